@@ -0,0 +1,475 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import re
+import signal
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from types import SimpleNamespace
+
+import tornado.web
+from telegram import Bot, Update
+from telegram.error import NetworkError, TelegramError
+from telegram.utils.request import Request
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+from metrics import serve
+from pathprofile_bot import API_URL, METRICS_PORT, OWNER, PORT, TOKEN, WEBHOOK_URL
+from pathprofile_bot import FREQ_PATTERN, HEIGHTS_PATTERN, MGRS_PATTERN, NUMBER_PATTERN, SESSION_EXPIRED
+from pathprofile_bot import coalescer, handling, limiter, logs, metrics, notifier, offloader, results, sessions
+from pathprofile_bot import Reply, Step, ask_mgrs, cancel_conversation, enter_freq, enter_heights, enter_mgrs
+from pathprofile_bot import enter_number_of_obstacles, enter_obstacle, enter_pathprofile, enter_radio
+from pathprofile_bot import start_pathprofile, get_azimuth_message, get_distance_message, get_error_message
+from pathprofile_bot import get_terrain_task, get_throttled_message, log, offload
+from pathprofile_bot import inline_query, send_cache_stats, send_edit, send_grid_stats, send_logs, send_reach
+from pathprofile_bot import send_relays, send_stats, send_sweep, start, version
+from sessions import ConversationStates
+
+try:
+    import pycurl  # noqa: F401
+    # Keeps the connections to telegram alive between calls, the default client opens one for every call
+    AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
+    KEEP_ALIVE = True
+except ImportError:
+    KEEP_ALIVE = False
+
+TELEGRAM_URL = "https://api.telegram.org/bot"  # Same as python-telegram-bot's, the token is appended
+CONNECTIONS = int(os.environ.get('PATHPROFILE_CONNECTIONS', 16))  # Calls to telegram in flight at once
+API_TIMEOUT = 30  # Seconds a call to telegram can take, including waiting for a connection
+WORKERS = 4  # Threads for the commands that are still handled by pathprofile_bot
+
+logger = logging.getLogger(__name__)
+
+# Record of the command being handled in this task, like pathprofile_bot.handling is for a thread
+record = contextvars.ContextVar("record", default=None)
+
+# Commands handled by the sync handlers of pathprofile_bot in a thread, they are quick or offload their work
+SYNC_COMMANDS = {"version": version, "start": start, "help": start, "sweep": send_sweep, "relay": send_relays,
+                 "edit": send_edit, "reach": send_reach, "logs": send_logs, "demstats": send_grid_stats,
+                 "cachestats": send_cache_stats, "stats": send_stats}
+
+
+class ApiClient:
+    """
+    Calls the telegram Bot API from the event loop with tornado's AsyncHTTPClient, at most connections calls at once,
+    so that many calls are in flight without a thread each
+    """
+
+    def __init__(self, base_url, connections=CONNECTIONS, timeout=API_TIMEOUT):
+        """:param base_url: URL the methods are appended to, e.g. https://api.telegram.org/bot<TOKEN>"""
+        self.base_url = base_url
+        self.timeout = timeout
+        self.client = AsyncHTTPClient(force_instance=True, max_clients=connections)
+
+    async def call(self, method, **params):
+        """
+        Calls method with params, which must be JSON serialisable
+        :return: its result, raises NetworkError if telegram cannot be reached and TelegramError if it answers with an
+        error
+        """
+        start_time = time.perf_counter()
+        try:
+            response = await self.client.fetch(f"{self.base_url}/{method}", method="POST", body=json.dumps(params),
+                                               headers={"Content-Type": "application/json"},
+                                               request_timeout=self.timeout, raise_error=False)
+        except (OSError, HTTPClientError) as e:  # E.g. connection refused or timed out, only HTTP errors are returned
+            raise NetworkError(str(e)) from e
+        finally:
+            metrics.observe_api(method, time.perf_counter() - start_time)
+
+        if response.code == 599:  # No response, as the curl client reports connection errors
+            raise NetworkError(str(response.error))
+        try:
+            data = json.loads(response.body)
+        except (TypeError, ValueError):
+            raise TelegramError(f"Invalid server response ({response.code})") from None
+        if not data.get("ok"):
+            raise TelegramError(data.get("description") or f"{method} failed")
+        return data["result"]
+
+    def close(self):
+        self.client.close()
+
+
+class LoopRequest(Request):
+    """
+    Request that sends the calls of a python-telegram-bot Bot through an ApiClient, for the sync handlers running in
+    other threads than the event loop
+    """
+
+    __slots__ = ("api", "loop")
+
+    def __init__(self, api, loop):
+        super().__init__()
+        self.api = api
+        self.loop = loop
+
+    def post(self, url, data, timeout=None):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            future = asyncio.run_coroutine_threadsafe(self.api.call(url.rsplit("/", 1)[-1], **(data or {})), self.loop)
+            return future.result()
+        raise RuntimeError("Sync Bot methods would block the event loop, use ApiClient.call")
+
+
+def log_command(update, command):
+    """pathprofile_bot.log for coroutines, keeping the record in the task"""
+    log(update, command)
+    record.set(handling.record)
+
+
+def logged(func):
+    """Records how long func takes and the state it returns in metrics, and adds the command it logs to logs"""
+
+    @wraps(func)
+    async def logged_func(self, update, *args):
+        record.set(None)
+        state = "error"
+        start_time = time.perf_counter()
+        try:
+            state = await func(self, update, *args)
+            return state
+        finally:
+            elapsed = time.perf_counter() - start_time
+            metrics.observe_handler(func.__name__, elapsed, state)
+            if record.get():
+                logs.add(record.get()._replace(latency=elapsed))
+
+    return logged_func
+
+
+def typing(func):
+    """Sends typing action while func handles the update, at the same time instead of before it"""
+    func = logged(func)
+
+    @wraps(func)
+    async def command_func(self, update, *args):
+        _, state = await asyncio.gather(self.send_typing(update), func(self, update, *args))
+        return state
+
+    return command_func
+
+
+def with_session(func):
+    """pathprofile_bot.with_session for coroutines"""
+
+    @wraps(func)
+    async def command_func(self, update, context):
+        chat_id = update.effective_chat.id
+        chat = await self.blocking(sessions.get, chat_id)
+        if chat is None:
+            await self.reply(update, SESSION_EXPIRED)
+            return -1
+
+        state = await func(self, update, context, chat)
+        await self.blocking(sessions.save, chat_id, chat)
+        return state
+
+    return command_func
+
+
+def get_command(message, username):
+    """
+    Command at the start of message and its arguments, like CommandHandler finds them
+    :return: e.g. ("distance", []) for /distance or /distance@username, None if it is not a command to this bot
+    """
+    entities = message.entities or []
+    if not message.text or not any(e.type == "bot_command" and e.offset == 0 for e in entities):
+        return None
+    words = message.text.split()
+    command, _, to = words[0][1:].partition("@")
+    if to and to.lower() != (username or "").lower():
+        return None
+    return command.lower(), words[1:]
+
+
+class AsyncBot:
+    """
+    Handles the updates of the webhook as coroutines on one event loop, so that many conversations progress at once
+    without a thread each. Updates of the same chat are handled one at a time, in order.
+    The steps of the conversations are the ones of pathprofile_bot, only sent from here. The other commands run the
+    handlers of pathprofile_bot in a few threads.
+    """
+
+    def __init__(self, api, loop, workers=WORKERS):
+        self.api = api
+        self.loop = loop
+        self.bot = Bot(TOKEN, base_url=API_URL, request=LoopRequest(api, loop))  # For the sync handlers
+        self.executor = ThreadPoolExecutor(workers)
+        self.store_executor = ThreadPoolExecutor(1)  # One is enough, SQLiteStore is used by one thread at a time
+        self.username = None
+
+        # (chat id, user id): state of its conversation, kept in sessions like the ConversationHandler's
+        self.states = ConversationStates(sessions)
+        self.locks = weakref.WeakValueDictionary()  # chat id: lock held while handling an update of the chat
+        self.tasks = set()  # Updates being handled, so that their tasks are not garbage collected
+
+        self.entry_points = {"distance": self.distance, "azimuth": self.azimuth, "pathprofile": self.pathprofile}
+        self.fallbacks = {"cancel": self.cancel, **self.entry_points}
+        mgrs = re.compile(MGRS_PATTERN)
+        heights = re.compile(HEIGHTS_PATTERN)
+        self.handlers = {  # state: (pattern of the messages it takes, None for the buttons, handler)
+            "distance": (mgrs, self.distance),
+            "azimuth": (mgrs, self.azimuth),
+            "pathprofile": (mgrs, self.pathprofile),
+            "get_radio": (None, self.get_radio),
+            "get_freq": (re.compile(FREQ_PATTERN), self.get_freq),
+            "get_height": (heights, self.get_height),
+            "get_number_of_obstacles": (re.compile(NUMBER_PATTERN), self.get_number_of_obstacles),
+            "get_obstacles": (heights, self.get_obstacles),
+        }
+
+    async def start(self):
+        self.username = (await self.api.call("getMe")).get("username")
+
+    def submit(self, data):
+        """Starts handling an update of the webhook and returns at once"""
+        task = self.loop.create_task(self.handle(data))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, data):
+        try:
+            update = Update.de_json(data, self.bot)
+            chat = update.effective_chat or update.effective_user
+            if chat is None or not await self.check_rate(update, chat):
+                return
+            if update.inline_query:  # Answered at once, no need to wait for the chat
+                await self.run_sync(inline_query, update, None)
+                return
+
+            # An identical update of the chat still waiting or being handled (e.g. MGRs sent twice) is only handled once
+            message = update.effective_message
+            key = (chat.id, "aiobot", update.callback_query.data if update.callback_query else message and message.text)
+            if not coalescer.join(key, lambda *_: None):
+                return
+            try:
+                lock = self.locks.get(chat.id)
+                if lock is None:
+                    lock = self.locks[chat.id] = asyncio.Lock()
+                async with lock:
+                    await self.dispatch(update)
+            finally:
+                coalescer.done(key, None, None)
+        except Exception:
+            logger.exception("Error handling update %s", data.get("update_id"))
+
+    async def check_rate(self, update, chat):
+        """pathprofile_bot.check_rate, :return: whether the update can be handled"""
+        allowed, warn = limiter.acquire(chat.id)
+        if not allowed and warn and update.effective_message:
+            await self.reply(update, get_throttled_message(chat.id))
+        return allowed
+
+    async def dispatch(self, update):
+        """Passes update to the handler of the conversation it is in, or of its command"""
+        key = (update.effective_chat.id, update.effective_user.id if update.effective_user else None)
+        message = update.message
+        command, args = (message and get_command(message, self.username)) or (None, None)
+
+        handler, context = None, SimpleNamespace(args=args, matches=None)
+        state = await self.blocking(self.states.get, key)
+        if state is not None:
+            pattern, state_handler = self.handlers[state]
+            if pattern is None and update.callback_query:
+                handler = state_handler
+            elif pattern is not None and message and message.text and (match := pattern.search(message.text)):
+                handler, context.matches = state_handler, [match]
+            elif command in self.fallbacks:
+                handler = self.fallbacks[command]
+        elif command in self.entry_points:
+            handler = self.entry_points[command]
+
+        if handler:
+            state = await handler(update, context)
+            if state == -1:
+                await self.blocking(self.states.pop, key)
+            elif state is not None:
+                await self.blocking(self.states.__setitem__, key, state)
+        elif command in SYNC_COMMANDS:
+            await self.run_sync(SYNC_COMMANDS[command], update, args)
+
+    async def run_sync(self, handler, update, args):
+        """Runs a handler of pathprofile_bot in a thread"""
+        await self.loop.run_in_executor(self.executor, handler, update, SimpleNamespace(bot=self.bot, args=args))
+
+    async def blocking(self, function, *args):
+        """
+        Runs function(*args) in the store's thread, for the calls to the session store, which can block the event loop
+        (SQLiteStore writes to disk), and the steps of the conversations that use it
+        """
+        return await self.loop.run_in_executor(self.store_executor, function, *args)
+
+    async def send_typing(self, update):
+        try:
+            await self.api.call("sendChatAction", chat_id=update.effective_chat.id, action="typing")
+        except Exception:  # Only cosmetic, the conversation goes on without it
+            logger.warning("Could not send typing action", exc_info=True)
+
+    async def reply(self, update, text, **params):
+        """Sends text to the chat of update, quoting the message in groups like Message.reply_text"""
+        message = update.effective_message
+        if message.chat.type != "private" and not update.callback_query:
+            params.setdefault("reply_to_message_id", message.message_id)
+        return await self.api.call("sendMessage", chat_id=message.chat_id, text=text, **params)
+
+    async def edit(self, message, text):
+        """Replaces the text of message, as returned by reply"""
+        return await self.api.call("editMessageText", chat_id=message["chat"]["id"],
+                                   message_id=message["message_id"], text=text)
+
+    async def send_step(self, update, step):
+        """pathprofile_bot.send_step for coroutines"""
+        for reply in step.replies:
+            if reply.edit:
+                await self.edit(update.callback_query.message.to_dict(), reply.text)
+            elif reply.buttons:
+                keyboard = [[{"text": option, "callback_data": option} for option in reply.buttons]]
+                await self.reply(update, reply.text, reply_markup={"inline_keyboard": keyboard})
+            else:
+                await self.reply(update, reply.text)
+
+        if step.terrain:
+            await self.reply_later(update, *get_terrain_task(update.effective_chat.id, step.terrain))
+        return step.state
+
+    async def reply_later(self, update, key, function, args, then=lambda result: result):
+        """
+        pathprofile_bot.reply_later for coroutines: function runs in the offload pool while the task waits for it,
+        leaving the event loop free for other chats
+        """
+        missing = object()
+        result = results.get(key, missing)
+        if result is not missing:
+            await self.reply(update, then(result))
+            return
+
+        working = await self.reply(update, "Working...")
+        future = self.loop.create_future()
+
+        def set_result(outcome):
+            if not future.done():
+                future.set_result(outcome)
+
+        offload(key, function, args, lambda *outcome: self.loop.call_soon_threadsafe(set_result, outcome))
+        result, error = await future
+        await self.edit(working, then(result) if error is None else get_error_message(error))
+
+    @typing
+    async def cancel(self, update, _):
+        log_command(update, "/cancel")
+        return await self.send_step(update, await self.blocking(cancel_conversation, update.message.chat_id))
+
+    @typing
+    async def azimuth(self, update, context):
+        if update.message.text == '/azimuth':
+            log_command(update, "/azimuth")
+            return await self.send_step(update, ask_mgrs("azimuth"))
+        return await self.send_step(update, Step([Reply(get_azimuth_message(context.matches[0].group(0)))], -1))
+
+    @typing
+    async def distance(self, update, context):
+        if update.message.text == '/distance':
+            log_command(update, "/distance")
+            return await self.send_step(update, ask_mgrs("distance"))
+        return await self.send_step(update, Step([Reply(get_distance_message(context.matches[0].group(0)))], -1))
+
+    @typing
+    async def pathprofile(self, update, context):
+        if context.args:
+            log_command(update, "/pathprofile")
+            step = await self.blocking(enter_pathprofile, update.message.chat_id, " ".join(context.args))
+            return await self.send_step(update, step)
+        elif update.message.text == "/pathprofile":
+            log_command(update, "/pathprofile")
+            return await self.send_step(update, await self.blocking(start_pathprofile, update.message.chat_id))
+        return await self.get_mgrs(update, context)
+
+    @with_session
+    async def get_mgrs(self, update, context, chat):
+        return await self.send_step(update, await self.blocking(enter_mgrs, chat, context.matches[0].group(0)))
+
+    @typing
+    @with_session
+    async def get_radio(self, update, _, chat):
+        return await self.send_step(update, await self.blocking(enter_radio, chat, update.callback_query.data))
+
+    @typing
+    @with_session
+    async def get_freq(self, update, context, chat):
+        return await self.send_step(update, await self.blocking(enter_freq, chat, context.matches[0].group(0)))
+
+    @typing
+    @with_session
+    async def get_height(self, update, context, chat):
+        step = await self.blocking(enter_heights, chat, *context.matches[0].group(1, 2))
+        return await self.send_step(update, step)
+
+    @typing
+    @with_session
+    async def get_number_of_obstacles(self, update, context, chat):
+        step = await self.blocking(enter_number_of_obstacles, chat, context.matches[0].group(0))
+        return await self.send_step(update, step)
+
+    @typing
+    @with_session
+    async def get_obstacles(self, update, context, chat):
+        step = await self.blocking(enter_obstacle, chat, *context.matches[0].group(1, 2))  # Calculates at the end
+        return await self.send_step(update, step)
+
+
+class WebhookHandler(tornado.web.RequestHandler):
+    """Takes the updates telegram posts to the webhook, answering at once while they are handled"""
+
+    def initialize(self, bot):
+        self.bot = bot
+
+    def post(self):
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        self.bot.submit(data)
+
+
+async def serve_webhook(port=PORT, url=None):
+    """Serves the webhook on port until SIGINT or SIGTERM"""
+    loop = asyncio.get_running_loop()
+    if not KEEP_ALIVE:
+        logger.warning("pycurl is not installed, every call to telegram opens a new connection")
+    api = ApiClient((API_URL or TELEGRAM_URL) + TOKEN)
+    bot = AsyncBot(api, loop)
+    await bot.start()
+    offloader.start()
+
+    if OWNER:
+        notifier.start(lambda text: bot.bot.send_message(OWNER, text))  # From the notifier's thread
+
+    if METRICS_PORT:
+        serve(metrics, METRICS_PORT)
+
+    server = tornado.web.Application([(f"/{TOKEN}", WebhookHandler, {"bot": bot})]).listen(port, "0.0.0.0")
+    print("Starting bot...")
+    await api.call("setWebhook", url=url or WEBHOOK_URL + TOKEN)
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    server.stop()
+    offloader.shutdown()
+    bot.executor.shutdown(wait=False)
+    bot.store_executor.shutdown(wait=False)
+    api.close()
+
+
+def run():
+    """Serves the bot, from python main.py bot with PATHPROFILE_ASYNC=1 so that pathprofile_bot is only imported once"""
+    asyncio.run(serve_webhook())
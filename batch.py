@@ -0,0 +1,181 @@
+import csv
+import json
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+
+from linkbudget import link_budget, pad_obstacles
+from main import check_float, check_freq, check_mgr, get_azimuth, get_distance
+
+CHUNK_SIZE = 1024  # Links computed together in one vectorized call
+
+INPUT_FIELDS = ["mgr1", "mgr2", "radio", "freq", "ht", "hr", "obstacles"]
+OUTPUT_FIELDS = ["row", "mgr1", "mgr2", "radio", "freq", "ht", "hr", "obstacles", "distance", "azimuth",
+                 "d1", "h", "los", "radius", "fsl", "pel", "case", "epl", "apl", "fm", "comms", "error"]
+RESULT_FIELDS = ["d1", "h", "los", "radius", "fsl", "pel", "case", "epl", "apl", "fm", "comms"]
+
+
+def get_format(path, default="csv"):
+    """csv or jsonl depending on the extension of path"""
+    if path and path.lower().endswith((".jsonl", ".json", ".ndjson")):
+        return "jsonl"
+    if path and path.lower().endswith(".csv"):
+        return "csv"
+    return default
+
+
+def read_links(f, fmt):
+    """
+    Yields every link in the file as a dict with the keys in INPUT_FIELDS, one line at a time, or None if the line
+    cannot be read. CSV files must have a header row. Obstacles are written as "5 30;10 50", or as [[5, 30], [10, 50]]
+    in JSONL.
+    """
+    if fmt == "csv":
+        yield from csv.DictReader(f)
+    else:
+        for line in f:
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield row if isinstance(row, dict) else None
+
+
+def parse_obstacles(obstacles):
+    """[(5.0, 30.0), (10.0, 50.0)] from "5 30;10 50" or [[5, 30], [10, 50]]"""
+    if not obstacles:
+        return []
+    if isinstance(obstacles, str):
+        obstacles = [obstacle.split() for obstacle in obstacles.split(";") if obstacle.strip()]
+    return [(float(d), float(h)) for d, h in obstacles]
+
+
+def parse_link(row):
+    """
+    Validates a link with the same checks as the CLI
+    :return: (distance, azimuth, freq, ht, hr, radio, obstacles), raises ValueError if the link is invalid
+    """
+    mgr1 = str(row.get("mgr1", ""))
+    mgr2 = str(row.get("mgr2", ""))
+    if not check_mgr(mgr1) or not check_mgr(mgr2):
+        raise ValueError("invalid mgr")
+
+    radio = str(row.get("radio", ""))
+    if radio not in ["406", "408"]:
+        raise ValueError("invalid radio")
+    radio = int(radio)
+
+    if not check_freq(radio, str(row.get("freq", ""))):
+        raise ValueError("invalid freq")
+
+    if not check_float(str(row.get("ht", ""))) or not check_float(str(row.get("hr", ""))):
+        raise ValueError("invalid height")
+
+    mgr1 = [float(x) / 10 for x in mgr1.split()]
+    mgr2 = [float(x) / 10 for x in mgr2.split()]
+    distance = get_distance(mgr1, mgr2)
+
+    try:
+        obstacles = parse_obstacles(row.get("obstacles"))
+    except (TypeError, ValueError):
+        raise ValueError("invalid obstacles") from None
+    if not all(0 < d < distance for d, _ in obstacles):
+        raise ValueError("obstacle must be between the two nodes")
+
+    return distance, get_azimuth(mgr1, mgr2), float(row["freq"]), float(row["ht"]), float(row["hr"]), radio, \
+        obstacles
+
+
+def compute_chunk(chunk, method="dominant"):
+    """
+    Validates and calculates a chunk of (row number, link) pairs in one vectorized call, see link_budget for method
+    :return: list of dicts with the keys in OUTPUT_FIELDS, in the same order as chunk
+    """
+    results = []
+    links = []
+    for number, row in chunk:
+        if row is None:
+            results.append({"row": number, "error": "invalid row"})
+            continue
+
+        result = {field: row.get(field, "") for field in INPUT_FIELDS}
+        result["row"] = number
+        try:
+            links.append((result, parse_link(row)))
+        except ValueError as e:
+            result["error"] = str(e)
+        results.append(result)
+
+    if links:
+        distance, azimuth, freq, ht, hr, radio, obstacles = zip(*(link for _, link in links))
+        budget = link_budget(distance, freq, ht, hr, radio, *pad_obstacles(obstacles), method=method)._asdict()
+
+        for i, (result, link) in enumerate(links):
+            result["distance"] = link[0]
+            result["azimuth"] = link[1]
+            for field in RESULT_FIELDS:
+                result[field] = budget[field][i].item()
+
+    return results
+
+
+def chunks(iterable, size):
+    """Splits iterable into lists of at most size items"""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def ordered_map(function, iterable, workers):
+    """
+    Like map, but fanned out to a process pool. At most 2 items per worker are in flight at once so memory stays
+    constant however long iterable is, and results come back in order.
+    """
+    if workers <= 1:
+        yield from map(function, iterable)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def write_results(results, f, fmt):
+    """Writes every result dict to f as CSV or JSONL"""
+    if fmt == "csv":
+        writer = csv.DictWriter(f, OUTPUT_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(results)
+    else:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+
+
+def run_batch(input_path, output_path=None, workers=1, chunk_size=CHUNK_SIZE, input_format=None, output_format=None,
+              method="dominant"):
+    """
+    Streams links from input_path (CSV or JSONL, "-" for stdin) through parse, validate, compute and write.
+    Invalid links are written with an error instead of stopping the batch.
+    """
+    input_format = input_format or get_format(input_path)
+    output_format = output_format or get_format(output_path, input_format)
+
+    f_in = sys.stdin if input_path == "-" else open(input_path, newline="")
+    f_out = sys.stdout if not output_path or output_path == "-" else open(output_path, "w", newline="")
+    try:
+        rows = enumerate(read_links(f_in, input_format), 1)
+        computed = ordered_map(partial(compute_chunk, method=method), chunks(rows, chunk_size), workers)
+        write_results((result for chunk in computed for result in chunk), f_out, output_format)
+    finally:
+        if f_in is not sys.stdin:
+            f_in.close()
+        if f_out is not sys.stdout:
+            f_out.close()
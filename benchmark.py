@@ -0,0 +1,147 @@
+import fnmatch
+import json
+import platform
+import timeit
+
+import numpy as np
+
+from linkbudget import effective_obstacle, link_budget, pad_obstacles
+from main import calculate_effective_obstacle, get_azimuth, get_azimuths, get_distance, get_distances
+
+SEED = 0  # Workloads are random but the same on every run
+OBSTACLE_COUNTS = [10, 100, 1000, 10000]
+PAIRWISE_MAX = 1000  # The pairwise search needs (m, m) arrays, too big to run beyond this
+THRESHOLD = 0.2  # Slowdown against the baseline flagged as a regression
+
+
+def get_links(n, m, rng):
+    """n random links of 10 to 30km with m random obstacles each between the nodes"""
+    distance = rng.uniform(10, 30, n)
+    obstacles = [list(zip(rng.uniform(0, 1, m) * d, rng.uniform(0, 100, m))) for d in distance]
+    return distance, obstacles
+
+
+def get_benchmarks():
+    """
+    Deterministic workloads of the hot paths
+    :return: {name: (function to time, number of operations it runs)}
+    """
+    rng = np.random.default_rng(SEED)
+    benchmarks = {}
+
+    mgr1 = rng.uniform(0, 100, (1000, 2)).tolist()
+    mgr2 = rng.uniform(0, 100, (1000, 2)).tolist()
+    pairs = list(zip(mgr1, mgr2))
+    benchmarks["get_distance"] = (lambda: [get_distance(a, b) for a, b in pairs], len(pairs))
+    benchmarks["get_azimuth"] = (lambda: [get_azimuth(a, b) for a, b in pairs], len(pairs))
+
+    array1, array2 = np.array(mgr1 * 100), np.array(mgr2 * 100)
+    benchmarks["get_distances[100000]"] = (lambda: get_distances(array1, array2), len(array1))
+    benchmarks["get_azimuths[100000]"] = (lambda: get_azimuths(array1, array2), len(array1))
+
+    distance, obstacles = get_links(1000, 2, rng)
+    triples = [(a, b, d) for d, (a, b) in zip(distance, obstacles)]
+    benchmarks["calculate_effective_obstacle"] = (lambda: [calculate_effective_obstacle(*x) for x in triples],
+                                                  len(triples))
+
+    # Step 2 on one link
+    for m in OBSTACLE_COUNTS:
+        distance, obstacles = get_links(1, m, rng)
+        obstacle_d, obstacle_h = pad_obstacles(obstacles)
+        for method in ["dominant", "pairwise"]:
+            if method == "pairwise" and m > PAIRWISE_MAX:
+                continue
+            benchmarks[f"effective_obstacle[{method},{m}]"] = (
+                lambda d=obstacle_d, h=obstacle_h, method=method, distance=distance:
+                effective_obstacle(d, h, distance, method), 1)
+        benchmarks[f"link_budget[deygout,{m}]"] = (
+            lambda d=obstacle_d, h=obstacle_h, distance=distance:
+            link_budget(distance, 800, 30, 40, 406, d, h, method="deygout"), 1)
+
+    benchmarks["calculate"] = get_calculate_benchmark(rng)
+    return benchmarks
+
+
+def get_calculate_benchmark(rng):
+    """The reply to the last step of /pathprofile, with the results cache emptied every time"""
+    import pathprofile_bot
+    from sessions import Session
+
+    distance, obstacles = get_links(1, 5, rng)
+    chat = Session("100 100", "200 200", ([10.0, 10.0], [20.0, 20.0]), distance[0], 406, 800.0, 30, 40,
+                   len(obstacles[0]), obstacles[0])
+
+    def run():
+        pathprofile_bot.results.clear()
+        pathprofile_bot.calculate(chat)
+
+    return run, 1
+
+
+def time_benchmark(function, operations, repeat=5, min_time=0.2):
+    """
+    Times function, called enough times per round for a round to take at least min_time
+    :return: {"number": calls per round, "best": and "median": seconds per operation over repeat rounds}
+    """
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / elapsed)) if elapsed < min_time else number
+    times = np.array(timer.repeat(repeat, number)) / number / operations
+    return {"number": number, "best": float(times.min()), "median": float(np.median(times))}
+
+
+def run_benchmarks(pattern="*", repeat=5, min_time=0.2):
+    """Times every benchmark whose name matches the glob pattern"""
+    results = {}
+    for name, (function, operations) in get_benchmarks().items():
+        if fnmatch.fnmatch(name, pattern):
+            results[name] = time_benchmark(function, operations, repeat, min_time)
+
+    return {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+            "results": results}
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Compares the best times of the benchmarks in both runs
+    :return: list of (name, baseline seconds, seconds, ratio, regressed), regressed if ratio > 1 + threshold
+    """
+    comparison = []
+    for name, result in results["results"].items():
+        if name in baseline["results"]:
+            before = baseline["results"][name]["best"]
+            ratio = result["best"] / before
+            comparison.append((name, before, result["best"], ratio, ratio > 1 + threshold))
+    return comparison
+
+
+def format_time(seconds):
+    for unit, scale in [("s", 1), ("ms", 1e-3), ("us", 1e-6)]:
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+def run_bench(output=None, baseline=None, threshold=THRESHOLD, pattern="*", repeat=5):
+    """
+    Prints the time per operation of the benchmarks, and how they compare to the results in baseline if it is given
+    :param output: JSON file to write the results to
+    :return: True if no benchmark is slower than the baseline by more than threshold
+    """
+    results = run_benchmarks(pattern, repeat)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if not baseline:
+        for name, result in results["results"].items():
+            print(f"{name:40} {format_time(result['best']):>10}")
+        return True
+
+    with open(baseline) as f:
+        comparison = compare(results, json.load(f), threshold)
+
+    for name, before, after, ratio, regressed in comparison:
+        print(f"{name:40} {format_time(before):>10} {format_time(after):>10} {ratio:6.2f}x"
+              f"{'  REGRESSION' if regressed else ''}")
+    return not any(regressed for *_, regressed in comparison)
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries also expire ttl seconds after they are added, or after they were last read if
+    refresh is set. Safe to share between the threads the bot runs handlers in.
+    """
+
+    def __init__(self, max_size=1024, ttl=3600, clock=time.monotonic, refresh=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.refresh = refresh
+        self.entries = OrderedDict()  # key: (time it expires, value), least recently used first
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """Value for key if it is cached and has not expired, default otherwise"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            if self.refresh:
+                self.entries[key] = (self.clock() + self.ttl, entry[1])
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        """Caches value for key, evicting the least recently used entries if the cache is full"""
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Removes key from the cache, returning its value if it was cached and has not expired"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= self.clock():
+                return default
+            return entry[1]
+
+    def get_or_compute(self, key, compute):
+        """Cached value for key, calling compute() and caching its result on a miss"""
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        """Hit/miss/eviction/expiration counters and current size of the cache"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "size": len(self.entries),
+                "max_size": self.max_size,
+            }
+
+    def clear(self):
+        """Empties the cache and resets the counters"""
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = self.evictions = self.expirations = 0
@@ -0,0 +1,93 @@
+import json
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+from logging.handlers import RotatingFileHandler
+
+PAGE_SIZE = 20  # Records per page of /logs, keeps a page well under the longest message telegram accepts
+
+# A command someone ran: unix time, telegram id and username, and seconds the handler took (None if still running)
+Record = namedtuple("Record", ["time", "user_id", "username", "command", "latency"])
+
+
+class CommandLog:
+    """
+    The last capacity commands run, oldest dropped first. If path is set, every record is also appended to it as a line
+    of JSON, rolling over to path.1, path.2... once it reaches max_bytes.
+    """
+
+    def __init__(self, capacity=1000, path=None, max_bytes=2 ** 20, backups=3):
+        self.records = deque(maxlen=capacity)
+        self.lock = threading.Lock()
+        self.total = 0  # Records added, including the ones dropped
+
+        self.logger = None
+        if path:
+            self.logger = logging.getLogger(f"{__name__}.{path}")
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            if not self.logger.handlers:
+                self.logger.addHandler(RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups))
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+            self.total += 1
+        if self.logger:
+            self.logger.info(json.dumps(record._asdict(), separators=(",", ":")))
+
+    def find(self, user=None, command=None):
+        """
+        Records newest first, filtered on user and command if they are given
+        :param user: telegram id or username
+        :param command: e.g. /pathprofile
+        """
+        with self.lock:
+            records = list(self.records)
+
+        return [record for record in reversed(records)
+                if (user is None or user in (str(record.user_id), record.username))
+                and (command is None or record.command == command)]
+
+    def page(self, page=1, page_size=PAGE_SIZE, user=None, command=None):
+        """
+        One page of find
+        :return: records of the page, number of pages
+        """
+        records = self.find(user, command)
+        pages = max(1, -(-len(records) // page_size))
+        return records[(page - 1) * page_size:page * page_size], pages
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+
+def get_logs_message(records, page, pages):
+    """Text listing records, one per line"""
+    if not records:
+        return "No logs."
+
+    message = f"Page {page}/{pages}\n"
+    for record in records:
+        latency = f" in {record.latency * 1000:.0f}ms" if record.latency is not None else ""
+        message += f"{time.strftime('%d %b %H:%M:%S', time.gmtime(record.time))} @{record.username} " \
+                   f"({record.user_id}) ran {record.command}{latency}\n"
+    return message
+
+
+def parse_logs_args(args):
+    """
+    Arguments of /logs: a page number, @username or @id to filter on, and a /command to filter on, in any order
+    :return: page, user, command
+    """
+    page, user, command = 1, None, None
+    for arg in args:
+        if arg.isdigit():
+            page = max(1, int(arg))
+        elif arg.startswith("@"):
+            user = arg[1:]
+        elif arg.startswith("/"):
+            command = arg
+    return page, user, command
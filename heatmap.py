@@ -0,0 +1,163 @@
+import struct
+import zlib
+from collections import namedtuple
+
+import numpy as np
+
+from batch import ordered_map
+from linkbudget import FM_THRESHOLD, link_budget
+from main import get_distances
+from terrain import open_grid
+
+CHUNK_CELLS = 2 ** 16  # Cells evaluated together without terrain
+CHUNK_SAMPLES = 2 ** 22  # Terrain samples evaluated together, which bounds the memory of a chunk
+
+# FM (dB) of every cell of an area, row i and column j being the cell at northings[i] and eastings[j] in km. Rows go
+# from north to south like an image. NaN where the FM is unknown (the transmitter's cell and outside of the grid).
+Coverage = namedtuple("Coverage", ["eastings", "northings", "fm"])
+
+
+def get_cells(box, step):
+    """
+    Eastings and northings of the cells of an area
+    :param box: (easting, northing, easting, northing) of 2 opposite corners in km
+    :param step: size of the cells in km
+    :return: eastings from west to east, northings from north to south
+    """
+    e1, e2 = sorted(box[0::2])
+    n1, n2 = sorted(box[1::2])
+    eastings = np.arange(round((e2 - e1) / step) + 1) * step + e1
+    northings = n2 - np.arange(round((n2 - n1) / step) + 1) * step
+    return eastings, northings
+
+
+def evaluate_cells(mgr, cells, freq, ht, hr, radio, grid_path=None):
+    """
+    FM from the transmitter at mgr to a receiver at every cell, with the obstacles of every ray taken from the
+    elevation grid at grid_path if it is given. Runs in worker processes, so the grid is opened by path.
+    :param cells: (n, 2) array of mgrs in km
+    :return: (n,) float32 array, NaN at mgr and outside of the grid
+    """
+    distance = get_distances(mgr, cells)
+    fm = np.full(len(cells), np.nan, dtype=np.float32)
+    valid = distance > 0
+
+    obstacles = ()
+    if grid_path:
+        grid = open_grid(grid_path)
+        rounded = np.rint(cells * 10).astype(int)
+        valid &= grid.contains(rounded[:, 0], rounded[:, 1])
+        if not valid.any():  # The whole chunk is outside of the grid
+            return fm
+        obstacles = grid.profiles(np.broadcast_to(mgr, cells[valid].shape), cells[valid])
+
+    fm[valid] = link_budget(distance[valid], freq, ht, hr, radio, *obstacles).fm
+    return fm
+
+
+def evaluate_chunk(args):
+    """evaluate_cells with its arguments packed together, for ordered_map"""
+    return evaluate_cells(*args)
+
+
+def get_chunks(mgr, cells, terrain):
+    """
+    Splits cells into chunks to evaluate together
+    :return: list of index arrays. With terrain, cells are ordered by the number of samples of their ray, so that rays
+    of similar lengths are padded together and every chunk has at most about CHUNK_SAMPLES samples
+    """
+    if not terrain:
+        return np.array_split(np.arange(len(cells)), max(1, -(-len(cells) // CHUNK_CELLS)))
+
+    samples = np.ceil(np.abs(cells - mgr).max(axis=1) * 10).astype(int) + 1  # Like ElevationGrid.profiles
+    order = np.argsort(samples, kind="stable")
+    samples = samples[order]
+
+    chunks = []
+    start = 0
+    while start < len(order):
+        # Longest chunk from start whose rays, padded to the longest (last) of them, fit in CHUNK_SAMPLES
+        size = np.arange(1, len(order) - start + 1) * samples[start:]
+        end = start + max(1, np.searchsorted(size, CHUNK_SAMPLES, side="right"))
+        chunks.append(order[start:end])
+        start = end
+    return chunks
+
+
+def coverage(mgr, box, step, radio, freq, ht, hr, grid=None, workers=1):
+    """
+    FM from a transmitter at mgr to a receiver at every cell of an area, evaluated in vectorized chunks. With an
+    elevation grid, the obstacles of every ray are taken from the terrain.
+    :param mgr: [10.0, 10.0] in km, as returned by main.get_mgr
+    :param box: (easting, northing, easting, northing) of 2 opposite corners of the area, in km
+    :param step: size of the cells in km
+    :param ht: height of the transmitter (m)
+    :param hr: height of the receivers (m)
+    :param grid: ElevationGrid to take the obstacles from
+    :param workers: number of processes to evaluate the chunks with
+    :return: Coverage
+    """
+    mgr = np.asarray(mgr, dtype=float)
+    if grid is not None:
+        cell = np.rint(mgr * 10).astype(int)
+        if not grid.contains(cell[0], cell[1]):
+            raise ValueError("Transmitter is outside of the elevation grid")
+
+    eastings, northings = get_cells(box, step)
+    cells = np.stack(np.meshgrid(eastings, northings), axis=-1).reshape(-1, 2)
+    grid_path = grid.path if grid is not None else None
+
+    chunks = get_chunks(mgr, cells, grid is not None)
+    fm = np.empty(len(cells), dtype=np.float32)
+    args = ((mgr, cells[chunk], freq, ht, hr, radio, grid_path) for chunk in chunks)
+    for chunk, result in zip(chunks, ordered_map(evaluate_chunk, args, workers)):
+        fm[chunk] = result
+
+    return Coverage(eastings, northings, fm.reshape(len(northings), len(eastings)))
+
+
+def get_pixels(fm, vmin=FM_THRESHOLD - 30, vmax=FM_THRESHOLD + 30):
+    """
+    Grayscale image of a coverage raster, from 1 at vmin to 255 at vmax, so that FM_THRESHOLD is mid gray by default.
+    Cells without a FM are 0.
+    :return: uint8 array of the same shape as fm
+    """
+    known = np.isfinite(fm)
+    scaled = (np.clip(np.where(known, fm, vmin), vmin, vmax) - vmin) / ((vmax - vmin) or 1)
+    return np.where(known, 1 + np.rint(scaled * 254), 0).astype(np.uint8)
+
+
+def write_image(path, pixels):
+    """Writes a grayscale image as PGM, or as PNG if path ends with .png"""
+    height, width = pixels.shape
+    with open(path, "wb") as f:
+        if not path.lower().endswith(".png"):
+            f.write(f"P5\n{width} {height}\n255\n".encode())
+            f.write(np.ascontiguousarray(pixels, dtype=np.uint8).tobytes())
+            return
+
+        def chunk(kind, data):
+            return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+        rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), pixels.astype(np.uint8)])  # Filter type 0 per row
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows.tobytes())))
+        f.write(chunk(b"IEND", b""))
+
+
+def run_coverage(mgr, box, step, radio, freq, ht, hr, output=None, image=None, workers=1):
+    """
+    Prints how much of an area the transmitter at mgr covers, writing the FM raster to output (.npz with fm, eastings
+    and northings) and a rendering of it to image (.png or .pgm) if they are given
+    """
+    result = coverage(mgr, box, step, radio, freq, ht, hr, grid=open_grid(), workers=workers)
+
+    if output:
+        np.savez(output, fm=result.fm, eastings=result.eastings, northings=result.northings)
+    if image:
+        write_image(image, get_pixels(result.fm))
+
+    known = np.isfinite(result.fm)
+    covered = (result.fm[known] > FM_THRESHOLD).mean() if known.any() else 0
+    print(f"{result.fm.shape[1]}x{result.fm.shape[0]} cells, comms through on {covered:.1%} of them")
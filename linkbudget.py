@@ -0,0 +1,303 @@
+from collections import namedtuple
+
+import numpy as np
+
+# EPL cases (Step 6)
+CASE_FSL = 0  # case 1/2: no obstruction within 0.6 of the first fresnel zone
+CASE_PEL = 1  # case 3: obstruction within 0.6 of the first fresnel zone but not blocking the LOS
+CASE_FSL_SL = 2  # case 4: obstacle blocks the LOS and FSL > PEL
+CASE_PEL_SL = 3  # case 4: obstacle blocks the LOS and PEL >= FSL
+CASE_DIFFRACTION = 4  # deygout method: obstacles within the first fresnel zone, diffraction loss of each main edge
+
+CASE_MESSAGES = {
+    CASE_FSL: "Since the obstacle is not within 0.6 of the first fresnel zone, EPL = FSL",
+    CASE_PEL: "Since the obstacle is within 0.6 of the first fresnel zone but does not block the LOS, EPL = PEL",
+    CASE_FSL_SL: "Since the obstacle blocks the LOS, EPL = FSL + SL",
+    CASE_PEL_SL: "Since the obstacle blocks the LOS, EPL = PEL + SL",
+    CASE_DIFFRACTION: "Since obstacles are within the first fresnel zone, EPL = FSL + the diffraction loss of the "
+                      "main obstacles",
+}
+
+# Step 7: APL, we assume receiver sensitivity using 2048MBps
+APL_406 = 40. + 2 * 15 - 2 * 9 - (-82)
+APL_408 = 36. + 2 * 20 - 2 * 2.4 - (-82)
+
+FM_THRESHOLD = 20  # Comms are through if FM is above this
+
+DEYGOUT_DEPTH = 2  # Levels of edges of the deygout method: the main edge, then the main edge on either side of it
+
+# Results of the link budget: corrected final obstacle (d1, h), LOS height over the obstacle, 0.6 of the first fresnel
+# zone radius, FSL, PEL, EPL case, EPL, APL, FM and whether comms are through
+LinkBudget = namedtuple("LinkBudget", ["d1", "h", "los", "radius", "fsl", "pel", "case", "epl", "apl", "fm", "comms"])
+
+
+def pad_obstacles(obstacle_sets):
+    """
+    Converts a list of obstacle sets into two padded 2D arrays of distances and heights, padded with NaN
+    :param obstacle_sets: [[(5, 30), (10, 50)], [], [(2, 10)]]
+    :return: (obstacle_d, obstacle_h) each of shape (number of links, largest number of obstacles)
+    """
+    width = max((len(obstacles) for obstacles in obstacle_sets), default=0)
+    obstacle_d = np.full((len(obstacle_sets), width), np.nan)
+    obstacle_h = np.full((len(obstacle_sets), width), np.nan)
+
+    for i, obstacles in enumerate(obstacle_sets):
+        if len(obstacles):
+            obstacle_d[i, :len(obstacles)], obstacle_h[i, :len(obstacles)] = np.asarray(obstacles, dtype=float).T
+
+    return obstacle_d, obstacle_h
+
+
+def largest_single_obstacle(obstacle_d, obstacle_h):
+    """Highest of the obstacles themselves, starting from (0, 0). The first one wins ties just like the original loop"""
+    n, m = obstacle_h.shape
+    d1 = np.zeros(n)
+    h = np.zeros(n)
+    if m == 0:
+        return d1, h
+
+    heights = np.where(np.isnan(obstacle_h), -np.inf, obstacle_h)
+    best = np.argmax(heights, axis=1)
+    rows = np.arange(n)
+    found = heights[rows, best] > 0
+
+    return np.where(found, obstacle_d[rows, best], d1), np.where(found, obstacle_h[rows, best], h)
+
+
+def pairwise_effective_obstacle(obstacle_d, obstacle_h, distance):
+    """
+    Original O(m^2) search: imaginary obstacle of every pair (i, x) with i < x, using the same formula as
+    main.calculate_effective_obstacle. Kept to verify effective_obstacle against.
+    """
+    d1, h = largest_single_obstacle(obstacle_d, obstacle_h)
+    n, m = obstacle_h.shape
+    if m < 2:
+        return d1, h
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        grad1 = obstacle_h / obstacle_d
+        grad2 = -obstacle_h / (distance[:, None] - obstacle_d)
+        pair_d = ((grad2 * obstacle_d - obstacle_h)[:, None, :]) / (grad2[:, None, :] - grad1[:, :, None])
+        pair_h = grad1[:, :, None] * pair_d
+
+    pair_h = np.where(np.triu(np.ones((m, m), dtype=bool), 1) & np.isfinite(pair_h), pair_h, -np.inf)
+    pair_h = pair_h.reshape(n, m * m)
+    pair_d = pair_d.reshape(n, m * m)
+    rows = np.arange(n)
+    best = np.argmax(pair_h, axis=1)
+    found = pair_h[rows, best] > h
+
+    return np.where(found, pair_d[rows, best], d1), np.where(found, pair_h[rows, best], h)
+
+
+def dominant_effective_obstacle(obstacle_d, obstacle_h, distance):
+    """
+    O(m) search returning the same obstacle as pairwise_effective_obstacle.
+    The imaginary obstacle of a pair (i, x) is where the line from the transmitting node over obstacle i meets the line
+    from the receiving node over obstacle x. Its height only grows with the gradient of either line, so for every x
+    the best partner is the obstacle with the steepest gradient from the transmitting node among those before x,
+    which is a running maximum. Only obstacles above the ground and strictly between the two nodes are considered.
+    """
+    d1, h = largest_single_obstacle(obstacle_d, obstacle_h)
+    n, m = obstacle_h.shape
+    if m < 2:
+        return d1, h
+
+    valid = (obstacle_h > 0) & (obstacle_d > 0) & (obstacle_d < distance[:, None])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        grad1 = np.where(valid, obstacle_h / obstacle_d, -np.inf)
+
+    # Steepest gradient from the transmitting node among the obstacles before x, and the first obstacle achieving it
+    steepest = np.maximum.accumulate(grad1, axis=1)
+    steepest = np.concatenate([np.full((n, 1), -np.inf), steepest[:, :-1]], axis=1)
+    index = np.arange(m)
+    first = np.maximum.accumulate(np.where(grad1 > steepest, index, 0), axis=1)
+    partner = np.concatenate([np.zeros((n, 1), dtype=int), first[:, :-1]], axis=1)
+
+    # Imaginary obstacle of every (partner, x) pair, using the same formula as main.calculate_effective_obstacle
+    with np.errstate(divide="ignore", invalid="ignore"):
+        grad2 = -obstacle_h / (distance[:, None] - obstacle_d)
+        pair_d = (grad2 * obstacle_d - obstacle_h) / (grad2 - steepest)
+        pair_h = steepest * pair_d
+
+    pair_h = np.where(valid & np.isfinite(steepest) & np.isfinite(pair_h), pair_h, -np.inf)
+
+    # Highest pair, ties go to the pair the original nested loop would have seen first
+    rows = np.arange(n)
+    order = np.where(pair_h == pair_h.max(axis=1, keepdims=True), partner * m + index, m * m)
+    best = np.argmin(order, axis=1)
+    found = pair_h[rows, best] > h
+
+    return np.where(found, pair_d[rows, best], d1), np.where(found, pair_h[rows, best], h)
+
+
+EFFECTIVE_OBSTACLE_METHODS = {
+    "dominant": dominant_effective_obstacle,
+    "pairwise": pairwise_effective_obstacle,
+}
+
+
+def knife_edge_loss(v):
+    """Diffraction loss (dB) of a single knife edge with Fresnel-Kirchhoff parameter v (ITU-R P.526), 0 below -0.78"""
+    v = np.asarray(v, dtype=float)
+    with np.errstate(invalid="ignore"):
+        loss = 6.9 + 20 * np.log10(np.sqrt((v - 0.1) ** 2 + 1) + v - 0.1)
+    return np.where(v > -0.78, loss, 0.0)
+
+
+def deygout_obstacles(obstacle_d, obstacle_h, distance, freq, ht, hr, depth=DEYGOUT_DEPTH):
+    """
+    Deygout's method over every obstacle: the main edge is the obstacle with the highest Fresnel-Kirchhoff parameter v
+    between the 2 nodes, then the main edge between each node and it, and so on for depth levels, stopping under
+    edges that do not diffract (v <= -0.78). The v of every obstacle in every segment of a level is calculated at once,
+    so a level costs O(m) per segment.
+    :param obstacle_d: (n, m) distances of the obstacles from the transmitting node, NaN padded
+    :param obstacle_h: (n, m) heights of the obstacles before the earth curvature correction, NaN padded
+    :return: (d1, h) of the main edge of every link as returned by effective_obstacle, (0, 0) without obstacles, and
+    the total diffraction loss (dB) of its edges
+    """
+    obstacle_d = np.asarray(obstacle_d, dtype=float)
+    obstacle_h = np.asarray(obstacle_h, dtype=float)
+    n, m = obstacle_h.shape
+    d1 = np.zeros(n)
+    h = np.zeros(n)
+    loss = np.zeros(n)
+    if m == 0:
+        return d1, h, loss
+
+    # Step 3 for every obstacle at once, and the factor of v that only depends on the frequency
+    heights = obstacle_h + obstacle_d * (distance[:, None] - obstacle_d) / 12.75 / 0.7
+    scale = (2 / (300 / freq) / 1000)[:, None, None]  # 2 / wavelength (m), with distances in km
+
+    # Segments between the nodes and the edges found so far: distance and height of their ends
+    start_d, start_h = np.zeros((n, 1)), ht[:, None]
+    end_d, end_h = distance[:, None], hr[:, None]
+    active = np.ones((n, 1), dtype=bool)
+    rows = np.arange(n)[:, None]
+
+    for level in range(depth):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            near = obstacle_d[:, None, :] - start_d[:, :, None]
+            far = end_d[:, :, None] - obstacle_d[:, None, :]
+            line = start_h[:, :, None] + (end_h - start_h)[:, :, None] * near / (end_d - start_d)[:, :, None]
+            v = (heights[:, None, :] - line) * np.sqrt(scale * (1 / near + 1 / far))
+        v = np.where((near > 0) & (far > 0) & active[:, :, None] & np.isfinite(v), v, -np.inf)
+
+        best = np.argmax(v, axis=2)
+        best_v = np.take_along_axis(v, best[:, :, None], axis=2)[:, :, 0]
+        loss += knife_edge_loss(best_v).sum(axis=1)
+
+        edge_d, edge_h = obstacle_d[rows, best], heights[rows, best]
+        if level == 0:
+            found = np.isfinite(best_v[:, 0])
+            d1 = np.where(found, edge_d[:, 0], 0.0)
+            h = np.where(found, obstacle_h[rows, best][:, 0], 0.0)
+
+        # Every diffracting edge splits its segment in 2
+        active = np.repeat(best_v > -0.78, 2, axis=1)
+        start_d = np.stack([start_d, edge_d], axis=2).reshape(n, -1)
+        start_h = np.stack([start_h, edge_h], axis=2).reshape(n, -1)
+        end_d = np.stack([edge_d, end_d], axis=2).reshape(n, -1)
+        end_h = np.stack([edge_h, end_h], axis=2).reshape(n, -1)
+
+    return d1, h, loss
+
+
+def effective_obstacle(obstacle_d, obstacle_h, distance, method="dominant"):
+    """
+    Step 2: calculate height and distance of the final obstacle for every link.
+    The final obstacle is the highest of the obstacles themselves and of the imaginary obstacles created by every
+    pair of obstacles (see main.calculate_effective_obstacle), starting from (0, 0).
+    :param obstacle_d: (n, m) distances of the obstacles from the transmitting node, NaN padded
+    :param obstacle_h: (n, m) heights of the obstacles, NaN padded
+    :param distance: (n,) total distance of each link
+    :param method: "dominant" for the O(m) search or "pairwise" for the original O(m^2) one
+    :return: (d1, h) arrays of shape (n,)
+    """
+    if method not in EFFECTIVE_OBSTACLE_METHODS:
+        raise ValueError(f"Unknown effective obstacle method {method!r}")
+
+    obstacle_d = np.asarray(obstacle_d, dtype=float)
+    obstacle_h = np.asarray(obstacle_h, dtype=float)
+    distance = np.asarray(distance, dtype=float)
+
+    return EFFECTIVE_OBSTACLE_METHODS[method](obstacle_d, obstacle_h, distance)
+
+
+def link_budget(distance, freq, ht, hr, radio, obstacle_d=None, obstacle_h=None, method="dominant", effective=None):
+    """
+    Steps 2 to 9 of the path profile for many links at once. Every argument is array-like with one entry per link
+    (scalars are broadcast), apart from the obstacles which are padded 2D arrays as returned by pad_obstacles.
+    method selects the effective obstacle search, see effective_obstacle, or is "deygout" to add the diffraction loss
+    of the main obstacles (see deygout_obstacles) to FSL instead of the EPL cases of Step 6, d1 and h being the main
+    edge.
+    effective can be the (d1, h) returned by effective_obstacle to skip Step 2, e.g. when only the frequency or heights
+    of links change. They are broadcast like the other arguments and the obstacles are then ignored.
+    :return: LinkBudget of arrays of shape (n,)
+    """
+    if method == "deygout" and effective is not None:
+        raise ValueError("The deygout method needs every obstacle, not an effective obstacle")
+
+    distance, freq, ht, hr = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(x, dtype=float)) for x in (distance, freq, ht, hr)))
+    radio = np.asarray(radio)
+
+    # Step 2: calculate height and distance of final obstacle
+    diffraction = None
+    if effective is not None:
+        d1, h = (np.broadcast_to(np.asarray(x, dtype=float), distance.shape) for x in effective)
+    elif method == "deygout" and obstacle_d is not None:
+        d1, h, diffraction = deygout_obstacles(obstacle_d, obstacle_h, distance, freq, ht, hr)
+    elif obstacle_d is None:
+        d1, h = effective_obstacle(np.empty((distance.size, 0)), np.empty((distance.size, 0)), distance)
+    else:
+        d1, h = effective_obstacle(obstacle_d, obstacle_h, distance, method)
+    d2 = distance - d1
+
+    # Step 3: adjust height of final obstacles for earth curvature correction
+    h = h + d1 * d2 / 12.75 / 0.7
+
+    # Degenerate links (e.g. zero distance or height) give inf or NaN rather than warnings
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Step 4: calculate height of LOS over the obstacle
+        los = np.where(hr > ht, (hr - ht) * d1 / distance + ht,
+                       np.where(ht > hr, (ht - hr) * d2 / distance + hr, ht))
+
+        # Step 5: calculate height of 0.6 first fresnel zone
+        radius = 0.6 * 548 * (d1 * d2 / freq / distance) ** 0.5
+        ffz_height = los - radius
+
+        # Step 6: find the relevant case and calculate EPL
+        fsl = 20 * np.log10(41.87 * freq * distance)
+        pel = 115.11 + 40 * np.log10(distance) - 20 * np.log10(ht * hr)
+        sl_fs = 19.22 * np.log10(h) - 9.5 * np.log10(d1) + 10 * np.log10(freq) - 41.84
+        sl_pe = 20.3 * np.log10(h) - 20 * np.log10(d1) + 10 * np.log10(freq) - 40
+
+        case = np.where(h < ffz_height, CASE_FSL,
+                        np.where(h > los, np.where(fsl > pel, CASE_FSL_SL, CASE_PEL_SL), CASE_PEL))
+        epl = np.choose(case, [fsl, pel, fsl + sl_fs, pel + sl_pe])
+
+    if diffraction is not None:
+        case = np.where(diffraction > 0, CASE_DIFFRACTION, CASE_FSL)
+        epl = fsl + diffraction
+
+    # Step 7: calculate APL
+    apl = np.where(radio == 408, APL_408, APL_406)
+
+    # Step 8: calculate FM
+    fm = apl - epl
+
+    # Step 9: conclude if comms is through
+    comms = fm > FM_THRESHOLD
+
+    return LinkBudget(d1, h, los, radius, fsl, pel, case, epl, apl, fm, comms)
+
+
+def evaluate_link(distance, freq, ht, hr, radio, obstacles=(), method="dominant", effective=None):
+    """
+    Link budget of a single link, with plain python numbers instead of arrays. effective is the (d1, h) of the link
+    as returned by effective_obstacle, see link_budget.
+    """
+    result = link_budget([distance], [freq], [ht], [hr], [radio], *pad_obstacles([obstacles]), method=method,
+                         effective=effective)
+    return LinkBudget(*(field[0].item() for field in result))
@@ -0,0 +1,318 @@
+import itertools
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+TOKEN = "123456:loadtest"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Path Profile", "username": "pathprofile_bot"}
+STEP_TIMEOUT = 30  # Seconds to wait for the reply to a step before counting it as an error
+
+# Scripted conversations: every step is a message (or ("callback", data) for a button) and texts one of which is in
+# the last reply to it. Callbacks press the button of the last reply of the step before.
+SCRIPTS = {
+    "distance": [("/distance", ("Please enter",)), ("100 100\n200 200", ("Distance:",))],
+    "azimuth": [("/azimuth", ("Please enter",)), ("100 100\n200 200", ("Azimuth:",))],
+    "pathprofile": [("/pathprofile", ("Please enter the two MGRs",)),
+                    ("100 100\n200 200", ("Radio type",)),
+                    (("callback", "406"), ("Please enter transmitting frequency",)),
+                    ("800.00", ("Please enter height",)),
+                    ("30 40", ("Please enter number of obstacles",)),
+                    ("2", ("Please enter distance between obstacle 1",)),
+                    ("5 30", ("Please enter distance between obstacle 2",)),
+                    ("7 40", ("Comms through", "No comms"))],
+}
+
+
+class FakeTelegram:
+    """
+    Stand-in for the telegram Bot API on localhost: answers the methods the bot calls like telegram would and hands
+    every message the bot sends or edits to the queue of its chat, so replies can be waited for
+    """
+
+    def __init__(self, port=0, host="127.0.0.1"):
+        self.replies = defaultdict(queue.Queue)  # chat id: (time, message) of every message sent or edited
+        self.calls = Counter()  # Calls to each method
+        self.webhook = threading.Event()  # Set once the bot has set its webhook
+        self.message_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keeps the connections of the bot's pool alive
+            disable_nagle_algorithm = True  # Or the body waits for the ACK of the headers on a kept alive connection
+
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                try:
+                    data = json.loads(body) if body else {}
+                except ValueError:
+                    data = {}
+
+                result = fake.answer(method, data)
+                if result is None:
+                    response = {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+                else:
+                    response = {"ok": True, "result": result}
+
+                body = json.dumps(response).encode()
+                self.send_response(200 if result is not None else 404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST
+
+            def log_message(self, *_):
+                pass
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 128  # Not 5, or the connections a bot opens at once wait for SYN retries (1s)
+
+        self.server = Server((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.url = f"http://{host}:{self.port}/bot"  # Base URL for the bot, which appends its token
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-telegram", daemon=True).start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def answer(self, method, data):
+        """Result of a call to method, or None if the method is not faked"""
+        with self.lock:
+            self.calls[method] += 1
+
+        if method == "getMe":
+            return BOT_USER
+        if method in ("setWebhook", "deleteWebhook"):
+            if method == "setWebhook":
+                self.webhook.set()
+            return True
+        if method in ("sendChatAction", "answerCallbackQuery", "answerInlineQuery"):
+            return True
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(data.get("chat_id", 0))
+            message_id = int(data["message_id"]) if "message_id" in data else next(self.message_ids)
+            message = {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                       "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", "")}
+            self.replies[chat_id].put((time.perf_counter(), message))
+            return message
+        return None
+
+
+class Conversation:
+    """One user chatting with the bot through its webhook, waiting for the reply to every step before the next"""
+
+    update_ids = itertools.count(1)
+
+    def __init__(self, webhook_url, fake, chat_id):
+        """:param fake: FakeTelegram the bot replies through"""
+        self.webhook_url = webhook_url
+        self.replies = fake.replies[chat_id]  # Created before the bot can reply
+        self.chat_id = chat_id
+        self.user = {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}", "username": f"user{chat_id}"}
+        self.last = None  # Last reply of the step before
+
+    def get_update(self, step):
+        update = {"update_id": next(self.update_ids)}
+        chat = {"id": self.chat_id, "type": "private"}
+        if isinstance(step, tuple):
+            update["callback_query"] = {"id": str(update["update_id"]), "from": self.user, "chat_instance": "1",
+                                        "data": step[1], "message": self.last}
+        else:
+            update["message"] = {"message_id": update["update_id"], "date": int(time.time()), "chat": chat,
+                                 "from": self.user, "text": step}
+            if step.startswith("/"):
+                update["message"]["entities"] = [{"type": "bot_command", "offset": 0,
+                                                  "length": len(step.split()[0])}]
+        return update
+
+    def send(self, step, expected):
+        """
+        Posts step to the webhook and waits for a reply containing one of the expected texts, skipping the replies
+        before it
+        :return: seconds until the reply, raises TimeoutError if it does not come
+        """
+        replies = self.replies
+        request = urllib.request.Request(self.webhook_url, json.dumps(self.get_update(step)).encode(),
+                                         {"Content-Type": "application/json"})
+        start_time = time.perf_counter()
+        urllib.request.urlopen(request, timeout=STEP_TIMEOUT).close()
+
+        deadline = start_time + STEP_TIMEOUT
+        while True:
+            try:
+                reply_time, message = replies.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                raise TimeoutError(f"No reply to {step!r}")
+            if any(text in message["text"] for text in expected):
+                self.last = message
+                return reply_time - start_time
+
+    def run(self, script):
+        """Runs the steps of script until one fails, :return: (step number, latency or the exception) of each"""
+        results = []
+        for number, (step, expected) in enumerate(script):
+            try:
+                results.append((number, self.send(step, expected)))
+            except Exception as e:
+                results.append((number, e))
+                break  # The rest of the conversation would not make sense
+        return results
+
+
+def run_load(webhook_url, fake, scripts=tuple(SCRIPTS), conversations=100, concurrency=10):
+    """
+    Runs conversations conversations, going through scripts in turn, with concurrency of them at once, each from its
+    own chat
+    :return: report as returned by get_report
+    """
+    chat_ids = itertools.count(1000)
+
+    def run(name):
+        return name, Conversation(webhook_url, fake, next(chat_ids)).run(SCRIPTS[name])
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(run, itertools.islice(itertools.cycle(scripts), conversations)))
+    return get_report(results, time.perf_counter() - start_time, fake.calls)
+
+
+def get_report(results, elapsed, calls):
+    """Throughput, reply latency percentiles and errors of the results of run_load, overall and per script"""
+    latencies = defaultdict(list)
+    errors = Counter()
+    completed = 0
+    for name, steps in results:
+        for number, outcome in steps:
+            if isinstance(outcome, Exception):
+                errors[f"{name} step {number + 1}: {type(outcome).__name__}"] += 1
+            else:
+                latencies[name].append(outcome)
+        completed += all(not isinstance(outcome, Exception) for _, outcome in steps)
+
+    def get_percentiles(values):
+        if not values:
+            return {}
+        p50, p95, p99 = np.percentile(values, [50, 95, 99]).tolist()
+        return {"count": len(values), "p50": p50, "p95": p95, "p99": p99, "max": max(values)}
+
+    steps = sum(len(values) for values in latencies.values())
+    return {"elapsed": elapsed, "conversations": len(results), "completed": completed,
+            "steps_per_second": steps / elapsed if elapsed else 0.0,
+            "conversations_per_second": completed / elapsed if elapsed else 0.0,
+            "latency": get_percentiles([x for values in latencies.values() for x in values]),
+            "scripts": {name: get_percentiles(values) for name, values in sorted(latencies.items())},
+            "errors": dict(errors), "api_calls": dict(calls)}
+
+
+def format_report(report):
+    """Text of a report as returned by get_report"""
+    lines = [f"{report['completed']}/{report['conversations']} conversations completed in {report['elapsed']:.1f}s, "
+             f"{report['conversations_per_second']:.1f} conversations/s, {report['steps_per_second']:.1f} replies/s"]
+
+    for name, latency in [("all", report["latency"])] + list(report["scripts"].items()):
+        if latency:
+            lines.append(f"{name:<12} p50 {latency['p50'] * 1000:7.1f}ms  p95 {latency['p95'] * 1000:7.1f}ms  "
+                         f"p99 {latency['p99'] * 1000:7.1f}ms  max {latency['max'] * 1000:7.1f}ms  "
+                         f"({latency['count']} replies)")
+
+    lines.append(f"Errors: {sum(report['errors'].values())}")
+    lines += [f"  {error}: {count}" for error, count in sorted(report["errors"].items())]
+    lines.append("API calls: " + ", ".join(f"{method} {count}" for method, count in sorted(report["api_calls"].items())))
+    return "\n".join(lines)
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout):
+    """Waits until something listens on port of localhost, raises TimeoutError if nothing does in time"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Nothing is listening on port {port}")
+
+
+def start_bot(fake, port, env=None):
+    """
+    Starts pathprofile_bot in a new process against fake, with its webhook on port and no rate limit
+    :return: the process, once its webhook is up
+    """
+    env = {**os.environ, "PATHPROFILE_TOKEN": TOKEN, "PORT": str(port), "PATHPROFILE_API_URL": fake.url,
+           "PATHPROFILE_METRICS_PORT": "0", "PATHPROFILE_RATE": "1000", "PATHPROFILE_BURST": "1000",
+           **(env or {})}
+    env.pop("TELEGRAM_ID", None)  # No digests to the owner
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    process = subprocess.Popen([sys.executable, path, "bot"], env=env, stdout=subprocess.DEVNULL)
+    try:
+        if not fake.webhook.wait(STEP_TIMEOUT):
+            raise TimeoutError("The bot did not set its webhook")
+        wait_for_port(port, STEP_TIMEOUT)
+    except Exception:
+        stop_bot(process)
+        raise
+    return process
+
+
+def stop_bot(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_loadtest(conversations=100, concurrency=10, scripts=tuple(SCRIPTS), output=None, webhook_url=None,
+                 api_port=0, async_mode=False):
+    """
+    Starts a FakeTelegram and the bot against it (unless webhook_url is given, for a bot already running with
+    PATHPROFILE_API_URL pointing at the FakeTelegram on api_port), runs the load and prints the report
+    :param async_mode: start the bot with PATHPROFILE_ASYNC=1, serving the webhook with aiobot
+    :return: the report
+    """
+    fake = FakeTelegram(api_port)
+    fake.start()
+    process = None
+    try:
+        if not webhook_url:
+            port = get_free_port()
+            process = start_bot(fake, port, {"PATHPROFILE_ASYNC": "1" if async_mode else "0"})
+            webhook_url = f"http://127.0.0.1:{port}/{TOKEN}"
+        report = run_load(webhook_url, fake, scripts, conversations, concurrency)
+    finally:
+        if process:
+            stop_bot(process)
+        fake.shutdown()
+
+    print(format_report(report))
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
@@ -1,4 +1,11 @@
-from math import log10, atan, pi
+import argparse
+import sys
+from math import atan, pi
+
+import numpy as np
+
+from linkbudget import CASE_MESSAGES, FM_THRESHOLD, evaluate_link
+from terrain import open_grid
 
 
 def checker(question, check):
@@ -48,6 +55,13 @@ def check_freq(radio, freq):
     return True
 
 
+def get_channels(radio):
+    """Every valid frequency (MHz) of the radio, in the same 0.250 steps as check_freq"""
+    if radio == 406:
+        return np.arange(61000, 96025, 25) / 100
+    return np.arange(135000, 269025, 25) / 100
+
+
 def check_mgr(mgr):
     """Checks that MGR inputted is valid"""
     mgr = mgr.split()
@@ -96,6 +110,28 @@ def get_azimuth(mgr1, mgr2):
         return 4800 + angle
 
 
+def get_distances(mgr1, mgr2):
+    """get_distance for arrays of mgrs of shape (..., 2), broadcast against each other"""
+    mgr1 = np.asarray(mgr1, dtype=float)
+    mgr2 = np.asarray(mgr2, dtype=float)
+    return ((mgr1[..., 0] - mgr2[..., 0]) ** 2 + (mgr1[..., 1] - mgr2[..., 1]) ** 2) ** 0.5
+
+
+def get_azimuths(mgr1, mgr2):
+    """get_azimuth for arrays of mgrs of shape (..., 2), broadcast against each other"""
+    mgr1 = np.asarray(mgr1, dtype=float)
+    mgr2 = np.asarray(mgr2, dtype=float)
+    h = mgr2[..., 0] - mgr1[..., 0]
+    v = mgr2[..., 1] - mgr1[..., 1]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        angle = np.abs(np.arctan(v / h)) / pi * 3200  # Must convert from radians to mils
+
+    return np.where(h == 0, np.where(v >= 0, 0., 3200.),  # North or South
+                    np.where(h > 0, np.where(v >= 0, 1600 - angle, 1600 + angle),  # First or second quadrant
+                             np.where(v < 0, 4800 - angle, 4800 + angle)))  # Third or fourth quadrant
+
+
 def calculate_effective_obstacle(obj1, obj2, distance):
     """Calculate the effective height and distance of the imaginary obstacle created by 2 different obstacles in path"""
     grad1 = obj1[1]/obj1[0]
@@ -114,14 +150,31 @@ def pathprofile():
     # Step 1: collect all the parameters for the formulas
     radio = int(checker('Radio type (406/408): ', lambda r: r in ['406', '408']))
     freq = float(checker('Transmitting frequency: ', lambda f: check_freq(radio, f)))
-    distance = float(checker('Total distance between the nodes (km): ', check_float))
+    grid = open_grid()  # If an elevation grid is configured, the obstacles come from the terrain between the MGRs
+
+    if grid:
+        mgr1, mgr2 = get_mgr()
+        distance = get_distance(mgr1, mgr2)
+        print(f"Distance: {distance:.2f}km")
+    else:
+        distance = float(checker('Total distance between the nodes (km): ', check_float))
+
     ht = float(checker('Height of transmitting node (m): ', check_float))
     hr = float(checker('Height of receiving node (m): ', check_float))
 
-    number_of_obstacles = int(checker('\nNumber of obstacles between the two nodes: ', check_int))
-
     obstacles = []
-    largest_obstacle = (0.0, 0.0)
+    number_of_obstacles = 0
+
+    if grid:
+        try:
+            obstacles = grid.profile(mgr1, mgr2)
+            print(f"\n{len(obstacles)} obstacles found in the terrain profile")
+        except ValueError as e:
+            print(f"\n{e}")
+            grid = None
+
+    if not grid:
+        number_of_obstacles = int(checker('\nNumber of obstacles between the two nodes: ', check_int))
 
     for i in range(1, number_of_obstacles+1):
         d = float(checker('\nDistance between obstacle ' + str(i) + ' and transmitting node (km): ',
@@ -129,78 +182,20 @@ def pathprofile():
         h = float(checker('Height of obstacle ' + str(i) + ' (m): ', check_float))
         obstacles.append((d, h))
 
-        if h > largest_obstacle[1]:
-            largest_obstacle = obstacles[-1]
+    # Steps 2 to 9: calculate the link budget
+    result = evaluate_link(distance, freq, ht, hr, radio, obstacles)
 
-    # Step 2: calculate height and distance of final obstacle
-    for i in range(len(obstacles)):
-        for x in range(i+1, len(obstacles)):
-            obj = calculate_effective_obstacle(obstacles[i], obstacles[x], distance)
-            if obj[1] > largest_obstacle[1]:
-                largest_obstacle = obj
+    print("\nThe final calculated obstacle is " + str(result.d1) +
+          "km away from the transmitting node, with a height of " + str(result.h) + "m")
+    print("The height of the LOS over the obstacle is " + str(result.los) + "m")
+    print("0.6 of the first fresnel zone radius is " + str(result.radius) + "m")
+    print(CASE_MESSAGES[result.case])
 
-    d1 = largest_obstacle[0]
-    d2 = distance - d1
-    h = largest_obstacle[1]
+    print("\nEPL =",  result.epl)
+    print("APL =",  result.apl)
+    print("FM =", result.fm)
 
-    # Step 3: adjust height of final obstacles for earth curvature correction
-    height_correction = d1 * d2 / 12.75 / 0.7
-    h += height_correction
-
-    print("\nThe final calculated obstacle is " + str(d1) +
-          "km away from the transmitting node, with a height of " + str(h) + "m")
-
-    # Step 4: calculate height of LOS over the obstacle
-    if hr > ht:
-        los = (hr - ht) * d1 / distance + ht
-    elif ht > hr:
-        los = (ht - hr) * d2 / distance + hr
-    else:
-        los = ht
-
-    print("The height of the LOS over the obstacle is " + str(los) + "m")
-
-    # Step 5: calculate height of 0.6 first fresnel zone
-    radius = 0.6 * 548 * (d1 * d2 / freq / distance) ** 0.5
-    ffz_height = los - radius
-
-    print("0.6 of the first fresnel zone radius is " + str(radius) + "m")
-
-    # Step 6: find the relevant case and calculate EPL
-    fsl = 20 * log10(41.87 * freq * distance)
-    pel = 115.11 + 40 * log10(distance) - 20 * log10(ht * hr)
-
-    if h < ffz_height:  # case 1/2 no obstruction within 0.6 of the first fresnel zone
-        epl = fsl
-        print("Since the obstacle is not within 0.6 of the first fresnel zone, EPL = FSL")
-    elif h > los:  # case 4
-        if fsl > pel:
-            sl_fs = 19.22 * log10(h) - 9.5 * log10(d1) + 10 * log10(freq) - 41.84
-            epl = fsl + sl_fs
-            print("Since the obstacle blocks the LOS, EPL = FSL + SL")
-        else:
-            sl_pe = 20.3 * log10(h) - 20 * log10(d1) + 10 * log10(freq) - 40
-            epl = pel + sl_pe
-            print("Since the obstacle blocks the LOS, EPL = PEL + SL")
-    else:  # case 3
-        epl = pel
-        print("Since the obstacle is within 0.6 of the first fresnel zone but does not block the LOS, EPL = PEL")
-
-    print("\nEPL =",  epl)
-
-    # Step 7: calculate APL, we assume receiver sensitivity using 2048MBps
-    if radio == 408:
-        apl = 36. + 2 * 20 - 2 * 2.4 - (-82)
-    else:
-        apl = 40. + 2 * 15 - 2 * 9 - (-82)
-    print("APL =",  apl)
-
-    # Step 8: calculate FM
-    fm = apl - epl
-    print("FM =", fm)
-
-    # Step 9: conclude if comms is through
-    if fm > 20:
+    if result.comms:
         print("\nComms through!!!")
     else:
         print("\nNo comms :(")
@@ -224,5 +219,194 @@ def main():
         print()
 
 
+def add_radio_arguments(parser, freq=True):
+    """Adds --radio and --freq to parser, the frequency is checked with check_freq"""
+    parser.add_argument("--radio", type=int, choices=[406, 408], required=True, help="radio type")
+    if freq:
+        parser.add_argument("--freq", type=float, required=True, help="transmitting frequency (MHz)")
+
+
+def mgr_argument(text):
+    """argparse type for an MGR such as "100 100", converted to km like get_mgr"""
+    if not check_mgr(text):
+        raise argparse.ArgumentTypeError(f"invalid MGR {text!r}")
+    return list(map(lambda x: float(x)/10, text.split()))
+
+
+def get_parser():
+    """Parser for the non-interactive commands, running main.py without a command starts the interactive menu"""
+    parser = argparse.ArgumentParser(description="Path profile, distance and azimuth between MGRs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    batch = commands.add_parser("batch", help="calculate the path profile of every link in a CSV or JSONL file")
+    batch.add_argument("input", help="CSV or JSONL file of links with mgr1, mgr2, radio, freq, ht, hr and obstacles, "
+                                     "- for stdin")
+    batch.add_argument("-o", "--output", help="CSV or JSONL file to write the results to, stdout by default")
+    batch.add_argument("--workers", type=int, default=1, help="number of processes to calculate with")
+    batch.add_argument("--format", choices=["csv", "jsonl"], help="format of the input, guessed from the extension "
+                                                                  "by default")
+    batch.add_argument("--method", choices=["dominant", "deygout"], default="dominant",
+                       help="single effective obstacle (dominant) or diffraction over every obstacle (deygout)")
+
+    matrix = commands.add_parser("matrix", help="distance, azimuth and FM between every pair of stations in a list")
+    matrix.add_argument("input", help="CSV or JSONL file of stations with name, mgr and height")
+    matrix.add_argument("output", help="directory to write distance.npy, azimuth.npy, fm.npy and stations.csv to")
+    add_radio_arguments(matrix)
+
+    route = commands.add_parser("route", help="relay chain with the best worst hop FM between 2 stations of a list")
+    route.add_argument("input", help="CSV or JSONL file of stations with name, mgr and height")
+    route.add_argument("source", help="name of the first station")
+    route.add_argument("target", help="name of the last station")
+    add_radio_arguments(route)
+    route.add_argument("--min-fm", type=float, default=FM_THRESHOLD, help="lowest FM of a usable hop (dB)")
+
+    track = commands.add_parser("track", help="follow a moving node against fixed stations and print where comms to "
+                                              "them change")
+    track.add_argument("stations", help="CSV or JSONL file of stations with name, mgr and height")
+    track.add_argument("input", help="CSV or JSONL file of positions with time and mgr, - for stdin")
+    add_radio_arguments(track)
+    track.add_argument("--height", type=float, required=True, help="height of the moving node (m)")
+    track.add_argument("--hysteresis", type=float, default=0, help="FM (dB) past the threshold before comms change")
+    track.add_argument("-o", "--output", help="JSONL file to write the events to, stdout by default")
+    track.add_argument("--format", choices=["csv", "jsonl"], help="format of the input, guessed from the extension "
+                                                                  "by default")
+
+    reach = commands.add_parser("reach", help="stations of a list that can reach an MGR, best FM first")
+    reach.add_argument("input", help="CSV or JSONL file of stations with name, mgr, height, radio and freq")
+    reach.add_argument("mgr", type=mgr_argument, help="MGR to reach, e.g. \"100 100\"")
+    reach.add_argument("--radio", type=int, choices=[406, 408], help="radio of the stations without one")
+    reach.add_argument("--freq", type=float, help="frequency of the stations without one (MHz)")
+    reach.add_argument("--height", type=float, default=2, help="height of the node at the MGR (m)")
+    reach.add_argument("--nearest", type=int, metavar="K", help="show the K nearest stations instead")
+    reach.add_argument("--within", type=float, metavar="KM", help="show the stations within KM instead")
+
+    sweep = commands.add_parser("sweep", help="FM of a link on every channel of the radio, best channel first")
+    add_radio_arguments(sweep, freq=False)
+    sweep.add_argument("--distance", type=float, required=True, help="total distance between the nodes (km)")
+    sweep.add_argument("--ht", type=float, required=True, help="height of transmitting node (m)")
+    sweep.add_argument("--hr", type=float, required=True, help="height of receiving node (m)")
+    sweep.add_argument("--obstacles", default="", help="distance (km) and height (m) of each obstacle, e.g. "
+                                                       "\"5 30;10 50\"")
+    sweep.add_argument("--top", type=int, default=10, help="number of channels to show")
+
+    relay = commands.add_parser("relay", help="best sites for a relay between 2 MGRs, using the elevation grid in "
+                                              "$PATHPROFILE_DEM if there is one")
+    add_radio_arguments(relay)
+    relay.add_argument("--mgr1", type=mgr_argument, required=True, help="MGR of the transmitting node, e.g. \"100 100\"")
+    relay.add_argument("--mgr2", type=mgr_argument, required=True, help="MGR of the receiving node")
+    relay.add_argument("--box", type=mgr_argument, nargs=2, metavar="MGR",
+                       help="MGRs of 2 opposite corners of the area to search, around both nodes by default")
+    relay.add_argument("--step", type=int, default=1, help="spacing of the candidate sites in MGR units (100m)")
+    relay.add_argument("--ht", type=float, required=True, help="height of transmitting node (m)")
+    relay.add_argument("--hr", type=float, required=True, help="height of receiving node (m)")
+    relay.add_argument("--relay-height", type=float, required=True, help="height of the relay (m)")
+    relay.add_argument("--top", type=int, default=10, help="number of sites to show")
+    relay.add_argument("--workers", type=int, default=1, help="number of processes to search with")
+    relay.add_argument("--no-prune", dest="prune", action="store_false",
+                       help="evaluate every candidate site with the terrain")
+
+    coverage = commands.add_parser("coverage", help="FM from one transmitter to every cell of an area, using the "
+                                                    "elevation grid in $PATHPROFILE_DEM if there is one")
+    add_radio_arguments(coverage)
+    coverage.add_argument("--mgr", type=mgr_argument, required=True, help="MGR of the transmitter, e.g. \"100 100\"")
+    coverage.add_argument("--box", type=mgr_argument, nargs=2, metavar="MGR", required=True,
+                          help="MGRs of 2 opposite corners of the area")
+    coverage.add_argument("--step", type=int, default=1, help="size of the cells in MGR units (100m)")
+    coverage.add_argument("--ht", type=float, required=True, help="height of the transmitter (m)")
+    coverage.add_argument("--hr", type=float, required=True, help="height of the receivers (m)")
+    coverage.add_argument("-o", "--output", help=".npz file to write the FM raster to")
+    coverage.add_argument("--image", help=".png or .pgm file to draw the FM raster to")
+    coverage.add_argument("--workers", type=int, default=1, help="number of processes to calculate with")
+
+    loadtest = commands.add_parser("loadtest", help="drive the telegram bot with scripted conversations through a "
+                                                    "fake telegram API and report its reply latency")
+    loadtest.add_argument("--conversations", type=int, default=100, help="number of conversations to run")
+    loadtest.add_argument("--concurrency", type=int, default=10, help="number of conversations at once")
+    loadtest.add_argument("--script", dest="scripts", action="append", choices=["distance", "azimuth", "pathprofile"],
+                          help="conversation to run, can be repeated, all of them by default")
+    loadtest.add_argument("-o", "--output", help="JSON file to write the report to")
+    loadtest.add_argument("--webhook-url", help="webhook of a bot already running with PATHPROFILE_API_URL set to "
+                                                "http://127.0.0.1:API_PORT/bot, instead of starting one")
+    loadtest.add_argument("--api-port", type=int, default=0, help="port of the fake telegram API")
+    loadtest.add_argument("--async", dest="async_mode", action="store_true", help="start the bot with its asyncio "
+                                                                                 "webhook server (aiobot)")
+
+    commands.add_parser("bot", help="serve the telegram bot, with aiobot if PATHPROFILE_ASYNC=1")
+
+    bench = commands.add_parser("bench", help="time the geometry and link budget hot paths")
+    bench.add_argument("-o", "--output", help="JSON file to write the results to")
+    bench.add_argument("--baseline", help="JSON file of earlier results to flag regressions against")
+    bench.add_argument("--threshold", type=float, default=0.2, help="slowdown against the baseline flagged as a "
+                                                                    "regression, 0.2 by default")
+    bench.add_argument("--filter", default="*", help="glob of the benchmarks to run, e.g. \"effective_obstacle*\"")
+    bench.add_argument("--repeat", type=int, default=5, help="number of rounds to take the best time of")
+
+    return parser
+
+
+def run_command(argv):
+    """Runs one of the non-interactive commands"""
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    if "freq" in args and args.freq is not None and not check_freq(args.radio, args.freq):
+        parser.error(f"invalid frequency {args.freq} for radio {args.radio}")
+
+    if args.command == "batch":
+        from batch import run_batch
+        run_batch(args.input, args.output, workers=args.workers, input_format=args.format, method=args.method)
+    elif args.command == "matrix":
+        from stations import run_matrix
+        run_matrix(args.input, args.output, args.radio, args.freq)
+    elif args.command == "route":
+        from network import run_route
+        run_route(args.input, args.source, args.target, args.radio, args.freq, args.min_fm)
+    elif args.command == "track":
+        from track import run_track
+        run_track(args.input, args.stations, args.radio, args.freq, args.height, args.hysteresis, args.output,
+                  args.format)
+    elif args.command == "reach":
+        from registry import get_neighbours_message, open_registry
+        registry = open_registry(args.input, args.radio, args.freq)
+        if args.nearest:
+            print(get_neighbours_message(registry.nearest(args.mgr, args.nearest)))
+        elif args.within is not None:
+            print(get_neighbours_message(registry.within(args.mgr, args.within)))
+        else:
+            print(get_neighbours_message(registry.reachable(args.mgr, args.height)))
+    elif args.command == "sweep":
+        from batch import parse_obstacles
+        from sweep import run_sweep
+        run_sweep(args.radio, args.distance, args.ht, args.hr, parse_obstacles(args.obstacles), args.top)
+    elif args.command == "relay":
+        from relay import find_relays, get_relay_message, get_search_box
+        box = args.box[0] + args.box[1] if args.box else get_search_box(args.mgr1, args.mgr2)
+        relays = find_relays(args.mgr1, args.mgr2, box, args.radio, args.freq, args.ht, args.hr, args.relay_height,
+                             step=args.step / 10, top=args.top, grid=open_grid(), workers=args.workers,
+                             prune=args.prune)
+        print(get_relay_message(relays))
+    elif args.command == "coverage":
+        from heatmap import run_coverage
+        run_coverage(args.mgr, args.box[0] + args.box[1], args.step / 10, args.radio, args.freq, args.ht, args.hr,
+                     args.output, args.image, args.workers)
+    elif args.command == "loadtest":
+        from loadtest import SCRIPTS, run_loadtest
+        run_loadtest(args.conversations, args.concurrency, args.scripts or tuple(SCRIPTS), args.output,
+                     args.webhook_url, args.api_port, args.async_mode)
+    elif args.command == "bot":
+        # Imported here, as the offload workers of the bot import this module again and must not set up the bot
+        from pathprofile_bot import ASYNC, main as run_bot
+        if ASYNC:
+            from aiobot import run as run_bot
+        run_bot()
+    elif args.command == "bench":
+        from benchmark import run_bench
+        if not run_bench(args.output, args.baseline, args.threshold, args.filter, args.repeat):
+            sys.exit(1)
+
+
 if __name__ == '__main__':
-    main()
+    if len(sys.argv) > 1:
+        run_command(sys.argv[1:])
+    else:
+        main()
@@ -0,0 +1,144 @@
+import bisect
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Upper bounds of the latency buckets (s)
+
+
+class Histogram:
+    """Counts of the values observed in each bucket, like a prometheus histogram"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is everything above the last bound
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate of the q quantile, interpolating linearly within its bucket. None if nothing has been observed"""
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if i == len(self.buckets):  # Above the last bound, the best we can say is the last bound
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def summary(self):
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else None,
+                "p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99)}
+
+
+class Metrics:
+    """Latency of the handlers and of the calls to the telegram API, and the states the handlers moved to"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.start_time = clock()
+        self.lock = threading.Lock()
+        self.handlers = {}  # name: Histogram
+        self.api = {}  # telegram API method: Histogram
+        self.transitions = Counter()  # (handler, state it returned): count
+
+    def observe_handler(self, name, seconds, state=None):
+        """Records a handler taking seconds and returning state, which is "error" if it raised"""
+        with self.lock:
+            self.handlers.setdefault(name, Histogram()).observe(seconds)
+            self.transitions[name, str(state)] += 1
+
+    def observe_api(self, method, seconds):
+        with self.lock:
+            self.api.setdefault(method, Histogram()).observe(seconds)
+
+    def snapshot(self):
+        """Summaries of every histogram, with the rate of calls per second since the metrics started"""
+        with self.lock:
+            uptime = self.clock() - self.start_time
+
+            def summaries(histograms):
+                return {name: dict(histogram.summary(), rate=histogram.count / uptime if uptime else 0.0)
+                        for name, histogram in sorted(histograms.items())}
+
+            return {"uptime": uptime, "handlers": summaries(self.handlers), "api": summaries(self.api),
+                    "transitions": [{"handler": handler, "state": state, "count": count}
+                                    for (handler, state), count in sorted(self.transitions.items())]}
+
+    def to_prometheus(self):
+        """Metrics in the prometheus text format"""
+        with self.lock:
+            lines = [f"pathprofile_uptime_seconds {self.clock() - self.start_time}"]
+            for metric, label, histograms in [("pathprofile_handler_seconds", "handler", self.handlers),
+                                              ("pathprofile_api_seconds", "method", self.api)]:
+                lines.append(f"# TYPE {metric} histogram")
+                for name, histogram in sorted(histograms.items()):
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.sum}')
+                    lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+
+            lines.append("# TYPE pathprofile_transitions_total counter")
+            for (handler, state), count in sorted(self.transitions.items()):
+                lines.append(f'pathprofile_transitions_total{{handler="{handler}",state="{state}"}} {count}')
+            return "\n".join(lines) + "\n"
+
+
+def serve(metrics, port, host="127.0.0.1"):
+    """
+    Serves /metrics in the prometheus text format and /metrics.json as a snapshot from a daemon thread
+    :return: the server, shut it down with server.shutdown()
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = metrics.to_prometheus(), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body, content_type = json.dumps(metrics.snapshot()), "application/json"
+            else:
+                self.send_error(404)
+                return
+
+            body = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):  # Scrapes are not worth printing
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+def get_stats_message(snapshot):
+    """Text of the latency and rate of every handler and telegram API method"""
+    def lines(summaries):
+        text = ""
+        for name, summary in summaries.items():
+            text += f"{name}: {summary['count']} ({summary['rate'] * 60:.1f}/min), " \
+                    f"mean {summary['mean'] * 1000:.0f}ms, p50 {summary['p50'] * 1000:.0f}ms, " \
+                    f"p95 {summary['p95'] * 1000:.0f}ms\n"
+        return text or "None\n"
+
+    return f"Uptime: {snapshot['uptime'] / 3600:.1f}h\n\n" \
+           f"Handlers\n{lines(snapshot['handlers'])}\n" \
+           f"Telegram API\n{lines(snapshot['api'])}"
@@ -0,0 +1,184 @@
+import heapq
+import math
+from collections import namedtuple
+
+import numpy as np
+
+from linkbudget import FM_THRESHOLD, link_budget
+from main import get_distances
+from stations import read_stations
+
+# Chain of stations from the first to the last, with the FM of each hop and the worst of them
+Route = namedtuple("Route", ["stations", "fm", "hops"])
+
+
+def get_max_range(radio, freq, min_fm=FM_THRESHOLD):
+    """
+    Longest link without obstacles that has at least min_fm (km). Without obstacles the FM only falls with distance,
+    so the range is the first of a fine logarithmic grid of distances that falls short, which errs on the long side.
+    """
+    distances = np.geomspace(1e-3, 1e4, 4001)
+    short = np.flatnonzero(link_budget(distances, freq, 1, 1, radio).fm < min_fm)
+    return distances[short[0]].item() if len(short) else distances[-1].item()
+
+
+class Network:
+    """
+    Stations and the links between them with at least min_fm, without obstacles, for finding the relay chain with the
+    best worst hop between 2 stations. Stations are kept in buckets of a grid max_range wide, so a station is only
+    evaluated against the stations in the 9 buckets around it instead of every other station, and adding, moving or
+    removing a station only updates its own links.
+    The widest paths from each source are cached until a change could affect them.
+    """
+
+    def __init__(self, radio, freq, min_fm=FM_THRESHOLD, max_range=None):
+        self.radio = radio
+        self.freq = freq
+        self.min_fm = min_fm
+        self.max_range = max_range or get_max_range(radio, freq, min_fm)
+
+        self.stations = {}  # name: (mgr, height)
+        self.buckets = {}  # (column, row): names of the stations in the bucket
+        self.links = {}  # name: {name of the other station: FM}
+        self.trees = {}  # source: (best, parents) as returned by widest_paths
+
+        self.evaluated = 0  # Pairs of stations the link budget was calculated for
+
+    def get_bucket(self, mgr):
+        return math.floor(mgr[0] / self.max_range), math.floor(mgr[1] / self.max_range)
+
+    def get_neighbours(self, mgr):
+        """Names of the stations in the 9 buckets around mgr, a superset of the stations within max_range"""
+        column, row = self.get_bucket(mgr)
+        return [name for i in (-1, 0, 1) for j in (-1, 0, 1) for name in self.buckets.get((column + i, row + j), ())]
+
+    def add(self, name, mgr, height):
+        """Adds a station, or moves it if there is already one with the same name"""
+        if name in self.stations:
+            self.remove(name)
+        self.trees.clear()  # A new station can make any route better
+
+        mgr = (float(mgr[0]), float(mgr[1]))
+        neighbours = self.get_neighbours(mgr)
+        self.stations[name] = (mgr, float(height))
+        self.buckets.setdefault(self.get_bucket(mgr), []).append(name)
+        self.links[name] = {}
+        if not neighbours:
+            return
+
+        # Step 1: keep the neighbours within range
+        others = np.array([self.stations[other][0] for other in neighbours])
+        distance = get_distances(mgr, others)
+        near = np.flatnonzero((distance <= self.max_range) & (distance > 0))
+        if not len(near):
+            return
+
+        # Step 2: calculate the link budget to each of them at once
+        heights = np.array([self.stations[neighbours[i]][1] for i in near])
+        fm = link_budget(distance[near], self.freq, height, heights, self.radio).fm
+        self.evaluated += len(near)
+
+        for i, value in zip(near, fm.tolist()):
+            if value >= self.min_fm:
+                self.links[name][neighbours[i]] = value
+                self.links[neighbours[i]][name] = value
+
+    def add_stations(self, names, mgrs, heights):
+        """Adds many stations, e.g. as returned by stations.read_stations"""
+        for name, mgr, height in zip(names, mgrs, heights):
+            self.add(name, mgr, height)
+
+    def move(self, name, mgr, height=None):
+        """Moves a station, keeping its height unless a new one is given"""
+        self.add(name, mgr, self.stations[name][1] if height is None else height)
+
+    def remove(self, name):
+        """Removes a station, e.g. when it goes down. Only the cached routes through it are dropped"""
+        mgr, _ = self.stations.pop(name)
+        bucket = self.get_bucket(mgr)
+        self.buckets[bucket].remove(name)
+        if not self.buckets[bucket]:
+            del self.buckets[bucket]
+
+        for other in self.links.pop(name):
+            del self.links[other][name]
+
+        self.trees.pop(name, None)
+        for source, (best, parents) in list(self.trees.items()):
+            if name in parents.values():
+                del self.trees[source]
+            else:
+                best.pop(name, None)
+                parents.pop(name, None)
+
+    def widest_paths(self, source):
+        """
+        Dijkstra's algorithm with the worst hop FM of a path as its length, higher being better, and the path with
+        fewer hops taken between equally good ones as they are found. Cached until a change could affect it.
+        :return: best, {station: worst hop FM of the best path to it}, and parents, {station: previous station on it}
+        """
+        if source in self.trees:
+            return self.trees[source]
+
+        best = {source: math.inf}
+        hops = {source: 0}
+        parents = {}
+        done = set()
+        heap = [(-math.inf, 0, source)]
+        while heap:
+            fm, count, name = heapq.heappop(heap)
+            if name in done:
+                continue
+            done.add(name)
+            for other, link in self.links[name].items():
+                worst = min(-fm, link)
+                if other not in done and (other not in best or (worst, -count - 1) > (best[other], -hops[other])):
+                    best[other] = worst
+                    hops[other] = count + 1
+                    parents[other] = name
+                    heapq.heappush(heap, (-worst, count + 1, other))
+
+        self.trees[source] = best, parents
+        return best, parents
+
+    def route(self, source, target):
+        """
+        Relay chain between 2 stations with the best worst hop FM
+        :return: Route, or None if there is no chain of links with at least min_fm between them
+        """
+        if source not in self.stations or target not in self.stations:
+            raise KeyError(f"Unknown station {source if source not in self.stations else target}")
+        if source == target:
+            return Route([source], math.inf, [])
+
+        best, parents = self.widest_paths(source)
+        if target not in best:
+            return None
+
+        stations = [target]
+        while stations[-1] != source:
+            stations.append(parents[stations[-1]])
+        stations.reverse()
+        return Route(stations, best[target], [self.links[a][b] for a, b in zip(stations, stations[1:])])
+
+    def stats(self):
+        return {"stations": len(self.stations), "links": sum(len(links) for links in self.links.values()) // 2,
+                "evaluated": self.evaluated, "cached": len(self.trees)}
+
+
+def get_route_message(route):
+    """Text of a relay chain, hop by hop"""
+    if route is None:
+        return "No route found :("
+
+    message = f"Route through {max(len(route.hops) - 1, 0)} relays, worst FM = {route.fm:.1f}dB\n"
+    for i, fm in enumerate(route.hops):
+        message += f"{i + 1}. {route.stations[i]} -> {route.stations[i + 1]}, FM = {fm:.1f}dB\n"
+    return message
+
+
+def run_route(input_path, source, target, radio, freq, min_fm=FM_THRESHOLD):
+    """Reads a station list and prints the best relay chain between 2 of its stations"""
+    network = Network(radio, freq, min_fm)
+    network.add_stations(*read_stations(input_path))
+    print(get_route_message(network.route(source, target)))
@@ -0,0 +1,103 @@
+import queue
+import threading
+import time
+
+MAX_LENGTH = 4096  # Longest message telegram accepts
+
+
+class Notifier:
+    """
+    Sends notifications from a background thread so that the caller never waits on the network. Notifications that
+    arrive within interval seconds of each other are sent together as one digest message, and when more than
+    max_queue are waiting, new ones are dropped and only counted in the next digest.
+    """
+
+    def __init__(self, max_queue=1000, interval=2.0, max_length=MAX_LENGTH):
+        self.queue = queue.Queue(max_queue)
+        self.interval = interval
+        self.max_length = max_length
+        self.send = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+        self.dropped = 0  # Dropped since the last digest
+        self.sent = 0
+        self.failed = 0
+
+    def start(self, send):
+        """Starts sending digests with send(text) in a daemon thread"""
+        self.send = send
+        self.thread = threading.Thread(target=self.run, name="notifier", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Sends whatever is queued and stops the thread"""
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+
+    def notify(self, message):
+        """Queues message without blocking, dropping it if the queue is full"""
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            messages = [self.queue.get()]
+            deadline = time.monotonic() + self.interval
+
+            # Wait a little for the rest of the burst so it goes out as one message
+            while None not in messages and (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    messages.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Anything that queued up while the last digest was being sent goes out now too
+            while not self.queue.empty():
+                messages.append(self.queue.get_nowait())
+
+            stopping = None in messages
+            messages = [message for message in messages if message is not None]
+
+            with self.lock:
+                dropped, self.dropped = self.dropped, 0
+
+            if messages or dropped:
+                self.send_digest(get_digest(messages, dropped, self.max_length))
+            if stopping:
+                return
+
+    def send_digest(self, text):
+        try:
+            self.send(text)
+            self.sent += 1
+        except Exception:  # The owner's chat being unreachable must not stop the notifications
+            self.failed += 1
+
+    def stats(self):
+        """Counters of the notifications"""
+        with self.lock:
+            return {"queued": self.queue.qsize(), "dropped": self.dropped, "sent": self.sent, "failed": self.failed}
+
+
+def get_digest(messages, dropped=0, max_length=MAX_LENGTH):
+    """Joins messages into one message of at most max_length characters, counting the ones that do not fit"""
+    text = ""
+    for i, message in enumerate(messages):
+        summary = f"\n... and {len(messages) - i + dropped} more"
+        line = ("\n" if text else "") + message
+
+        # Keep room for the summary unless this is the last message
+        room = max_length - (len(summary) if i < len(messages) - 1 or dropped else 0)
+        if len(text) + len(line) > room:
+            return (text + summary).lstrip("\n")[:max_length]
+        text += line
+
+    if dropped:
+        text = (text + f"\n... and {dropped} more").lstrip("\n")
+    return text
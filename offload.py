@@ -0,0 +1,130 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+
+class Busy(Exception):
+    """Raised when too many calculations are already waiting for the pool"""
+
+
+def run_and_report(function, args, report):
+    """Runs function(*args) in a worker, :return: its result, the worker's pid and report()"""
+    return function(*args), os.getpid(), report()
+
+
+class Offloader:
+    """
+    Runs calculations in a pool of worker processes, so the thread that submits them is free straight away. At most
+    max_pending calculations are waiting or running at once, and callers are told a calculation timed out after timeout
+    seconds. A calculation that times out keeps its worker until it is done, as it cannot be stopped without losing
+    the pool, and counts against max_pending until then.
+    With forkserver, the workers are forked from a server that has only imported the preload modules, and each worker
+    imports the module the program was started from again as __mp_main__, so it must not set up anything on import.
+    report is called in a worker after each calculation, and what it returns is kept per worker for reports, e.g. the
+    counters of a cache the workers keep.
+    """
+
+    def __init__(self, workers=2, max_pending=8, timeout=60.0, start_method="forkserver", preload=(), report=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.start_method = start_method  # Workers are not forked from the threads of the caller
+        self.preload = list(preload)
+        self.report = report
+        self.executor = None
+        self.lock = threading.Lock()
+        self.worker_reports = {}  # pid: what report returned after the last calculation of the worker
+
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    def start(self):
+        context = multiprocessing.get_context(self.start_method)
+        if self.start_method == "forkserver":
+            context.set_forkserver_preload(self.preload)
+        self.worker_reports = {}
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=context)
+
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def submit(self, function, args, callback, timeout=None):
+        """
+        Runs function(*args) in the pool and calls callback(result, error) once, from another thread, when it is done.
+        error is None if it succeeded, the exception it raised, or TimeoutError if it took longer than timeout
+        (by default self.timeout). function and args must be picklable. Raises Busy if max_pending are waiting, or
+        the error of the pool if it cannot take the calculation (e.g. BrokenProcessPool), and callback is not called.
+        """
+        with self.lock:
+            if self.executor is None:
+                raise RuntimeError("Offloader has not been started")
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise Busy()
+            self.pending += 1
+            self.submitted += 1
+
+        finished = []  # Whichever of the result and the timeout comes first is passed to callback
+
+        def finish(result, error):
+            with self.lock:
+                if finished:
+                    return
+                finished.append(True)
+                if isinstance(error, TimeoutError):
+                    self.timeouts += 1
+                elif error is not None:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+            callback(result, error)
+
+        timer = threading.Timer(self.timeout if timeout is None else timeout, finish, (None, TimeoutError()))
+        timer.daemon = True
+
+        def done(future):
+            timer.cancel()
+            with self.lock:
+                self.pending -= 1
+            if future.cancelled():
+                finish(None, TimeoutError())
+            elif future.exception() is not None:
+                finish(None, future.exception())
+            elif self.report:
+                result, pid, report = future.result()
+                with self.lock:
+                    self.worker_reports[pid] = report
+                finish(result, None)
+            else:
+                finish(future.result(), None)
+
+        try:
+            if self.report:
+                future = self.executor.submit(run_and_report, function, args, self.report)
+            else:
+                future = self.executor.submit(function, *args)
+        except BaseException:  # E.g. BrokenProcessPool, the calculation was never submitted
+            with self.lock:
+                self.pending -= 1
+                self.failed += 1
+            raise
+        timer.start()  # A timer cancelled by done before it starts never fires
+        future.add_done_callback(done)
+
+    def stats(self):
+        with self.lock:
+            return {"pending": self.pending, "max_pending": self.max_pending, "submitted": self.submitted,
+                    "completed": self.completed, "failed": self.failed, "timeouts": self.timeouts,
+                    "rejected": self.rejected}
+
+    def reports(self):
+        """What report returned after the last calculation of each worker that has run one"""
+        with self.lock:
+            return list(self.worker_reports.values())
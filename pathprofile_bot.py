@@ -1,24 +1,177 @@
 from telegram.ext import Updater, CommandHandler, ConversationHandler, CallbackQueryHandler, MessageHandler, Filters
-from telegram import ChatAction, InlineKeyboardMarkup, InlineKeyboardButton, Bot
-from telegram import ParseMode
+from telegram.ext import InlineQueryHandler, TypeHandler, DispatcherHandlerStop, BasePersistence
+from telegram import ChatAction, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import Bot, Update, ParseMode, InlineQueryResultArticle, InputTextMessageContent
+from telegram.utils.request import Request
+import numpy as np
 import os
-from math import log10
+import sys
+import threading
+import time
+from collections import namedtuple
 from functools import wraps
-from main import get_distance, get_azimuth, check_freq, calculate_effective_obstacle
+from main import get_distance, get_azimuth, check_float, check_freq, check_mgr
+from batch import parse_link
+from linkbudget import CASE_MESSAGES, evaluate_link, effective_obstacle, pad_obstacles
+from terrain import add_stats, open_grid
+from relay import get_search_box, get_step
+from cache import TTLCache
+from notifier import Notifier
+from sessions import ConversationStates, Session, open_store
+from commandlog import CommandLog, Record, get_logs_message, parse_logs_args
+from metrics import Metrics, get_stats_message, serve
+from offload import Busy, Offloader
+from ratelimit import Coalescer, RateLimiter
+from registry import get_neighbours_message, open_registry
+from tasks import grid_stats, profile_task, relay_task, sweep_task
 
 TOKEN = os.environ.get('PATHPROFILE_TOKEN')
 PORT = int(os.environ.get('PORT', 5000))
 OWNER = os.environ.get('TELEGRAM_ID', None)
+METRICS_PORT = int(os.environ.get('PATHPROFILE_METRICS_PORT', PORT + 1))  # 0 to not serve the metrics
+API_URL = os.environ.get('PATHPROFILE_API_URL')  # Bot API to use instead of telegram's, e.g. loadtest.FakeTelegram
+WEBHOOK_URL = os.environ.get('PATHPROFILE_WEBHOOK_URL', "https://pathprofile.herokuapp.com/")
+ASYNC = os.environ.get('PATHPROFILE_ASYNC') == "1"  # main.py bot serves the webhook with aiobot instead of the Updater
 
 VERSION = 1.8
 VERSION_INTRO = "Updates owner's chat when someone runs a command with quick link to username of user"
+RELAY_CANDIDATES = 10000  # Most relay sites searched by /relay
+REACH_HEIGHT = 2  # Height of the node at the MGR of /reach unless one is given (m)
+REACH_TOP = 10  # Most stations listed by /reach
 
-chats = {}
-logs = []
+# What a step of a conversation answers, whichever server sends it: the replies to send in order, the state to go to,
+# and the session whose obstacles are then taken from the terrain in the offload pool (see get_terrain_task) before
+# replying with its path profile, if any
+Step = namedtuple("Step", ["replies", "state", "terrain"], defaults=(None,))
+
+# Reply of a step, with buttons of options to pick from, or replacing the text of the message whose button was pressed
+Reply = namedtuple("Reply", ["text", "buttons", "edit"], defaults=(None, False))
+
+# Messages each step of the conversations takes
+MGRS_PATTERN = r"(\d+ \d+\n\d+ \d+)"
+FREQ_PATTERN = r"(\d+\.\d+)"
+HEIGHTS_PATTERN = r"(\d+) (\d+)"
+NUMBER_PATTERN = r"(\d+)"
+
+MGRS_PROMPT = "Please enter the two MGRs as such:\n100 100\n200 200"
+SESSION_EXPIRED = "Session expired, please start again with /pathprofile."
+
+# Who ran what command recently, also appended to PATHPROFILE_LOG if it is set
+logs = CommandLog(int(os.environ.get('PATHPROFILE_LOG_SIZE', 1000)), os.environ.get('PATHPROFILE_LOG'))
+# Runs /sweep, /relay and terrain profiles in worker processes, so that they do not hold up the dispatcher
+offloader = Offloader(int(os.environ.get('PATHPROFILE_WORKERS', 2)), int(os.environ.get('PATHPROFILE_MAX_PENDING', 8)),
+                      float(os.environ.get('PATHPROFILE_TIMEOUT', 60)), preload=["tasks"], report=grid_stats)
+
+# Requests each chat can make, PATHPROFILE_BURST at once then PATHPROFILE_RATE per second
+limiter = RateLimiter(float(os.environ.get('PATHPROFILE_RATE', 1)), int(os.environ.get('PATHPROFILE_BURST', 5)))
+
+# Identical offloaded calculations in flight at the same time are only run once
+coalescer = Coalescer()
+
+# Stations listed in PATHPROFILE_STATIONS for /reach, None if it is not set
+registry = open_registry()
+
+# Latency of the handlers and of the calls to telegram, served on METRICS_PORT and sent by /stats
+metrics = Metrics()
+
+handling = threading.local()  # Record of the command being handled in this thread, logged once the handler is done
+
+# Results of /pathprofile, /sweep, /relay and terrain profiles keyed on their normalised inputs, so that the same
+# links run over and over are not recalculated. Distances and azimuths are cheaper to calculate than to look up
+results = TTLCache(int(os.environ.get('PATHPROFILE_CACHE_SIZE', 1024)),
+                   float(os.environ.get('PATHPROFILE_CACHE_TTL', 3600)))
+
+# What each chat has entered in /pathprofile, kept in memory or in SQLite if PATHPROFILE_SESSIONS is set
+sessions = open_store()
+
+# Sends the owner a digest of the commands that were run, started by main
+notifier = Notifier()
+
+
+class TimedRequest(Request):
+    """Request that records how long every call to the telegram API takes in metrics"""
+
+    def post(self, url, data, timeout=None):
+        start_time = time.perf_counter()
+        try:
+            return super().post(url, data, timeout)
+        finally:
+            metrics.observe_api(url.rsplit("/", 1)[-1], time.perf_counter() - start_time)
+
+
+class StatePersistence(BasePersistence):
+    """
+    Keeps the states of the conversations in the session store with the sessions, so that with a SQLiteStore another
+    process serving the bot can take the next step of a conversation. Nothing else is persisted.
+    """
+
+    __slots__ = ("store",)
+
+    def __init__(self, store):
+        super().__init__(store_user_data=False, store_chat_data=False, store_bot_data=False)
+        self.store = store
+
+    def get_conversations(self, name):
+        return ConversationStates(self.store)
+
+    def update_conversation(self, name, key, new_state):
+        pass  # Already saved by ConversationStates
+
+    def get_user_data(self):
+        return {}
+
+    def get_chat_data(self):
+        return {}
+
+    def get_bot_data(self):
+        return {}
+
+    def update_user_data(self, user_id, data):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+
+def timed(func):
+    """Records how long func takes and the state it returns in metrics"""
+
+    @wraps(func)
+    def timed_func(*args, **kwargs):
+        state = "error"
+        start_time = time.perf_counter()
+        try:
+            state = func(*args, **kwargs)
+            return state
+        finally:
+            metrics.observe_handler(func.__name__, time.perf_counter() - start_time, state)
+
+    return timed_func
+
+
+def logged(func):
+    """Adds the command func logs with log to logs once func is done, with how long it took"""
+    func = timed(func)
+
+    @wraps(func)
+    def logged_func(update, context, *args, **kwargs):
+        handling.record = None
+        start_time = time.perf_counter()
+        try:
+            return func(update, context, *args, **kwargs)
+        finally:
+            if handling.record:
+                logs.add(handling.record._replace(latency=time.perf_counter() - start_time))
+
+    return logged_func
 
 
 def typing(func):
     """Sends typing action while processing func command."""
+    func = logged(func)
 
     @wraps(func)
     def command_func(update, context, *args, **kwargs):
@@ -28,6 +181,60 @@ def typing(func):
     return command_func
 
 
+def coalesced(func):
+    """
+    Shares the handling of a message with an identical one (same chat, handler and text) still being handled, e.g. MGRs
+    sent twice: the duplicate waits for the first to be done and goes to the same state, without replying again
+    """
+
+    @wraps(func)
+    def command_func(update, context):
+        query = update.callback_query
+        key = (update.effective_chat.id, func.__name__, query.data if query else update.effective_message.text)
+        return coalescer.run(key, lambda: func(update, context))
+
+    return command_func
+
+
+def check_rate(update, _):
+    """Stops updates from chats over their rate limit before they reach any other handler, warning them once"""
+    chat = update.effective_chat or update.effective_user
+    if chat is None:
+        return
+
+    allowed, warn = limiter.acquire(chat.id)
+    if allowed:
+        return
+    if warn and update.effective_message:
+        update.effective_message.reply_text(get_throttled_message(chat.id))
+    raise DispatcherHandlerStop()
+
+
+def get_throttled_message(chat_id):
+    return f"Too many requests, please wait {limiter.wait_time(chat_id):.0f} seconds and try again."
+
+
+def with_session(func):
+    """
+    Passes the session of the chat to func(update, context, chat) and saves it once func is done. Ends the conversation
+    if the session has expired.
+    """
+
+    @wraps(func)
+    def command_func(update, context, *args, **kwargs):
+        chat_id = update.effective_chat.id
+        chat = sessions.get(chat_id)
+        if chat is None:
+            update.effective_message.reply_text(SESSION_EXPIRED)
+            return -1
+
+        state = func(update, context, chat, *args, **kwargs)
+        sessions.save(chat_id, chat)
+        return state
+
+    return command_func
+
+
 # /version
 @typing
 def version(update, _):
@@ -38,26 +245,81 @@ def version(update, _):
 
 # Updates owner when someone runs a command. Stores the logs temporarily which can be accessed by /logs
 def log(update, command):
-    username = update.message.chat.username
-    userid = update.message.chat.id
+    chat = update.effective_chat or update.effective_user  # Inline queries are not sent from a chat
+    username = chat.username
+    userid = chat.id
 
     message = f"@{username} ({userid}) ran {command}"
-    logs.append(message + "\n")
+    handling.record = Record(time.time(), userid, username, command, None)
 
     if OWNER:
-        bot = Bot(TOKEN)
-        bot.send_message(OWNER, message)
+        notifier.notify(message)  # Never waits for telegram, the notifier sends it in the background
 
 
 @typing
-# /logs
-# Sends who ran what command recently. Logs will be cleared when bot goes to sleep. Can only be called by owner
-def send_logs(update, _):
+# /logs [page] [@username or @id] [/command]
+# Sends who ran what command recently, newest first. Logs will be cleared when bot goes to sleep. Can only be called by
+# owner
+def send_logs(update, context):
     if str(update.message.chat.id) == OWNER:
-        if len(logs) > 0:
-            update.message.reply_text("".join(logs))
+        page, user, command = parse_logs_args(context.args or [])
+        records, pages = logs.page(page, user=user, command=command)
+        update.message.reply_text(get_logs_message(records, page, pages))
+    return -1
+
+
+@typing
+# /demstats
+# Sends the hit/miss/eviction counters of the elevation grid tile caches of the offload workers, which take the terrain
+# profiles, added up. Can only be called by owner
+def send_grid_stats(update, _):
+    if str(update.message.chat.id) == OWNER:
+        if open_grid():
+            reports = [report for report in offloader.reports() if report]
+            stats = add_stats(reports)
+            update.message.reply_text(f"Workers: {len(reports)}\n"
+                                      f"Hits: {stats['hits']}\n"
+                                      f"Misses: {stats['misses']}\n"
+                                      f"Hit rate: {stats['hit_rate']:.1%}\n"
+                                      f"Evictions: {stats['evictions']}\n"
+                                      f"Prefetches: {stats['prefetches']}\n"
+                                      f"Tiles: {stats['tiles']}\n"
+                                      f"Size: {stats['bytes'] / 2 ** 20:.1f}/{stats['max_bytes'] / 2 ** 20:.1f}MB")
         else:
-            update.message.reply_text("No logs.")
+            update.message.reply_text("No elevation grid.")
+    return -1
+
+
+@typing
+# /stats
+# Sends the latency and rate of every handler and of the calls to telegram. Can only be called by owner
+def send_stats(update, _):
+    if str(update.message.chat.id) == OWNER:
+        stats = offloader.stats()
+        update.message.reply_text(get_stats_message(metrics.snapshot()) +
+                                  f"\nOffloaded\n"
+                                  f"Pending: {stats['pending']}/{stats['max_pending']}\n"
+                                  f"Completed: {stats['completed']}\n"
+                                  f"Failed: {stats['failed']}\n"
+                                  f"Timed out: {stats['timeouts']}\n"
+                                  f"Rejected: {stats['rejected']}\n"
+                                  f"Coalesced: {coalescer.stats()['coalesced']}\n\n"
+                                  f"Throttled: {limiter.stats()['throttled']}")
+    return -1
+
+
+@typing
+# /cachestats
+# Sends the hit rate and size of the results cache. Can only be called by owner
+def send_cache_stats(update, _):
+    if str(update.message.chat.id) == OWNER:
+        stats = results.stats()
+        update.message.reply_text(f"Hits: {stats['hits']}\n"
+                                  f"Misses: {stats['misses']}\n"
+                                  f"Hit rate: {stats['hit_rate']:.1%}\n"
+                                  f"Evictions: {stats['evictions']}\n"
+                                  f"Expirations: {stats['expirations']}\n"
+                                  f"Size: {stats['size']}/{stats['max_size']}")
     return -1
 
 
@@ -68,8 +330,14 @@ def start(update, _):
     welcome_message = "I can help you calculate path profile, azimuth, and distance between two MGRs.\n\n" \
                       "You can control me by sending these commands:\n\n" \
                       "/pathprofile - calculate path profile\n" \
+                      "/pathprofile 100 100 200 200 406 800.00 30 40 5 30 - calculate path profile in one message " \
+                      "(MGRs, radio, frequency, heights and obstacles)\n" \
                       "/distance - calculate distance (in km) between 2 MGRs\n" \
                       "/azimuth - calculate azimuth (in mils) from MGR 1 to MGR 2\n" \
+                      "/sweep - find the best channels for the last path profile\n" \
+                      "/relay - find the best sites for a relay for the last path profile\n" \
+                      "/edit - change the frequency, heights or obstacles of the last path profile\n" \
+                      "/reach 100 100 - list the stations that can reach an MGR\n" \
                       "/cancel - cancel current operation (e.g. in case of incorrect entry)\n" \
                       "/help - show this message\n\n" \
                       "Any feedback can be directed to @xavilien"
@@ -77,12 +345,38 @@ def start(update, _):
     return -1
 
 
+def send_step(update, step):
+    """Sends the replies of step, then takes the obstacles from the terrain if it asks to, :return: its state"""
+    for reply in step.replies:
+        if reply.edit:
+            update.callback_query.message.edit_text(reply.text)
+        elif reply.buttons:
+            keyboard = [[InlineKeyboardButton(option, callback_data=option) for option in reply.buttons]]
+            update.effective_message.reply_text(reply.text, reply_markup=InlineKeyboardMarkup(keyboard))
+        else:
+            update.effective_message.reply_text(reply.text)
+
+    if step.terrain:
+        reply_later(update, *get_terrain_task(update.effective_chat.id, step.terrain))
+    return step.state
+
+
+def ask_mgrs(state):
+    """First step of /distance, /azimuth and /pathprofile"""
+    return Step([Reply(MGRS_PROMPT)], state)
+
+
+def cancel_conversation(chat_id):
+    sessions.delete(chat_id)
+    return Step([Reply("Operation cancelled.")], -1)
+
+
+@coalesced
 @typing
 # /cancel
 def cancel(update, _):
     log(update, "/cancel")
-    update.message.reply_text("Operation cancelled.")
-    return -1
+    return send_step(update, cancel_conversation(update.message.chat_id))
 
 
 def get_mgr(text):
@@ -97,6 +391,7 @@ def get_mgr(text):
     return mgr[:2], mgr[2:]
 
 
+@coalesced
 @typing
 def azimuth(update, context):
     r"""
@@ -106,16 +401,21 @@ def azimuth(update, context):
     text = update.message.text
     if text == '/azimuth':
         log(update, "/azimuth")
-        update.message.reply_text("Please enter the two MGRs as such:\n100 100\n200 200")
-        return "azimuth"
+        return send_step(update, ask_mgrs("azimuth"))
     else:
         text = context.matches[0].group(0)  # We use the regex match in case of bad input
-        mgr1, mgr2 = get_mgr(text)  # Convert raw text to the 2 mgrs
-        azi = get_azimuth(mgr1, mgr2)  # Calculate azimuth
-        update.message.reply_text(f"MGR 1: {text[0]} {text[1]}\nMGR 2: {text[2]} {text[3]}\nAzimuth: {azi:.0f}mils")
-        return -1
+        return send_step(update, Step([Reply(get_azimuth_message(text))], -1))
+
+
+def get_azimuth_message(text):
+    """Reply to /azimuth for text of the form accepted by get_mgr"""
+    mgr1, mgr2 = get_mgr(text)  # Convert raw text to the 2 mgrs
+    azi = get_azimuth(mgr1, mgr2)  # Calculate azimuth, cheaper than going through the results cache
+    text = text.split()
+    return f"MGR 1: {text[0]} {text[1]}\nMGR 2: {text[2]} {text[3]}\nAzimuth: {azi:.0f}mils"
 
 
+@coalesced
 @typing
 def distance(update, context):
     r"""
@@ -125,269 +425,587 @@ def distance(update, context):
     text = update.message.text
     if text == '/distance':
         log(update, "/distance")
-        update.message.reply_text("Please enter the two MGRs as such:\n100 100\n200 200")
-        return "distance"
+        return send_step(update, ask_mgrs("distance"))
     else:
         text = context.matches[0].group(0)
-        mgr1, mgr2 = get_mgr(text)  # Convert raw text to the 2 mgrs
-        dist = get_distance(mgr1, mgr2)  # Calculate distance
-        text = text.split()
-        update.message.reply_text(f"MGR 1: {text[0]} {text[1]}\nMGR 2: {text[2]} {text[3]}\nDistance: {dist:.3f}km")
-        return -1
+        return send_step(update, Step([Reply(get_distance_message(text))], -1))
+
+
+def get_distance_message(text):
+    """Reply to /distance for text of the form accepted by get_mgr"""
+    mgr1, mgr2 = get_mgr(text)  # Convert raw text to the 2 mgrs
+    dist = get_distance(mgr1, mgr2)  # Calculate distance
+    text = text.split()
+    return f"MGR 1: {text[0]} {text[1]}\nMGR 2: {text[2]} {text[3]}\nDistance: {dist:.3f}km"
+
 
+def start_pathprofile(chat_id):
+    """Starts a new session for /pathprofile and asks for the MGRs"""
+    sessions.save(chat_id, Session())  # Keep track of variables the user has inputted
+    return ask_mgrs("pathprofile")
 
+
+@coalesced
 @typing
 def pathprofile(update, context):
     r"""
     Initial state for the path profile calculator. Gets user to input MGR.
     Matches (\d+ \d+\n\d+ \d+)
+    With arguments (see parse_pathprofile), calculates the path profile in one go.
     :return: "pathprofile" if MGR has not be inputted, "get_radio" otherwise
     """
     text = update.message.text
-    chat = chats.get(update.message.chat_id)  # Keep track of variables the user has inputted
 
-    if text == "/pathprofile":
+    if context.args:
+        log(update, "/pathprofile")
+        return pathprofile_oneshot(update, " ".join(context.args))
+    elif text == "/pathprofile":
         log(update, "/pathprofile")
-        chats[update.message.chat_id] = {}
-        update.message.reply_text("Please enter the two MGRs as such:\n100 100\n200 200")
-        return "pathprofile"
+        return send_step(update, start_pathprofile(update.message.chat_id))
     else:
-        text = context.matches[0].group(0)
-        mgr1, mgr2 = get_mgr(text)
-        text = text.split()
-        chat["mgr1"] = f"{text[0]} {text[1]}"
-        chat["mgr2"] = f"{text[2]} {text[3]}"
-        chat["distance"] = get_distance(mgr1, mgr2)
+        return get_mgrs(update, context)
+
 
-        update.message.reply_text(f"MGR 1: {chat['mgr1']}\n"
-                                  f"MGR 2: {chat['mgr1']}\n"
-                                  f"Distance: {get_distance(mgr1, mgr2):.1f}km")
+def enter_mgrs(chat, text):
+    """
+    Processes the two MGRs of /pathprofile and asks for the radio
+    :return: Step to get_radio
+    """
+    mgr1, mgr2 = get_mgr(text)
+    text = text.split()
+    chat.mgr1 = f"{text[0]} {text[1]}"
+    chat.mgr2 = f"{text[2]} {text[3]}"
+    chat.distance = get_distance(mgr1, mgr2)
+    chat.points = (mgr1, mgr2)
 
-        # Generate keyboard to ask whether the user wants to calculate for 406 or 408 radio
-        options = [406, 408]
-        keyboard = [[InlineKeyboardButton(str(option), callback_data=option) for option in options]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+    # Buttons to ask whether the user wants to calculate for 406 or 408 radio
+    return Step([Reply(f"MGR 1: {chat.mgr1}\n"
+                       f"MGR 2: {chat.mgr2}\n"
+                       f"Distance: {chat.distance:.1f}km"),
+                 Reply("Radio type", buttons=["406", "408"])], "get_radio")
 
-        update.message.reply_text("Radio type", reply_markup=reply_markup)
 
-        return "get_radio"
+@with_session
+def get_mgrs(update, context, chat):
+    return send_step(update, enter_mgrs(chat, context.matches[0].group(0)))
 
 
-@typing
-def get_radio(update, _):
+def enter_radio(chat, radio):
     """
     Processes radio choice and asks for frequency.
-    :return: get_frequency
+    :return: Step to get_freq
     """
-    query = update.callback_query
-    chat = chats[query.message.chat.id]
-    chat["radio"] = int(query.data)
-    query.message.edit_text(f"Radio: {query.data}")  # Take away the inlinekeyboard to show the option picked
+    chat.radio = int(radio)
+    return Step([Reply(f"Radio: {radio}", edit=True),  # Take away the buttons to show the option picked
+                 Reply("Please enter transmitting frequency to 2 decimal places.")], "get_freq")
+
+
+@coalesced
+@typing
+@with_session
+def get_radio(update, _, chat):
+    return send_step(update, enter_radio(chat, update.callback_query.data))
+
 
-    query.message.reply_text("Please enter transmitting frequency to 2 decimal places.")
+def enter_freq(chat, freq):
+    """
+    Processes frequency choice, including checks to make sure that it is valid and asks for transmitting height
+    :return: Step to get_height, or get_freq again if it is not valid
+    """
+    freq = float(freq)
+    if not check_freq(chat.radio, freq):
+        return Step([Reply("Invalid frequency, please enter again.")], "get_freq")
 
-    return "get_freq"
+    chat.freq = freq
+    return Step([Reply(f"Transmitting frequency: {freq}MHz"),
+                 Reply("Please enter height of transmitting and receiving node to the nearest metre as such:\n"
+                       "30 40")], "get_height")
 
 
+@coalesced
 @typing
-def get_freq(update, context):
+@with_session
+def get_freq(update, context, chat):
     r"""
-    Processes frequency choice, including checks to make sure that it is valid and asks for transmitting height
     Matches (\d+\.\d+)
-    :return: get_height
-    """
-    freq = float(context.matches[0].group(0))
-    chat = chats[update.message.chat_id]
-    radio = chat["radio"]
-
-    if check_freq(radio, freq):
-        chat["freq"] = freq
-        update.message.reply_text(f"Transmitting frequency: {freq}MHz")
-        update.message.reply_text("Please enter height of transmitting and receiving node to the nearest metre "
-                                  "as such:\n"
-                                  "30 40")
-        return "get_height"
-    else:
-        update.message.reply_text("Invalid frequency, please enter again.")
-        return "get_freq"
+    """
+    return send_step(update, enter_freq(chat, context.matches[0].group(0)))
 
 
+def enter_heights(chat, ht, hr):
+    """
+    Processes transmitting and receiving height and asks for the number of obstacles between the two nodes, or takes
+    the obstacles from the terrain between the two MGRs if an elevation grid is configured
+    :return: Step to get_number_of_obstacles, or the end if the obstacles are taken from the terrain
+    """
+    chat.ht = int(ht)
+    chat.hr = int(hr)
+    replies = [Reply(f"Transmitting height: {ht}m\nReceiving height: {hr}m")]
+
+    try:
+        if check_terrain(chat):
+            return Step(replies, -1, chat)
+    except ValueError as e:
+        replies.append(Reply(f"{e}, obstacles must be entered manually."))
+
+    replies.append(Reply("Please enter number of obstacles between the two nodes."))
+    return Step(replies, "get_number_of_obstacles")
+
+
+@coalesced
 @typing
-def get_height(update, context):
+@with_session
+def get_height(update, context, chat):
     r"""
-    Processes transmitting and receiving height and asks for the number of obstacles between the two nodes
     Matches (\d+) (\d+)
-    :return: get_obstacles
     """
-    heights = context.matches[0].group(1, 2)
-    chat = chats[update.message.chat_id]
+    return send_step(update, enter_heights(chat, *context.matches[0].group(1, 2)))
+
+
+def check_terrain(chat):
+    """
+    Whether the obstacles of chat can be taken from the terrain between its MGRs, i.e. an elevation grid is configured
+    :return: True if it is, raises ValueError if the MGRs are outside of the grid
+    """
+    if not (grid := open_grid()):
+        return False
+
+    cells = np.rint(np.array(chat.points) * 10).astype(int)
+    if not grid.contains(cells[:, 0], cells[:, 1]).all():
+        raise ValueError("Path is outside of the elevation grid")
+    return True
+
+
+def add_terrain(chat):
+    """Takes the obstacles of chat from the terrain in this thread if check_terrain"""
+    if not check_terrain(chat):
+        return False
+
+    mgr1, mgr2 = chat.points
+    key = ("profile", *mgr1, *mgr2)
+    chat.obstacles = list(results.get_or_compute(key, lambda: coalescer.run(key, lambda: profile_task(mgr1, mgr2))))
+    chat.terrain = True
+    return True
+
+
+def get_error_message(error):
+    """Reply to an offloaded calculation that failed with error"""
+    if isinstance(error, Busy):
+        return "The bot is busy, please try again in a minute."
+    if isinstance(error, TimeoutError):
+        return "Sorry, this is taking too long. Please try again later."
+    return "Sorry, something went wrong."
+
+
+def offload(key, function, args, done):
+    """
+    Runs function(*args) in the offload pool and calls done(result, error) from another thread when it is done, caching
+    the result under key. Requests for a key already being calculated wait for the same calculation.
+    """
+    def finish(result, error):
+        if error is None:
+            results.put(key, result)
+        coalescer.done(key, result, error)
+
+    if coalescer.join(key, done):
+        try:
+            offloader.submit(function, args, finish)
+        except Exception as e:  # Busy, or the pool is broken
+            finish(None, e)
+
+
+def reply_later(update, key, function, args, then=lambda result: result):
+    """
+    Replies with then(function(*args)), using the result cached under key if there is one. Otherwise function runs in
+    the offload pool: "Working..." is sent at once and edited with the reply when it is done, leaving the dispatcher
+    free for other chats in the meantime.
+    """
+    missing = object()
+    result = results.get(key, missing)
+    if result is not missing:
+        update.effective_message.reply_text(then(result))
+        return
+
+    working = update.effective_message.reply_text("Working...")
+    offload(key, function, args,
+            lambda result, error: working.edit_text(then(result) if error is None else get_error_message(error)))
+
+
+def get_terrain_task(chat_id, chat):
+    """
+    Arguments of reply_later for taking the obstacles of chat from the terrain in the offload pool, then replying with
+    the path profile
+    :return: key, function, args, then
+    """
+    mgr1, mgr2 = chat.points
 
-    chat["ht"] = int(heights[0])
-    chat["hr"] = int(heights[1])
-    update.message.reply_text(f"Transmitting height: {heights[0]}m\nReceiving height: {heights[1]}m")
-    update.message.reply_text("Please enter number of obstacles between the two nodes.")
-    return "get_number_of_obstacles"
+    def then(obstacles):
+        chat.obstacles = list(obstacles)
+        chat.terrain = True
+        chat.calculated = True
+        sessions.save(chat_id, chat)
+        return get_pathprofile_message(chat) + PATHPROFILE_FOOTER
 
+    return ("profile", *mgr1, *mgr2), profile_task, (mgr1, mgr2), then
 
+
+def enter_number_of_obstacles(chat, number):
+    """
+    Processes the number of obstacles between the two nodes and initialises some variables we will need for calculation.
+    If there are no obstacles, calculate immediately. Otherwise, get all the obstacles in get_obstacles.
+    :return: Step to get_obstacles or the end
+    """
+    # Initialise some variables that we will need
+    chat.number_of_obstacles = int(number)
+    chat.obstacles = []
+
+    if chat.number_of_obstacles == 0:
+        return calculate(chat)
+
+    return Step([Reply("Please enter distance between obstacle 1 and transmitting node to the nearest km and height "
+                       "of obstacle 1 to the nearest metres as such:\n"
+                       "5 30")], "get_obstacles")
+
+
+@coalesced
 @typing
-def get_number_of_obstacles(update, context):
+@with_session
+def get_number_of_obstacles(update, context, chat):
     r"""
-    Processes the number of obstacles between the two nodes and initialises some variables we will need for calculation.
-    If there are no obstacles, calculate immediately. Otherwise, get all the obstacles by passing to get_obstacles.
     Matches (\d+)
-    :return: "get_obstacles" or -1
     """
-    chat = chats[update.message.chat_id]
+    return send_step(update, enter_number_of_obstacles(chat, context.matches[0].group(0)))
 
-    # Initialise some variables that we will need
-    chat["number_of_obstacles"] = int(context.matches[0].group(0))
-    chat["obstacles"] = []
-    chat["largest_obstacle"] = (0.0, 0.0)
 
-    if chat["number_of_obstacles"] == 0:
-        return calculate(update)
+def enter_obstacle(chat, d, h):
+    """
+    Processes the distance and height of an obstacle, then calculates the path profile once all of them are in. Final
+    step of the pathprofile conversation.
+    :return: Step to get_obstacles or the end
+    """
+    d, h = float(d), float(h)
+
+    if d >= chat.distance:  # Make sure that the distance is valid
+        return Step([Reply("Obstacle must be between the two nodes. Please enter again.")], "get_obstacles")
 
-    update.message.reply_text("Please enter distance between obstacle 1 and transmitting "
-                              "node to the nearest km and height of obstacle 1 to the nearest metres as such:\n"
-                              "5 30")
-    return "get_obstacles"
+    chat.obstacles.append((d, h))
 
+    if (count := len(chat.obstacles)) == chat.number_of_obstacles:  # Check if we have details of all obstacles
+        return calculate(chat)
 
+    return Step([Reply(f"Please enter distance between obstacle {count+1} and transmitting node to the nearest km "
+                       f"and height of obstacle {count+1} to the nearest metres as such:\n"
+                       "5 30")], "get_obstacles")
+
+
+@coalesced
 @typing
-def get_obstacles(update, context):
+@with_session
+def get_obstacles(update, context, chat):
     r"""
-    Processes the obstacles heights and distances between the two nodes before calling the calculate function
-    that will send the results to the user. Final step of the pathprofile conversation.
     Matches (\d+) (\d+)
     """
-    chat = chats[update.message.chat_id]
-    d, h = list(map(float, context.matches[0].group(1, 2)))
-    
-    if d >= chat["distance"]:  # Make sure that the distance is valid
-        update.message.reply_text("Obstacle must be between the two nodes. Please enter again.")
-        return "get_obstacles"
-    
-    chat["obstacles"].append((d, h))
-    if h > chat["largest_obstacle"][1]:
-        chat["largest_obstacle"] = (d, h)
+    return send_step(update, enter_obstacle(chat, *context.matches[0].group(1, 2)))
+
+
+def get_results_message(dist, radio, freq, ht, hr, obstacles, terrain=False):
+    """Obstacles and Steps 2 to 9 of the path profile as text"""
+    message = ""
+
+    # Print details of all the obstacles, terrain profiles have too many to list
+    if terrain:
+        message += f"Obstacles: {len(obstacles)} from the terrain profile\n\n"
+    else:
+        for i, obstacle in enumerate(obstacles):
+            message += f"Obstacle {i + 1}\n" \
+                       f"Distance: {obstacle[0]:.0f}km\n" \
+                       f"Height: {obstacle[1]:.0f}m\n\n"
+
+    # Steps 2 to 9: calculate the link budget
+    result = evaluate_link(dist, freq, ht, hr, radio, obstacles)
+
+    message += f"The final calculated obstacle is {result.d1:.1f}km away from the transmitting node, " \
+               f"with a height of {result.h:.1f}m\n\n"
+    message += f"The height of the LOS over the obstacle is {result.los:.1f}m\n\n"
+    message += f"0.6 of the first fresnel zone radius is {result.radius:.1f}m\n\n"
+    message += f"{CASE_MESSAGES[result.case]}\n\n"
+    message += f"EPL = {result.epl:.1f}dB\n"
+    message += f"APL = {result.apl}dB\n"
+    message += f"FM = {result.fm:.1f}dB\n\n"
+
+    if result.comms:
+        message += "Comms through!!!"
+    else:
+        message += "No comms :("
+
+    return message
+
 
-    if (count := len(chat["obstacles"])) == chat["number_of_obstacles"]:  # Check if we have details of all obstacles
-        return calculate(update)
+def parse_pathprofile(text):
+    """
+    Path profile entered in one message, checked like in batch mode
+    :param text: str of the following form, MGR 1, MGR 2, radio, frequency, heights then the distance and height of
+    every obstacle:
+    100 100 200 200 406 800.00 30 40 5 30 7 40
+    :return: Session, raises ValueError if text is not a valid path profile
+    """
+    text = text.split()
+    if len(text) < 8 or len(text) % 2:
+        raise ValueError("missing values")
 
-    update.message.reply_text(f"Please enter distance between obstacle {count+1} and transmitting node to the "
-                              f"nearest km and height of obstacle {count+1} to the nearest metres as such:\n"
-                              "5 30")
-    return "get_obstacles"
+    mgr1, mgr2 = f"{text[0]} {text[1]}", f"{text[2]} {text[3]}"
+    link = {"mgr1": mgr1, "mgr2": mgr2, "radio": text[4], "freq": text[5], "ht": text[6], "hr": text[7],
+            "obstacles": list(zip(text[8::2], text[9::2]))}
+    dist, _, freq, ht, hr, radio, obstacles = parse_link(link)
 
+    return Session(mgr1, mgr2, get_mgr(" ".join(text[:4])), dist, radio, freq, ht, hr, len(obstacles), obstacles)
 
-def calculate(update):
+
+def enter_pathprofile(chat_id, text):
+    """
+    Path profile entered in one message, saved for /sweep and /relay. Without obstacles, they are taken from the
+    terrain if an elevation grid is configured and the MGRs are inside of it.
+    :return: Step to the end
+    """
+    try:
+        chat = parse_pathprofile(text)
+    except ValueError as e:
+        return Step([Reply(f"Invalid path profile ({e}). Please enter it as such:\n"
+                           "/pathprofile 100 100 200 200 406 800.00 30 40 5 30\n"
+                           "i.e. MGR 1, MGR 2, radio, frequency, transmitting and receiving heights, then the "
+                           "distance and height of every obstacle.")], -1)
+
+    try:
+        if not chat.obstacles and check_terrain(chat):
+            return Step([], -1, chat)
+    except ValueError:  # Outside of the grid, calculate without obstacles as entered
+        pass
+
+    step = calculate(chat)
+    sessions.save(chat_id, chat)
+    return step
+
+
+def pathprofile_oneshot(update, text):
+    """Replies with the path profile entered in one message, see enter_pathprofile"""
+    return send_step(update, enter_pathprofile(update.message.chat_id, text))
+
+
+def get_pathprofile_message(chat):
+    """Reply with the inputs and results of the path profile of chat"""
     # Pull out all the relevant variables
-    chat = chats[update.message.chat_id]
-    mgr1 = chat["mgr1"]
-    mgr2 = chat["mgr2"]
-    dist = chat["distance"]
-    radio = chat["radio"]
-    freq = chat["freq"]
-    ht = chat["ht"]
-    hr = chat["hr"]
-
-    obstacles = chat["obstacles"]
-    largest_obstacle = chat["largest_obstacle"]
+    mgr1 = chat.mgr1
+    mgr2 = chat.mgr2
+    dist = chat.distance
+    radio = chat.radio
+    freq = chat.freq
+    ht = chat.ht
+    hr = chat.hr
+
+    obstacles = chat.obstacles
+    terrain = chat.terrain
 
     message = f"MGR 1: {mgr1}\n" \
               f"MGR 2: {mgr2}\n" \
               f"Distance: {dist:.1f}km\n" \
               f"Radio: {radio}\n" \
               f"Frequency: {freq}MHz\n" \
-              f"Transmitting height: {ht}m\n" \
-              f"Receiving height: {hr}m\n\n"
-
-    # Print details of all the obstacles
-    for i, obstacle in enumerate(chat["obstacles"]):
-        message += f"Obstacle {i + 1}\n" \
-                   f"Distance: {obstacle[0]:.0f}km\n" \
-                   f"Height: {obstacle[1]:.0f}m\n\n"
-
-    # Step 2: calculate height and distance of final obstacle
-    for i in range(len(obstacles)):
-        for x in range(i + 1, len(obstacles)):
-            obj = calculate_effective_obstacle(obstacles[i], obstacles[x], dist)
-            if obj[1] > largest_obstacle[1]:
-                largest_obstacle = obj
-
-    d1 = largest_obstacle[0]
-    d2 = dist - d1
-    h = largest_obstacle[1]
-
-    # Step 3: adjust height of final obstacles for earth curvature correction
-    height_correction = d1 * d2 / 12.75 / 0.7
-    h += height_correction
-
-    message += f"The final calculated obstacle is {d1:.1f}km away from the transmitting node, " \
-               f"with a height of {h:.1f}m\n\n"
-
-    # Step 4: calculate height of LOS over the obstacle
-    if hr > ht:
-        los = (hr - ht) * d1 / dist + ht
-    elif ht > hr:
-        los = (ht - hr) * d2 / dist + hr
-    else:
-        los = ht
+              f"Transmitting height: {ht:g}m\n" \
+              f"Receiving height: {hr:g}m\n\n"
 
-    message += f"The height of the LOS over the obstacle is {los:.1f}m\n\n"
+    key = ("pathprofile", dist, radio, freq, ht, hr, tuple(obstacles), terrain)
+    return message + results.get_or_compute(key, lambda: get_results_message(dist, radio, freq, ht, hr, obstacles,
+                                                                             terrain))
 
-    # Step 5: calculate height of 0.6 first fresnel zone
-    radius = 0.6 * 548 * (d1 * d2 / freq / dist) ** 0.5
-    ffz_height = los - radius
 
-    message += f"0.6 of the first fresnel zone radius is {radius:.1f}m\n\n"
+PATHPROFILE_FOOTER = "\n\n/sweep - find the best channels for this link\n/relay - find the best sites for a relay\n" \
+                     "/edit - change the frequency, heights or obstacles of this link"
 
-    # Step 6: find the relevant case and calculate EPL
-    fsl = 20 * log10(41.87 * freq * dist)
-    pel = 115.11 + 40 * log10(dist) - 20 * log10(ht * hr)
 
-    if h < ffz_height:  # case 1/2 no obstruction within 0.6 of the first fresnel zone
-        epl = fsl
-        message += "Since the obstacle is not within 0.6 of the first fresnel zone, EPL = FSL\n\n"
-    elif h > los:  # case 4
-        if fsl > pel:
-            sl_fs = 19.22 * log10(h) - 9.5 * log10(d1) + 10 * log10(freq) - 41.84
-            epl = fsl + sl_fs
-            message += "Since the obstacle blocks the LOS, EPL = FSL + SL\n\n"
-        else:
-            sl_pe = 20.3 * log10(h) - 20 * log10(d1) + 10 * log10(freq) - 40
-            epl = pel + sl_pe
-            message += "Since the obstacle blocks the LOS, EPL = PEL + SL\n\n"
-    else:  # case 3
-        epl = pel
-        message += "Since the obstacle is within 0.6 of the first fresnel zone " \
-                   "but does not block the LOS, EPL = PEL\n\n"
-
-    message += f"EPL = {epl:.1f}dB\n"
-
-    # Step 7: calculate APL, we assume receiver sensitivity using 2048MBps
-    if radio == 408:
-        apl = 36. + 2 * 20 - 2 * 2.4 - (-82)
-    else:
-        apl = 40. + 2 * 15 - 2 * 9 - (-82)
-    message += f"APL = {apl}dB\n"
+def calculate(chat):
+    """Last step of /pathprofile, :return: Step to the end with the path profile of chat"""
+    start_time = time.perf_counter()
+    message = get_pathprofile_message(chat) + PATHPROFILE_FOOTER
+    chat.calculated = True
+    metrics.observe_handler("calculate", time.perf_counter() - start_time, -1)
+    return Step([Reply(message)], -1)
+
 
-    # Step 8: calculate FM
-    fm = apl - epl
-    message += f"FM = {fm:.1f}dB\n\n"
+def get_effective(chat):
+    """Step 2 of the path profile of chat, only searched for once per set of obstacles"""
+    if chat.effective is None:
+        d1, h = effective_obstacle(*pad_obstacles([chat.obstacles]), np.array([chat.distance], dtype=float))
+        chat.effective = (d1.item(), h.item())
+    return chat.effective
 
-    # Step 9: conclude if comms is through
-    if fm > 20:
+
+def get_edit_message(before, after, change):
+    """Text comparing the EPL and FM of a link before and after change"""
+    message = f"{change}\n\n"
+    if before.case != after.case:
+        message += f"{CASE_MESSAGES[after.case]}\n\n"
+    message += f"EPL = {before.epl:.1f}dB -> {after.epl:.1f}dB ({after.epl - before.epl:+.1f}dB)\n"
+    message += f"FM = {before.fm:.1f}dB -> {after.fm:.1f}dB ({after.fm - before.fm:+.1f}dB)\n\n"
+
+    if after.comms:
         message += "Comms through!!!"
     else:
         message += "No comms :("
+    return message
+
+
+EDIT_USAGE = "Please enter what to change as such:\n" \
+             "/edit freq 850.00 - transmitting frequency\n" \
+             "/edit ht 35 - height of transmitting node\n" \
+             "/edit hr 45 - height of receiving node\n" \
+             "/edit obstacle 6 40 - add an obstacle 6km from the transmitting node, 40m high"
+
+
+@typing
+# /edit freq|ht|hr|obstacle value
+def send_edit(update, context):
+    """
+    Changes one input of the last path profile calculated in the chat and replies with how the EPL and FM changed.
+    The effective obstacle is kept unless an obstacle is added.
+    """
+    log(update, "/edit")
+    chat = sessions.get(update.message.chat_id)
+
+    if not chat or not chat.calculated:
+        update.message.reply_text("Please calculate a path profile using /pathprofile first.")
+        return -1
+
+    args = context.args or []
+    field = args[0].lower() if args else None
+    try:
+        values = list(map(float, args[1:]))
+    except ValueError:
+        values = []
+
+    def evaluate():
+        return evaluate_link(chat.distance, chat.freq, chat.ht, chat.hr, chat.radio, effective=get_effective(chat))
+
+    before = evaluate()
+
+    if field == "freq" and len(values) == 1 and check_freq(chat.radio, args[1]):
+        change = f"Transmitting frequency: {chat.freq}MHz -> {values[0]}MHz"
+        chat.freq = values[0]
+    elif field in ("ht", "hr") and len(values) == 1 and values[0] > 0:
+        name = "Transmitting" if field == "ht" else "Receiving"
+        change = f"{name} height: {getattr(chat, field):g}m -> {values[0]:g}m"
+        setattr(chat, field, values[0])
+    elif field == "obstacle" and len(values) == 2 and 0 < values[0] < chat.distance:
+        change = f"Added obstacle {len(chat.obstacles) + 1}\nDistance: {values[0]:.0f}km\nHeight: {values[1]:.0f}m"
+        chat.obstacles.append((values[0], values[1]))
+        chat.number_of_obstacles = len(chat.obstacles)
+        chat.effective = None  # The only change that needs Step 2 again
+    else:
+        update.message.reply_text(EDIT_USAGE)
+        return -1
 
-    update.message.reply_text(message)
+    update.message.reply_text(get_edit_message(before, evaluate(), change))
+    sessions.save(update.message.chat_id, chat)
     return -1
 
 
+@typing
+# /sweep
+def send_sweep(update, _):
+    """Replies with the best channels for the last path profile calculated in the chat"""
+    log(update, "/sweep")
+    chat = sessions.get(update.message.chat_id)
+
+    if not chat or not chat.calculated:
+        update.message.reply_text("Please calculate a path profile using /pathprofile first.")
+        return -1
+
+    args = (chat.distance, chat.ht, chat.hr, chat.radio, tuple(chat.obstacles))
+    reply_later(update, ("sweep", *args), sweep_task, args, lambda message: f"Radio: {chat.radio}\n\n" + message)
+    return -1
+
+
+@typing
+# /relay
+def send_relays(update, _):
+    """Replies with the best sites for a relay between the nodes of the last path profile calculated in the chat"""
+    log(update, "/relay")
+    chat = sessions.get(update.message.chat_id)
+
+    if not chat or not chat.calculated:
+        update.message.reply_text("Please calculate a path profile using /pathprofile first.")
+        return -1
+
+    mgr1, mgr2 = chat.points
+    box = get_search_box(mgr1, mgr2)
+    step = get_step(box, RELAY_CANDIDATES)
+    key = ("relay", *mgr1, *mgr2, chat.radio, chat.freq, chat.ht, chat.hr)
+    args = (mgr1, mgr2, box, chat.radio, chat.freq, chat.ht, chat.hr, chat.ht, step, 5)
+    reply_later(update, key, relay_task, args, lambda message: f"Relay height: {chat.ht:g}m\n"
+                                                               f"Spacing: {step * 1000:.0f}m\n\n" + message)
+    return -1
+
+
+@typing
+# /reach MGR [height]
+def send_reach(update, context):
+    """Replies with the stations listed in PATHPROFILE_STATIONS that can reach an MGR, best FM first"""
+    log(update, "/reach")
+    if registry is None:
+        update.message.reply_text("No stations have been loaded.")
+        return -1
+
+    args = context.args or []
+    if len(args) not in (2, 3) or not check_mgr(" ".join(args[:2])) or \
+            (len(args) == 3 and (not check_float(args[2]) or float(args[2]) <= 0)):
+        update.message.reply_text("Please enter an MGR and optionally the height of the node there (m), "
+                                  "e.g. /reach 100 100 2")
+        return -1
+
+    mgr = [float(x) / 10 for x in args[:2]]
+    height = float(args[2]) if len(args) == 3 else REACH_HEIGHT
+    neighbours = registry.reachable(mgr, height)
+    update.message.reply_text(f"Stations that can reach MGR {args[0]} {args[1]} ({height:g}m high)\n\n" +
+                              get_neighbours_message(neighbours[:REACH_TOP]))
+    return -1
+
+
+@logged
+def inline_query(update, _):
+    """
+    Answers inline queries of 2 MGRs with their distance and azimuth, and of a path profile in the form of
+    parse_pathprofile with its results
+    """
+    query = update.inline_query
+    text = query.query.split()
+    answers = []
+
+    if len(text) == 4 and check_mgr(" ".join(text[:2])) and check_mgr(" ".join(text[2:])):
+        log(update, "inline distance")
+        text = " ".join(text)
+        answers = [("distance", "Distance", get_distance_message(text)),
+                   ("azimuth", "Azimuth", get_azimuth_message(text))]
+    elif len(text) >= 8:
+        log(update, "inline pathprofile")
+        try:
+            chat = parse_pathprofile(query.query)
+        except ValueError as e:
+            query.answer([], switch_pm_text=f"Invalid path profile ({e})", switch_pm_parameter="pathprofile")
+            return
+
+        try:
+            if not chat.obstacles:
+                add_terrain(chat)  # Inline queries cannot be edited later, so this runs in a run_async thread
+        except ValueError:
+            pass
+        answers = [("pathprofile", "Path profile", get_pathprofile_message(chat))]
+
+    query.answer([InlineQueryResultArticle(id=key, title=title, description=message.split("\n")[-1],
+                                           input_message_content=InputTextMessageContent(message))
+                  for key, title, message in answers])
+
+
 def get_conversation_handler():
-    mgr_filter = Filters.regex(r"(\d+ \d+\n\d+ \d+)")
+    mgr_filter = Filters.regex(MGRS_PATTERN)
 
     conversation_handler = ConversationHandler(
         entry_points=[CommandHandler('distance', distance),
@@ -398,15 +1016,17 @@ def get_conversation_handler():
             "azimuth": [MessageHandler(mgr_filter, azimuth)],
             "pathprofile": [MessageHandler(mgr_filter, pathprofile)],
             "get_radio": [CallbackQueryHandler(get_radio)],
-            "get_freq": [MessageHandler(Filters.regex(r"(\d+\.\d+)"), get_freq)],
-            "get_height": [MessageHandler(Filters.regex(r"(\d+) (\d+)"), get_height)],
-            "get_number_of_obstacles": [MessageHandler(Filters.regex(r"(\d+)"), get_number_of_obstacles)],
-            "get_obstacles": [MessageHandler(Filters.regex(r"(\d+) (\d+)"), get_obstacles)]
+            "get_freq": [MessageHandler(Filters.regex(FREQ_PATTERN), get_freq)],
+            "get_height": [MessageHandler(Filters.regex(HEIGHTS_PATTERN), get_height)],
+            "get_number_of_obstacles": [MessageHandler(Filters.regex(NUMBER_PATTERN), get_number_of_obstacles)],
+            "get_obstacles": [MessageHandler(Filters.regex(HEIGHTS_PATTERN), get_obstacles)]
         },
         fallbacks=[CommandHandler('cancel', cancel),
                    CommandHandler('pathprofile', pathprofile),
                    CommandHandler('azimuth', azimuth),
                    CommandHandler('distance', distance)],
+        name="conversations",
+        persistent=True,  # In sessions, see StatePersistence
 
     )
 
@@ -414,23 +1034,46 @@ def get_conversation_handler():
 
 
 def main():
-    updater = Updater(TOKEN)
+    offloader.start()
+
+    workers = 4
+    # Same pool size as Updater(TOKEN) would use
+    bot = Bot(TOKEN, base_url=API_URL, request=TimedRequest(con_pool_size=workers + 4))
+    updater = Updater(bot=bot, workers=workers, persistence=StatePersistence(sessions))
     dp = updater.dispatcher  # Registers handlers (commands etc)
 
+    dp.add_handler(TypeHandler(Update, check_rate), group=-1)  # Runs before the handlers in the default group 0
     dp.add_handler(get_conversation_handler())
     dp.add_handler(CommandHandler("version", version))  # To keep track of bot updates
     dp.add_handler(CommandHandler("start", start))  # Run start function when /start command is used
     dp.add_handler(CommandHandler("help", start))
+    dp.add_handler(CommandHandler("sweep", send_sweep))
+    dp.add_handler(CommandHandler("relay", send_relays))
+    dp.add_handler(CommandHandler("edit", send_edit))
+    dp.add_handler(CommandHandler("reach", send_reach))
     dp.add_handler(CommandHandler("logs", send_logs))
+    dp.add_handler(CommandHandler("demstats", send_grid_stats))
+    dp.add_handler(CommandHandler("cachestats", send_cache_stats))
+    dp.add_handler(CommandHandler("stats", send_stats))
+    dp.add_handler(InlineQueryHandler(inline_query, run_async=True))
+
+    if OWNER:
+        notifier.start(lambda text: updater.bot.send_message(OWNER, text))  # Reuses the updater's connection pool
+
+    if METRICS_PORT:
+        serve(metrics, METRICS_PORT)  # Only on localhost, scrape it from the same machine
 
     print("Starting bot...")
     # updater.start_polling()  # Start the bot
 
-    url = "https://pathprofile.herokuapp.com/" + TOKEN
+    url = WEBHOOK_URL + TOKEN
     updater.start_webhook(listen="0.0.0.0", port=PORT, url_path=TOKEN, webhook_url=url)
 
     updater.idle()  # Not exactly sure why this has to be here to be honest
 
 
 if __name__ == '__main__':
-    main()
+    # Started again through main.py: the offload workers import the module the bot was started from again, and this one
+    # sets up the stores, pool and logs of the bot on import
+    os.execv(sys.executable, [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"),
+                              "bot"])
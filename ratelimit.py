@@ -0,0 +1,120 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter:
+    """
+    Token bucket per key (chat): every request takes a token, buckets hold at most burst tokens and refill at rate tokens
+    per second. Only the max_keys most recently seen buckets are kept, the others would be full anyway by the time they
+    are seen again in most cases.
+    """
+
+    def __init__(self, rate=1.0, burst=5, max_keys=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = OrderedDict()  # key: [tokens, time they were counted, whether the key was told it is throttled]
+        self.lock = threading.Lock()
+
+        self.allowed = 0
+        self.throttled = 0
+
+    def acquire(self, key):
+        """
+        Takes a token from the bucket of key
+        :return: (allowed, warn), warn being True for the first request refused since the last one allowed
+        """
+        with self.lock:
+            now = self.clock()
+            bucket = self.buckets.pop(key, None) or [self.burst, now, False]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                bucket[2] = False
+                self.allowed += 1
+                return True, False
+
+            warn = not bucket[2]
+            bucket[2] = True
+            self.throttled += 1
+            return False, warn
+
+    def wait_time(self, key):
+        """Seconds until key has a token again"""
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                return 0.0
+            tokens = bucket[0] + (self.clock() - bucket[1]) * self.rate
+            return max(0.0, (1 - tokens) / self.rate)
+
+    def stats(self):
+        with self.lock:
+            return {"allowed": self.allowed, "throttled": self.throttled, "keys": len(self.buckets)}
+
+
+class Coalescer:
+    """
+    Shares one calculation between identical requests that arrive while it is still in flight. The first request for a
+    key starts the calculation, and the callbacks of every request for the key are called with its result.
+    """
+
+    def __init__(self):
+        self.pending = {}  # key: callbacks waiting for the calculation of key
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def join(self, key, callback):
+        """
+        Adds callback to the calculation of key
+        :return: True if no calculation of key is in flight, the caller must then start it and call done when it is done
+        """
+        with self.lock:
+            if key in self.pending:
+                self.pending[key].append(callback)
+                self.coalesced += 1
+                return False
+            self.pending[key] = [callback]
+            return True
+
+    def done(self, key, *args):
+        """Calls every callback waiting for key with args"""
+        with self.lock:
+            callbacks = self.pending.pop(key, [])
+        for callback in callbacks:
+            callback(*args)
+
+    def run(self, key, compute):
+        """compute(), or the result of the compute() already in flight for key in another thread"""
+        finished = threading.Event()
+        outcome = []
+
+        def callback(result, error):
+            outcome.append((result, error))
+            finished.set()
+
+        if self.join(key, callback):
+            try:
+                result = compute()
+            except Exception as e:
+                self.done(key, None, e)
+                raise
+            self.done(key, result, None)
+        finished.wait()
+
+        result, error = outcome[0]
+        if error is not None:
+            raise error
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {"coalesced": self.coalesced, "in_flight": len(self.pending)}
@@ -0,0 +1,208 @@
+import math
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from batch import get_format, read_links
+from linkbudget import FM_THRESHOLD, link_budget
+from main import check_float, check_freq, check_mgr, get_azimuths, get_channels, get_distances
+from network import get_max_range
+
+CELL_SIZE = 10  # Width of the buckets of the registry (km)
+STATIONS_PATH = os.environ.get("PATHPROFILE_STATIONS")
+
+# Station found by a query, with its distance (km) and azimuth (mils) from the MGR queried and the FM of the link
+# between them (None for queries that do not calculate it)
+Neighbour = namedtuple("Neighbour", ["name", "distance", "azimuth", "fm"])
+
+
+class Registry:
+    """
+    Fixed stations, each with its own radio and frequency, indexed by a grid of buckets cell_size km wide so that
+    queries only look at the stations in the buckets around an MGR. Stations are kept in arrays, with the slots of
+    removed stations reused, so the stations found in the buckets are evaluated at once.
+    Stations that can reach an MGR are searched for within the range of each radio at its lowest frequency
+    (get_max_range), the furthest any of its links can have min_fm, before calculating the link budget.
+    """
+
+    def __init__(self, cell_size=CELL_SIZE, min_fm=FM_THRESHOLD):
+        self.cell_size = cell_size
+        self.min_fm = min_fm
+        self.ranges = {radio: get_max_range(radio, get_channels(radio)[0], min_fm) for radio in (406, 408)}
+
+        self.names = []
+        self.mgrs = np.empty((0, 2))
+        self.heights = np.empty(0)
+        self.radios = np.empty(0, dtype=int)
+        self.freqs = np.empty(0)
+        self.indices = {}  # name: slot of the station in the arrays
+        self.free = []  # Slots of removed stations
+        self.buckets = {}  # (column, row): slots of the stations in the bucket
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get_bucket(self, mgr):
+        return math.floor(mgr[0] / self.cell_size), math.floor(mgr[1] / self.cell_size)
+
+    def add(self, names, mgrs, heights, radios, freqs):
+        """
+        Adds many stations at once, e.g. as returned by read_registry. Stations already there are moved, and a name
+        repeated in names is only added once, at its last position
+        """
+        names = list(names)
+        mgrs = np.asarray(mgrs, dtype=float).reshape(-1, 2)
+        last = list({name: i for i, name in enumerate(names)}.values())
+        if len(last) < len(names):
+            heights, radios, freqs = (np.broadcast_to(x, len(names))[last] for x in (heights, radios, freqs))
+            names = [names[i] for i in last]
+            mgrs = mgrs[last]
+
+        self.remove([name for name in names if name in self.indices])
+
+        n = len(mgrs)
+        if len(self.free) < n:  # Grow the arrays to fit
+            size = len(self.names)
+            grow = max(n - len(self.free), size)
+            self.names += [None] * grow
+            self.mgrs = np.concatenate([self.mgrs, np.full((grow, 2), np.nan)])
+            self.heights = np.concatenate([self.heights, np.zeros(grow)])
+            self.radios = np.concatenate([self.radios, np.zeros(grow, dtype=int)])
+            self.freqs = np.concatenate([self.freqs, np.zeros(grow)])
+            self.free += range(size + grow - 1, size - 1, -1)
+
+        slots = np.array([self.free.pop() for _ in range(n)], dtype=int)
+        self.mgrs[slots] = mgrs
+        self.heights[slots] = heights
+        self.radios[slots] = radios
+        self.freqs[slots] = freqs
+
+        for name, slot, mgr in zip(names, slots.tolist(), mgrs.tolist()):
+            self.names[slot] = name
+            self.indices[name] = slot
+            self.buckets.setdefault(self.get_bucket(mgr), set()).add(slot)
+
+    def remove(self, names):
+        """Removes many stations at once"""
+        for name in names:
+            slot = self.indices.pop(name)
+            bucket = self.get_bucket(self.mgrs[slot])
+            self.buckets[bucket].discard(slot)
+            if not self.buckets[bucket]:
+                del self.buckets[bucket]
+            self.names[slot] = None
+            self.mgrs[slot] = np.nan
+            self.free.append(slot)
+
+    def get_slots(self, mgr, radius):
+        """Slots of the stations in the buckets that overlap the square of side 2 * radius around mgr"""
+        column1, row1 = self.get_bucket((mgr[0] - radius, mgr[1] - radius))
+        column2, row2 = self.get_bucket((mgr[0] + radius, mgr[1] + radius))
+        if (column2 - column1 + 1) * (row2 - row1 + 1) > len(self.buckets):  # Fewer buckets than cells to look at
+            return np.fromiter((slot for (column, row), slots in self.buckets.items()
+                                if column1 <= column <= column2 and row1 <= row <= row2 for slot in slots), dtype=int)
+        return np.fromiter((slot for column in range(column1, column2 + 1) for row in range(row1, row2 + 1)
+                            for slot in self.buckets.get((column, row), ())), dtype=int)
+
+    def get_neighbours(self, mgr, slots, distance, fm=None):
+        """Neighbours of the stations at slots, in the order given"""
+        azimuth = get_azimuths(mgr, self.mgrs[slots])
+        return [Neighbour(self.names[slot], d, a, f) for slot, d, a, f in
+                zip(slots.tolist(), distance.tolist(), azimuth.tolist(), [None] * len(slots) if fm is None else fm)]
+
+    def within(self, mgr, radius):
+        """Stations within radius km of mgr, nearest first"""
+        slots = self.get_slots(mgr, radius)
+        distance = get_distances(mgr, self.mgrs[slots])
+        keep = np.flatnonzero(distance <= radius)
+        keep = keep[np.argsort(distance[keep], kind="stable")]
+        return self.get_neighbours(mgr, slots[keep], distance[keep])
+
+    def nearest(self, mgr, k):
+        """
+        The k stations nearest to mgr, nearest first. Searches rings of buckets further and further away until the
+        k-th nearest station found so far is nearer than any station that could be in the next ring.
+        """
+        if not self.indices:
+            return []
+        column, row = self.get_bucket(mgr)
+        columns, rows = zip(*self.buckets)
+        rings = max(abs(column - min(columns)), abs(column - max(columns)), abs(row - min(rows)), abs(row - max(rows)))
+
+        for ring in range(rings + 1):
+            slots = self.get_slots(mgr, ring * self.cell_size)
+            if len(slots) < k and ring < rings:
+                continue
+            distance = get_distances(mgr, self.mgrs[slots])
+            best = np.argsort(distance, kind="stable")[:k]
+            if ring == rings or distance[best[-1]] <= ring * self.cell_size:
+                return self.get_neighbours(mgr, slots[best], distance[best])
+
+    def reachable(self, mgr, hr, min_fm=None):
+        """
+        Stations with at least min_fm (by default the min_fm of the registry, which cannot be lowered) to a node at
+        mgr that is hr high, calculated without obstacles, best FM first
+        """
+        min_fm = self.min_fm if min_fm is None else max(min_fm, self.min_fm)
+        slots = self.get_slots(mgr, max(self.ranges.values()))
+        distance = get_distances(mgr, self.mgrs[slots])
+        ranges = np.where(self.radios[slots] == 406, self.ranges[406], self.ranges[408])
+
+        # Step 1: keep the stations within the range of their radio
+        near = np.flatnonzero(distance <= ranges)
+        slots = slots[near]
+        distance = distance[near]
+        if not len(slots):
+            return []
+
+        # Step 2: calculate the link budget of the ones left at once
+        fm = link_budget(distance, self.freqs[slots], self.heights[slots], hr, self.radios[slots]).fm
+        keep = np.flatnonzero(fm >= min_fm)
+        keep = keep[np.argsort(-fm[keep], kind="stable")]
+        return self.get_neighbours(mgr, slots[keep], distance[keep], fm[keep].tolist())
+
+
+def read_registry(path, radio=None, freq=None, fmt=None):
+    """
+    Reads a CSV (with a header row) or JSONL list of stations with a name, mgr, height, and radio and freq, which can be
+    left out of the rows if they are given
+    :return: names, mgrs (n, 2) in km like main.get_mgr, heights, radios and freqs, ready for Registry.add
+    """
+    names, mgrs, heights, radios, freqs = [], [], [], [], []
+
+    with open(path, newline="") as f:
+        for number, row in enumerate(read_links(f, fmt or get_format(path)), 1):
+            row_radio = str((row or {}).get("radio") or radio or "")
+            row_freq = str((row or {}).get("freq") or freq or "")
+            if (row is None or not check_mgr(str(row.get("mgr", ""))) or not check_float(str(row.get("height", "")))
+                    or row_radio not in ("406", "408") or not check_freq(int(row_radio), row_freq)):
+                raise ValueError(f"Invalid station on row {number}")
+            names.append(str(row.get("name") or number))
+            mgrs.append([float(x) / 10 for x in str(row["mgr"]).split()])
+            heights.append(float(row["height"]))
+            radios.append(int(row_radio))
+            freqs.append(float(row_freq))
+
+    return names, np.array(mgrs, dtype=float).reshape(-1, 2), np.array(heights), np.array(radios), np.array(freqs)
+
+
+def open_registry(path=STATIONS_PATH, radio=None, freq=None):
+    """Registry of the stations at path (by default $PATHPROFILE_STATIONS), or None if no list has been configured"""
+    if not path:
+        return None
+    registry = Registry()
+    registry.add(*read_registry(path, radio, freq))
+    return registry
+
+
+def get_neighbours_message(neighbours):
+    """Text listing stations found by a query"""
+    if not neighbours:
+        return "No stations found :("
+
+    message = ""
+    for i, neighbour in enumerate(neighbours):
+        message += f"{i + 1}. {neighbour.name}, {neighbour.distance:.1f}km at {neighbour.azimuth:.0f} mils"
+        message += f", FM = {neighbour.fm:.1f}dB\n" if neighbour.fm is not None else "\n"
+    return message
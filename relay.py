@@ -0,0 +1,162 @@
+from collections import namedtuple
+
+import numpy as np
+
+from batch import chunks, ordered_map
+from linkbudget import link_budget
+from main import get_distances
+from terrain import open_grid
+
+CHUNK_SIZE = 256  # Candidates evaluated together with terrain
+
+# A candidate relay site in km like main.get_mgr, with the FM of the hop from mgr1 to the relay, from the relay to mgr2,
+# and the worst of the two
+Relay = namedtuple("Relay", ["mgr", "fm", "fm1", "fm2"])
+
+
+def get_candidates(box, step):
+    """
+    Candidate relay sites on a grid
+    :param box: (easting, northing, easting, northing) of 2 opposite corners in km
+    :param step: spacing of the grid in km
+    :return: (n, 2) array of mgrs
+    """
+    e1, e2 = sorted(box[0::2])
+    n1, n2 = sorted(box[1::2])
+    eastings = np.arange(round((e2 - e1) / step) + 1) * step + e1
+    northings = np.arange(round((n2 - n1) / step) + 1) * step + n1
+    return np.stack(np.meshgrid(eastings, northings, indexing="ij"), axis=-1).reshape(-1, 2)
+
+
+def get_upper_bound(distance, freq, ht, hr, radio):
+    """
+    Best FM a hop can have whatever its obstacles, from the lowest EPL of every case of Step 6. When the LOS is
+    blocked, SL is lowest with the obstacle as low as the LOS can be (the lower node) and as far as it can be
+    (the other node), which can make it negative.
+    """
+    result = link_budget(distance, freq, ht, hr, radio)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        h = np.log10(np.minimum(ht, hr))
+        sl_fs = 19.22 * h - 9.5 * np.log10(distance) + 10 * np.log10(freq) - 41.84
+        sl_pe = 20.3 * h - 20 * np.log10(distance) + 10 * np.log10(freq) - 40
+
+    blocked = np.where(result.fsl > result.pel, result.fsl + np.minimum(sl_fs, 0), result.pel + np.minimum(sl_pe, 0))
+    return result.apl - np.minimum(np.minimum(result.fsl, result.pel), blocked)
+
+
+def evaluate_terrain(grid_path, mgr1, mgr2, candidates, freq, ht, hr, h_relay, radio):
+    """
+    FM of both hops through every candidate with the obstacles taken from the elevation grid at grid_path.
+    Runs in worker processes, so the grid is opened by path. Candidates outside of the grid get a FM of -inf.
+    :return: (fm1, fm2) arrays
+    """
+    grid = open_grid(grid_path)
+    fm1 = np.full(len(candidates), -np.inf)
+    fm2 = np.full(len(candidates), -np.inf)
+
+    cells = np.rint(np.concatenate([candidates, [mgr1, mgr2]]) * 10).astype(int)
+    inside = grid.contains(cells[:, 0], cells[:, 1])
+    if not inside[-2:].all():
+        return fm1, fm2
+
+    inside = inside[:-2]
+    relays = candidates[inside]
+    hop1 = grid.profiles(np.broadcast_to(mgr1, relays.shape), relays)
+    hop2 = grid.profiles(relays, np.broadcast_to(mgr2, relays.shape))
+
+    fm1[inside] = link_budget(get_distances(mgr1, relays), freq, ht, h_relay, radio, *hop1).fm
+    fm2[inside] = link_budget(get_distances(relays, mgr2), freq, h_relay, hr, radio, *hop2).fm
+
+    return fm1, fm2
+
+
+def evaluate_chunk(args):
+    """evaluate_terrain with its arguments packed together, for ordered_map. Returns the candidates with their FMs"""
+    return (args[3],) + evaluate_terrain(*args)
+
+
+def find_relays(mgr1, mgr2, box, radio, freq, ht, hr, h_relay, step=0.1, top=10, grid=None, workers=1, prune=True,
+                chunk_size=CHUNK_SIZE):
+    """
+    Searches a grid of candidate relay sites between mgr1 and mgr2 for the ones with the best worst-hop FM.
+    Without an elevation grid every candidate is evaluated at once without obstacles. With one, the candidates are
+    evaluated best upper bound (get_upper_bound) first, and the search stops as soon as no remaining candidate can
+    beat the top sites found. Candidates at either node are skipped.
+    :param mgr1: [10.0, 10.0] in km, as returned by main.get_mgr
+    :param box: (easting, northing, easting, northing) of 2 opposite corners of the area to search, in km
+    :param h_relay: height of the relay (m)
+    :param grid: ElevationGrid to take the obstacles of each hop from
+    :param workers: number of processes to evaluate the terrain with
+    :param prune: set to False to evaluate every candidate with the terrain
+    :return: up to top Relays, best first
+    """
+    candidates = get_candidates(box, step)
+    distance1 = get_distances(mgr1, candidates)
+    distance2 = get_distances(candidates, mgr2)
+    candidates = candidates[(distance1 > 0) & (distance2 > 0)]
+    distance1 = get_distances(mgr1, candidates)
+    distance2 = get_distances(candidates, mgr2)
+
+    if grid is None:
+        fm1 = link_budget(distance1, freq, ht, h_relay, radio).fm
+        fm2 = link_budget(distance2, freq, h_relay, hr, radio).fm
+        return get_top(candidates, fm1, fm2, top)
+
+    bound = np.minimum(get_upper_bound(distance1, freq, ht, h_relay, radio),
+                       get_upper_bound(distance2, freq, h_relay, hr, radio))
+    order = np.argsort(-bound, kind="stable")
+    candidates = candidates[order]
+    bound = bound[order]
+
+    found = []  # (candidates, fm1, fm2) of every chunk evaluated so far
+    top_fm = np.empty(0)  # Best worst-hop FMs found so far
+    kth_best = -np.inf
+
+    def get_chunks():
+        for chunk in chunks(range(len(candidates)), chunk_size):
+            if prune and bound[chunk[0]] <= kth_best:  # No candidate left can make it into the top sites
+                return
+            yield grid.path, mgr1, mgr2, candidates[chunk], freq, ht, hr, h_relay, radio
+
+    for result in ordered_map(evaluate_chunk, get_chunks(), workers):
+        found.append(result)
+        top_fm = np.sort(np.concatenate([top_fm, np.minimum(result[1], result[2])]))[-top:]
+        if len(top_fm) == top:
+            kth_best = top_fm[0]
+
+    if not found:
+        return []
+    return get_top(*(np.concatenate(x) for x in zip(*found)), top)
+
+
+def get_top(candidates, fm1, fm2, top):
+    """The top candidates by worst-hop FM, best first"""
+    fm = np.minimum(fm1, fm2)
+    best = np.argsort(-fm, kind="stable")[:top]
+    best = best[np.isfinite(fm[best])]
+    return [Relay(candidates[i].tolist(), fm[i].item(), fm1[i].item(), fm2[i].item()) for i in best]
+
+
+def get_relay_message(relays):
+    """Text listing the relay sites found, best first"""
+    if not relays:
+        return "No relay sites found :("
+
+    message = "Best relay sites\n"
+    for i, relay in enumerate(relays):
+        message += f"{i + 1}. MGR {relay.mgr[0] * 10:.0f} {relay.mgr[1] * 10:.0f}, FM = {relay.fm:.1f}dB " \
+                   f"({relay.fm1:.1f}dB and {relay.fm2:.1f}dB)\n"
+    return message
+
+
+def get_search_box(mgr1, mgr2, margin=0.25):
+    """Area around 2 MGRs to search for relays in, extended by margin of the distance between them on every side"""
+    pad = margin * float(get_distances(mgr1, mgr2))
+    return (min(mgr1[0], mgr2[0]) - pad, min(mgr1[1], mgr2[1]) - pad,
+            max(mgr1[0], mgr2[0]) + pad, max(mgr1[1], mgr2[1]) + pad)
+
+
+def get_step(box, max_candidates):
+    """Smallest spacing in whole MGR units (km) that keeps the grid of candidates in box under max_candidates"""
+    area = abs(box[2] - box[0]) * abs(box[3] - box[1])
+    return max(1, int(np.ceil((area / max_candidates) ** 0.5 * 10))) / 10
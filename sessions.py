@@ -0,0 +1,244 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from cache import TTLCache
+
+SESSIONS_PATH = os.environ.get('PATHPROFILE_SESSIONS')  # SQLite database shared between processes, if set
+SESSION_SIZE = int(os.environ.get('PATHPROFILE_SESSION_SIZE', 10000))  # Most chats kept
+SESSION_TTL = float(os.environ.get('PATHPROFILE_SESSION_TTL', 86400))  # Seconds a chat is kept after it was last used
+
+
+class Session:
+    """
+    What a chat has entered so far in /pathprofile, and the link calculated last for /sweep and /relay.
+    mgr1 and mgr2 are the MGRs as entered, points the same MGRs in km like main.get_mgr. effective is the (d1, h) of
+    the obstacles as returned by linkbudget.effective_obstacle once it has been searched for.
+    """
+
+    __slots__ = ["mgr1", "mgr2", "points", "distance", "radio", "freq", "ht", "hr", "number_of_obstacles",
+                 "obstacles", "terrain", "calculated", "effective"]
+
+    def __init__(self, mgr1=None, mgr2=None, points=None, distance=None, radio=None, freq=None, ht=None, hr=None,
+                 number_of_obstacles=0, obstacles=(), terrain=False, calculated=False, effective=None):
+        self.mgr1 = mgr1
+        self.mgr2 = mgr2
+        self.points = points
+        self.distance = distance
+        self.radio = radio
+        self.freq = freq
+        self.ht = ht
+        self.hr = hr
+        self.number_of_obstacles = number_of_obstacles
+        self.obstacles = [tuple(obstacle) for obstacle in obstacles]
+        self.terrain = terrain
+        self.calculated = calculated
+        self.effective = effective
+
+    def __eq__(self, other):
+        return isinstance(other, Session) and self.to_dict() == other.to_dict()
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, text):
+        session = cls(**json.loads(text))
+        if session.points is not None:
+            session.points = tuple(session.points)
+        if session.effective is not None:
+            session.effective = tuple(session.effective)
+        return session
+
+
+class MemoryStore:
+    """
+    Sessions of the chats kept in this process, least recently used evicted after max_size and expired ttl after they
+    were last used, read or saved
+    """
+
+    def __init__(self, max_size=SESSION_SIZE, ttl=SESSION_TTL, clock=time.monotonic):
+        self.sessions = TTLCache(max_size, ttl, clock, refresh=True)
+        self.states = TTLCache(max_size, ttl, clock, refresh=True)
+
+    def get(self, chat_id):
+        """Session of chat_id, None if there is none or it has expired. Restarts its ttl like SQLiteStore"""
+        return self.sessions.get(chat_id)
+
+    def save(self, chat_id, session):
+        """Stores session for chat_id, restarting its ttl. Sessions are changed in place, so this only keeps them alive"""
+        self.sessions.put(chat_id, session)
+
+    def delete(self, chat_id):
+        self.sessions.pop(chat_id)
+
+    def get_state(self, key):
+        """State of the conversation keyed on key, e.g. (chat id, user id), None if there is none or it has expired"""
+        return self.states.get(key)
+
+    def save_state(self, key, state):
+        self.states.put(key, state)
+
+    def delete_state(self, key):
+        self.states.pop(key)
+
+    def stats(self):
+        stats = self.sessions.stats()
+        return {"size": stats["size"], "max_size": stats["max_size"], "evictions": stats["evictions"],
+                "expirations": stats["expirations"]}
+
+    def close(self):
+        pass
+
+
+class SQLiteStore:
+    """
+    Sessions of the chats and the states of their conversations in a SQLite database, so that they survive restarts and
+    several processes serving the bot see the same conversations. Evicts and expires like MemoryStore, using the wall
+    clock as it is shared between processes. Sessions are copies, so they must be saved after every change.
+    """
+
+    def __init__(self, path, max_size=SESSION_SIZE, ttl=SESSION_TTL, clock=time.time):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()  # The connection is shared between the threads the bot runs handlers in
+
+        self.evictions = 0
+        self.expirations = 0
+
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")  # Readers in other processes do not block writers
+        self.connection.execute("CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL, "
+                                "used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS sessions_used ON sessions (used)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS states (key TEXT PRIMARY KEY, state TEXT NOT NULL, "
+                                "used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS states_used ON states (used)")
+
+    def get(self, chat_id):
+        with self.lock:
+            row = self.connection.execute("SELECT data, used FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is None:
+                return None
+            if row[1] + self.ttl <= self.clock():
+                self.connection.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+                self.expirations += 1
+                return None
+
+            self.connection.execute("UPDATE sessions SET used = ? WHERE chat_id = ?", (self.clock(), chat_id))
+            return Session.from_json(row[0])
+
+    def save(self, chat_id, session):
+        with self.lock:
+            now = self.clock()
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                                        (chat_id, session.to_json(), now))
+
+                # Step 1: expire sessions that have not been used for ttl
+                self.expirations += self.connection.execute("DELETE FROM sessions WHERE used <= ?",
+                                                            (now - self.ttl,)).rowcount
+
+                # Step 2: evict the least recently used sessions over max_size
+                self.evictions += self.connection.execute(
+                    "DELETE FROM sessions WHERE chat_id IN (SELECT chat_id FROM sessions ORDER BY used DESC "
+                    "LIMIT -1 OFFSET ?)", (self.max_size,)).rowcount
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def delete(self, chat_id):
+        with self.lock:
+            self.connection.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+
+    def get_state(self, key):
+        key = json.dumps(key)
+        with self.lock:
+            row = self.connection.execute("SELECT state, used FROM states WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] + self.ttl <= self.clock():
+                self.connection.execute("DELETE FROM states WHERE key = ?", (key,))
+                return None
+
+            self.connection.execute("UPDATE states SET used = ? WHERE key = ?", (self.clock(), key))
+            return json.loads(row[0])
+
+    def save_state(self, key, state):
+        with self.lock:
+            now = self.clock()
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute("INSERT OR REPLACE INTO states VALUES (?, ?, ?)",
+                                        (json.dumps(key), json.dumps(state), now))
+                self.connection.execute("DELETE FROM states WHERE used <= ?", (now - self.ttl,))
+                self.connection.execute("DELETE FROM states WHERE key IN (SELECT key FROM states ORDER BY used DESC "
+                                        "LIMIT -1 OFFSET ?)", (self.max_size,))
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def delete_state(self, key):
+        with self.lock:
+            self.connection.execute("DELETE FROM states WHERE key = ?", (json.dumps(key),))
+
+    def stats(self):
+        with self.lock:
+            size = self.connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            return {"size": size, "max_size": self.max_size, "evictions": self.evictions,
+                    "expirations": self.expirations}
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class ConversationStates:
+    """
+    States of the conversations in a session store, as the dict ConversationHandler.conversations keyed on (chat id,
+    user id). Every lookup goes to the store, so processes sharing a SQLiteStore carry on each other's conversations.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, key, default=None):
+        state = self.store.get_state(key)
+        return default if state is None else state
+
+    def __contains__(self, key):
+        return self.store.get_state(key) is not None
+
+    def __getitem__(self, key):
+        state = self.store.get_state(key)
+        if state is None:
+            raise KeyError(key)
+        return state
+
+    def __setitem__(self, key, state):
+        self.store.save_state(key, state)
+
+    def __delitem__(self, key):
+        self.store.delete_state(key)
+
+    def pop(self, key, default=None):
+        state = self.get(key, default)
+        self.store.delete_state(key)
+        return state
+
+
+def open_store(path=SESSIONS_PATH, max_size=SESSION_SIZE, ttl=SESSION_TTL):
+    """SQLiteStore at path if it is set, MemoryStore otherwise"""
+    if path:
+        return SQLiteStore(path, max_size, ttl)
+    return MemoryStore(max_size, ttl)
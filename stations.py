@@ -0,0 +1,87 @@
+import csv
+import os
+
+import numpy as np
+
+from batch import get_format, read_links
+from linkbudget import link_budget
+from main import check_float, check_mgr, get_azimuths, get_distances
+
+BLOCK_SIZE = 256  # Rows of the matrices calculated at once, bounds the memory used whatever the number of stations
+MATRICES = ["distance", "azimuth", "fm"]
+
+
+def read_stations(path, fmt=None):
+    """
+    Reads a CSV (with a header row) or JSONL list of stations with a name, mgr and height, e.g. HQ,100 100,30
+    :return: names, mgrs as an (n, 2) array in km like main.get_mgr, heights as an (n,) array
+    """
+    names = []
+    mgrs = []
+    heights = []
+
+    with open(path, newline="") as f:
+        for number, row in enumerate(read_links(f, fmt or get_format(path)), 1):
+            if row is None or not check_mgr(str(row.get("mgr", ""))) or not check_float(str(row.get("height", ""))):
+                raise ValueError(f"Invalid station on row {number}")
+            names.append(str(row.get("name") or number))
+            mgrs.append([float(x) / 10 for x in str(row["mgr"]).split()])
+            heights.append(float(row["height"]))
+
+    return names, np.array(mgrs, dtype=float).reshape(-1, 2), np.array(heights, dtype=float)
+
+
+def get_matrices(mgrs, heights, radio, freq, directory=None, block_size=BLOCK_SIZE):
+    """
+    Distance (km), azimuth (mils) and FM (dB) from every station (row) to every other station (column).
+    FM is calculated without obstacles, with the height of the row station as the transmitting height.
+    The diagonal of the FM matrix is NaN.
+    :param directory: if given, the matrices are written to distance.npy, azimuth.npy and fm.npy in directory as they
+    are calculated, and returned as read-only memory maps of those files
+    :return: {"distance": (n, n) array, "azimuth": (n, n) array, "fm": (n, n) array}, all float32
+    """
+    mgrs = np.asarray(mgrs, dtype=float)
+    heights = np.asarray(heights, dtype=float)
+    n = len(mgrs)
+
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        matrices = {name: np.lib.format.open_memmap(os.path.join(directory, f"{name}.npy"), mode="w+",
+                                                    dtype=np.float32, shape=(n, n)) for name in MATRICES}
+    else:
+        matrices = {name: np.empty((n, n), dtype=np.float32) for name in MATRICES}
+
+    for start in range(0, n, block_size):
+        rows = slice(start, min(start + block_size, n))
+        distance = get_distances(mgrs[rows, None], mgrs[None, :])
+
+        matrices["distance"][rows] = distance
+        matrices["azimuth"][rows] = get_azimuths(mgrs[rows, None], mgrs[None, :])
+
+        ht, hr = np.broadcast_arrays(heights[rows, None], heights[None, :])
+        fm = link_budget(distance.ravel(), freq, ht.ravel(), hr.ravel(), radio).fm.reshape(distance.shape)
+        matrices["fm"][rows] = np.where(distance > 0, fm, np.nan)
+
+    if directory:
+        for matrix in matrices.values():
+            matrix.flush()
+        return load_matrices(directory)
+
+    return matrices
+
+
+def load_matrices(directory):
+    """Opens the matrices written by get_matrices as read-only memory maps, so they can be sliced without loading"""
+    return {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in MATRICES}
+
+
+def run_matrix(input_path, directory, radio, freq, block_size=BLOCK_SIZE):
+    """Reads a station list and writes the matrices and the order of the stations (stations.csv) to directory"""
+    names, mgrs, heights = read_stations(input_path)
+    get_matrices(mgrs, heights, radio, freq, directory, block_size)
+
+    with open(os.path.join(directory, "stations.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["index", "name", "mgr", "height"])
+        for i, (name, mgr, height) in enumerate(zip(names, mgrs, heights)):
+            writer.writerow([i, name, f"{mgr[0] * 10:.0f} {mgr[1] * 10:.0f}", height])
@@ -0,0 +1,59 @@
+from collections import namedtuple
+
+import numpy as np
+
+from linkbudget import effective_obstacle, link_budget, pad_obstacles
+from main import get_channels
+
+# Channels ranked from the highest FM, and the runs of consecutive channels with and without comms as (lowest
+# frequency, highest frequency, comms), lowest first. The FM does not always fall as the frequency rises, as the
+# case can switch between PEL and FSL, so comms can be through on several separate ranges.
+Sweep = namedtuple("Sweep", ["freq", "fm", "epl", "ranges"])
+
+
+def get_ranges(channels, comms):
+    """Runs of consecutive channels with the same comms, as (lowest frequency, highest frequency, comms)"""
+    starts = np.concatenate([[0], np.flatnonzero(comms[1:] != comms[:-1]) + 1])
+    ends = np.concatenate([starts[1:], [len(channels)]]) - 1
+    return [(channels[start].item(), channels[end].item(), bool(comms[start]))
+            for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+def sweep(distance, ht, hr, radio, obstacles=(), method="dominant"):
+    """
+    Calculates EPL and FM of a link on every valid channel of the radio in one vectorized call. The effective obstacle
+    does not depend on the frequency, so it is only searched for once.
+    :return: Sweep of arrays, best channel first
+    """
+    channels = get_channels(radio)
+    effective = effective_obstacle(*pad_obstacles([obstacles]), np.array([distance], dtype=float), method)
+    result = link_budget(distance, channels, ht, hr, radio, effective=effective)
+
+    order = np.argsort(-result.fm, kind="stable")  # Lowest frequency first between channels with the same FM
+    ranges = get_ranges(channels, result.comms)
+
+    return Sweep(channels[order], result.fm[order], result.epl[order], ranges)
+
+
+def get_sweep_message(result, top=10):
+    """Text listing the best channels of a sweep and the ranges of channels comms are through and not through on"""
+    message = "Best channels\n"
+    for i, (freq, fm) in enumerate(zip(result.freq[:top], result.fm[:top])):
+        message += f"{i + 1}. {freq:.2f}MHz, FM = {fm:.1f}dB\n"
+
+    if len(result.ranges) == 1 and result.ranges[0][2]:
+        message += "\nComms through on every channel!!!"
+    elif len(result.ranges) == 1:
+        message += "\nNo comms on any channel :("
+    else:
+        for comms in True, False:
+            ranges = [f"{low:.2f}MHz" if low == high else f"{low:.2f}-{high:.2f}MHz"
+                      for low, high, through in result.ranges if through == comms]
+            message += f"\n{'Comms through' if comms else 'No comms'} on {', '.join(ranges)}"
+
+    return message
+
+
+def run_sweep(radio, distance, ht, hr, obstacles=(), top=10):
+    """Prints the best channels of a link"""
+    print(get_sweep_message(sweep(distance, ht, hr, radio, obstacles), top))
@@ -0,0 +1,31 @@
+from relay import find_relays, get_relay_message
+from sweep import get_sweep_message, sweep
+from terrain import open_grid
+
+# Heavy calculations of the bot, run in the worker processes of its Offloader. They are kept out of pathprofile_bot so
+# that the workers, forked from a server that has only imported this module, do not import telegram or open the bot's
+# session store and logs. This holds as long as the bot is started from main.py (python main.py bot), which the workers
+# import again as __mp_main__, rather than from pathprofile_bot.py. The elevation grid is opened in each worker from
+# $PATHPROFILE_DEM, as memory maps are not passed between processes.
+
+
+def profile_task(mgr1, mgr2):
+    """Obstacles of the terrain between 2 MGRs, see ElevationGrid.profile"""
+    return tuple(open_grid().profile(mgr1, mgr2))
+
+
+def sweep_task(distance, ht, hr, radio, obstacles):
+    """Reply to /sweep"""
+    return get_sweep_message(sweep(distance, ht, hr, radio, obstacles))
+
+
+def relay_task(mgr1, mgr2, box, radio, freq, ht, hr, h_relay, step, top):
+    """Reply to /relay"""
+    return get_relay_message(find_relays(mgr1, mgr2, box, radio, freq, ht, hr, h_relay, step=step, top=top,
+                                         grid=open_grid()))
+
+
+def grid_stats():
+    """Counters of the tile cache of the worker's elevation grid, reported to the Offloader after each task"""
+    grid = open_grid()
+    return grid.cache.stats() if grid else None
@@ -0,0 +1,241 @@
+import os
+import struct
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+DEM_PATH = os.environ.get('PATHPROFILE_DEM')
+
+# Grid file layout: header followed by rows * cols little-endian int16 elevations (m), row-major, starting from the
+# south-west corner. Each cell is one 100m MGR unit, row is the northing and column is the easting.
+MAGIC = b"PPDEM001"
+HEADER = struct.Struct("<8s4i")  # magic, easting and northing of the south-west cell, rows, cols
+DTYPE = np.dtype("<i2")
+
+TILE_SIZE = 64  # Cells per side of the tiles read from the grid file
+CACHE_BYTES = int(os.environ.get('PATHPROFILE_DEM_CACHE', 64 * 2 ** 20))  # Memory budget of the tile cache
+
+
+def write_grid(path, elevations, origin):
+    """
+    Writes a grid file that can be opened by ElevationGrid
+    :param elevations: 2D array of elevations (m), elevations[row][col] is at (origin[0] + col, origin[1] + row)
+    :param origin: (easting, northing) of the south-west cell in MGR units, e.g. (100, 100)
+    """
+    elevations = np.asarray(elevations)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, int(origin[0]), int(origin[1]), *elevations.shape))
+        f.write(elevations.astype(DTYPE).tobytes())
+
+
+class TileCache:
+    """
+    Bounded LRU cache of square tiles of a 2D array, so that repeated profiles over the same area do not read the same
+    blocks from disk again. Tiles are evicted least recently used first once the cache is over max_bytes.
+    """
+
+    def __init__(self, data, tile_size=TILE_SIZE, max_bytes=CACHE_BYTES, prefetch=1):
+        self.data = data
+        self.tile_size = tile_size
+        self.max_bytes = max_bytes
+        self.prefetch = prefetch  # Number of tiles read ahead along the direction of the path
+        self.tiles = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()  # The bot runs handlers in several threads
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetches = 0
+
+    def load(self, key):
+        """Reads the tile from the array and adds it to the cache, evicting old tiles if needed"""
+        r0 = key[0] * self.tile_size
+        c0 = key[1] * self.tile_size
+        tile = np.array(self.data[r0:r0 + self.tile_size, c0:c0 + self.tile_size])
+
+        self.tiles[key] = tile
+        self.nbytes += tile.nbytes
+        while self.nbytes > self.max_bytes and len(self.tiles) > 1:
+            _, evicted = self.tiles.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+        return tile
+
+    def tile(self, key):
+        """Tile at (tile row, tile column), from the cache if possible"""
+        if key in self.tiles:
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+
+        self.misses += 1
+        return self.load(key)
+
+    def read(self, rows, cols):
+        """
+        Values at the given cells, which must be inside the array. The cells are expected to follow a path, and
+        the tiles after the last cell in the direction from the first cell to the last are prefetched.
+        """
+        rows = np.asarray(rows)
+        cols = np.asarray(cols)
+        values = np.empty(rows.shape, dtype=self.data.dtype)
+        if rows.size == 0:
+            return values
+
+        # Group the cells by tile with a single sort over one integer key per cell
+        tiles_across = -(-self.data.shape[1] // self.tile_size)
+        keys = (rows // self.tile_size * tiles_across + cols // self.tile_size).ravel()
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        ends = np.r_[starts[1:], len(keys)]
+
+        flat_rows = rows.ravel()
+        flat_cols = cols.ravel()
+        flat_values = values.ravel()
+
+        with self.lock:
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                key = divmod(int(keys[start]), tiles_across)
+                cells = order[start:end]
+                tile = self.tile(key)
+                flat_values[cells] = tile[flat_rows[cells] - key[0] * self.tile_size,
+                                          flat_cols[cells] - key[1] * self.tile_size]
+
+            step = (int(np.sign(rows.flat[-1] - rows.flat[0])), int(np.sign(cols.flat[-1] - cols.flat[0])))
+            if step != (0, 0):
+                self.read_ahead((rows.flat[-1] // self.tile_size, cols.flat[-1] // self.tile_size), step)
+
+        return values
+
+    def read_ahead(self, key, step):
+        """Prefetches the tiles following key in the direction of step"""
+        tiles_shape = (-(-self.data.shape[0] // self.tile_size), -(-self.data.shape[1] // self.tile_size))
+        for i in range(1, self.prefetch + 1):
+            ahead = (int(key[0] + i * step[0]), int(key[1] + i * step[1]))
+            if not (0 <= ahead[0] < tiles_shape[0] and 0 <= ahead[1] < tiles_shape[1]):
+                break
+            if ahead not in self.tiles:
+                self.prefetches += 1
+                self.load(ahead)
+
+    def stats(self):
+        """Hit/miss/eviction counters and current size of the cache"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "prefetches": self.prefetches,
+                "tiles": len(self.tiles),
+                "bytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        """Empties the cache and resets the counters"""
+        with self.lock:
+            self.tiles.clear()
+            self.nbytes = 0
+            self.hits = self.misses = self.evictions = self.prefetches = 0
+
+
+class ElevationGrid:
+    """
+    Elevation raster memory mapped from a grid file. Only the tiles containing the cells that are sampled are read from
+    disk, and they are kept in a TileCache of cache_bytes.
+    """
+
+    def __init__(self, path, cache_bytes=CACHE_BYTES, tile_size=TILE_SIZE):
+        with open(path, "rb") as f:
+            magic, easting, northing, rows, cols = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an elevation grid file")
+
+        self.path = path
+        self.origin = (easting, northing)
+        self.shape = (rows, cols)
+        self.data = np.memmap(path, dtype=DTYPE, mode="r", offset=HEADER.size, shape=self.shape)
+        self.cache = TileCache(self.data, tile_size, cache_bytes)
+
+    def contains(self, easting, northing):
+        """Whether the cells at the given MGR units are inside the grid"""
+        rows = np.asarray(northing) - self.origin[1]
+        cols = np.asarray(easting) - self.origin[0]
+        return (rows >= 0) & (cols >= 0) & (rows < self.shape[0]) & (cols < self.shape[1])
+
+    def elevation(self, easting, northing):
+        """Elevations (m) of the cells at the given MGR units. Raises ValueError if any falls outside the grid."""
+        easting = np.asarray(easting, dtype=int)
+        northing = np.asarray(northing, dtype=int)
+
+        if not self.contains(easting, northing).all():
+            raise ValueError("Path is outside of the elevation grid")
+
+        return self.read(northing - self.origin[1], easting - self.origin[0])
+
+    def read(self, rows, cols):
+        """Reads the given cells through the tile cache"""
+        return self.cache.read(rows, cols).astype(float)
+
+    def profiles(self, mgr1, mgr2):
+        """
+        profile of many paths at once, sampled once per cell along each path
+        :param mgr1: (n, 2) array of mgrs in km
+        :param mgr2: (n, 2) array of mgrs in km
+        :return: (obstacle_d, obstacle_h) arrays of shape (n, most samples in a path) like linkbudget.pad_obstacles,
+        with NaN wherever there is no obstacle
+        """
+        start = np.asarray(mgr1, dtype=float).reshape(-1, 2) * 10  # Back to MGR units
+        end = np.asarray(mgr2, dtype=float).reshape(-1, 2) * 10
+        if not len(start):
+            return np.empty((0, 0)), np.empty((0, 0))
+        samples = np.maximum(np.ceil(np.abs(end - start).max(axis=1)).astype(int) + 1, 2)
+
+        k = np.arange(samples.max())
+        inside = k < samples[:, None]
+        t = np.where(inside, k / (samples[:, None] - 1), 1)  # Samples past the end of a path repeat its last cell
+        points = np.rint(start[:, None] + t[..., None] * (end - start)[:, None]).astype(int)
+        ground = self.elevation(points[..., 0], points[..., 1])
+
+        distance = np.hypot(*(end - start).T) / 10
+        h = ground - (ground[:, :1] + t * (ground[:, -1] - ground[:, 0])[:, None])
+
+        above = inside & (h > 0) & (k > 0) & (k < samples[:, None] - 1)  # The nodes themselves are not obstacles
+        return np.where(above, t * distance[:, None], np.nan), np.where(above, h, np.nan)
+
+    def profile(self, mgr1, mgr2):
+        """
+        Samples the grid once per cell along the straight line between 2 MGRs and converts it to obstacles.
+        Obstacle heights are measured from the straight line between the ground at the two nodes, like the heights
+        entered by hand, and only the samples above that line are kept.
+        :param mgr1: [10.0, 10.0] in km, as returned by main.get_mgr
+        :param mgr2: [20.0, 20.0]
+        :return: [(distance from mgr1 (km), height (m)), ...]
+        """
+        d, h = self.profiles([mgr1], [mgr2])
+        above = ~np.isnan(h[0])
+        return list(zip(d[0, above].tolist(), h[0, above].tolist()))
+
+
+def add_stats(stats):
+    """Adds up the TileCache.stats of several caches, e.g. of the grid of every worker process"""
+    total = {key: sum(s[key] for s in stats) for key in ("hits", "misses", "evictions", "prefetches", "tiles", "bytes",
+                                                          "max_bytes")}
+    lookups = total["hits"] + total["misses"]
+    total["hit_rate"] = total["hits"] / lookups if lookups else 0.0
+    return total
+
+
+@lru_cache(maxsize=None)
+def open_grid(path=DEM_PATH):
+    """ElevationGrid at path (by default $PATHPROFILE_DEM), or None if no grid has been configured"""
+    if not path:
+        return None
+    return ElevationGrid(path)
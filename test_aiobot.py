@@ -0,0 +1,136 @@
+import asyncio
+import threading
+from unittest import TestCase, mock
+
+from aiobot import *
+from pathprofile_bot import MGRS_PROMPT, coalescer
+from sessions import MemoryStore, Session
+from loadtest import FakeTelegram, Conversation, SCRIPTS, TOKEN, get_free_port, run_load, start_bot, stop_bot
+
+
+class Test(TestCase):
+    def test_api_client(self):
+        fake = FakeTelegram()
+        fake.start()
+
+        async def send():
+            api = ApiClient(fake.url + TOKEN, connections=2)
+            try:
+                messages = await asyncio.gather(*(api.call("sendMessage", chat_id=1, text=str(i)) for i in range(10)))
+                with self.assertRaises(TelegramError):
+                    await api.call("getUpdates")
+                return messages
+            finally:
+                api.close()
+
+        try:
+            messages = asyncio.run(send())
+        finally:
+            fake.shutdown()
+
+        self.assertEqual([message["text"] for message in messages], [str(i) for i in range(10)])
+        self.assertEqual(fake.calls["sendMessage"], 10)
+
+    def test_network_error(self):
+        async def send():
+            api = ApiClient(f"http://127.0.0.1:{get_free_port()}/bot{TOKEN}", timeout=5)
+            try:
+                await api.call("getMe")
+            finally:
+                api.close()
+
+        with self.assertRaises(NetworkError):
+            asyncio.run(send())
+
+    def test_typing_error(self):
+        async def handle():
+            api = ApiClient(f"http://127.0.0.1:{get_free_port()}/bot{TOKEN}", timeout=5)
+            update = SimpleNamespace(effective_chat=SimpleNamespace(id=1))
+            try:
+                with self.assertLogs("aiobot", "WARNING"):
+                    # Telegram cannot be reached, but the handler goes on
+                    await AsyncBot.send_typing(SimpleNamespace(api=api), update)
+            finally:
+                api.close()
+
+        asyncio.run(handle())
+
+    def test_session_off_loop(self):
+        store = MemoryStore()
+        store.save(1, Session(radio=406))
+        threads = []
+
+        def record(function):
+            return lambda *args: threads.append(threading.get_ident()) or function(*args)
+
+        async def handle():
+            api = SimpleNamespace(call=mock.AsyncMock(return_value={"chat": {"id": 1}, "message_id": 2}))
+            bot = AsyncBot(api, asyncio.get_running_loop())
+            update = Update.de_json({"update_id": 1, "message": {"message_id": 1, "date": 0, "text": "800.00",
+                                                                 "chat": {"id": 1, "type": "private"}}}, None)
+            context = SimpleNamespace(matches=[re.search(FREQ_PATTERN, "800.00")])
+            try:
+                self.assertEqual(await bot.get_freq(update, context), "get_height")
+            finally:
+                bot.executor.shutdown()
+                bot.store_executor.shutdown()
+            return threading.get_ident()
+
+        with mock.patch("aiobot.TOKEN", TOKEN), mock.patch("aiobot.sessions", mock.Mock(wraps=store)) as sessions:
+            sessions.get.side_effect = record(store.get)
+            sessions.save.side_effect = record(store.save)
+            loop_thread = asyncio.run(handle())
+
+        self.assertEqual(store.get(1).freq, 800.0)
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(loop_thread, threads)  # SQLiteStore would block the event loop
+
+    def test_duplicate_messages(self):
+        store = MemoryStore()
+        mgrs = "100 100\n200 200"
+
+        async def send_twice(text, state=None):
+            api = SimpleNamespace(call=mock.AsyncMock(return_value={"chat": {"id": 3}, "message_id": 2}))
+            bot = AsyncBot(api, asyncio.get_running_loop())
+            if state:
+                bot.states[(3, 3)] = state
+            entities = [{"type": "bot_command", "offset": 0, "length": len(text)}] if text.startswith("/") else []
+            message = {"message_id": 1, "date": 0, "text": text, "entities": entities,
+                       "chat": {"id": 3, "type": "private"}, "from": {"id": 3, "is_bot": False, "first_name": "user"}}
+            try:
+                # The second arrives while the first is being handled
+                await asyncio.gather(*(bot.handle({"update_id": i, "message": message}) for i in range(2)))
+            finally:
+                bot.executor.shutdown()
+                bot.store_executor.shutdown()
+            return [call.kwargs["text"] for call in api.call.call_args_list if call.args == ("sendMessage",)]
+
+        coalesced = coalescer.stats()["coalesced"]
+        with mock.patch("aiobot.TOKEN", TOKEN), mock.patch("aiobot.sessions", store):
+            self.assertEqual(asyncio.run(send_twice("/distance")), [MGRS_PROMPT])
+            self.assertEqual(store.get_state((3, 3)), "distance")
+            self.assertEqual(asyncio.run(send_twice(mgrs, "distance")), [get_distance_message(mgrs)])
+            self.assertIsNone(store.get_state((3, 3)))
+        self.assertEqual(coalescer.stats()["coalesced"], coalesced + 2)
+
+    def test_load(self):
+        fake = FakeTelegram()
+        fake.start()
+        port = get_free_port()
+        process = start_bot(fake, port, {"PATHPROFILE_ASYNC": "1"})
+        webhook_url = f"http://127.0.0.1:{port}/{TOKEN}"
+        try:
+            report = run_load(webhook_url, fake, conversations=6, concurrency=3)
+            # Commands handled by the sync handlers, and a calculation in the offload pool
+            steps = Conversation(webhook_url, fake, 1).run([
+                ("/pathprofile 100 100 200 200 406 800.00 30 40 5 30", ("Comms through", "No comms")),
+                ("/sweep", ("Radio: 406",)),
+                ("/help", ("I can help",))])
+        finally:
+            stop_bot(process)
+            fake.shutdown()
+
+        self.assertEqual((report["completed"], report["errors"]), (6, {}))
+        self.assertEqual(report["scripts"]["pathprofile"]["count"], 2 * len(SCRIPTS["pathprofile"]))
+        self.assertEqual((fake.calls["getMe"], fake.calls["setWebhook"]), (1, 1))
+        self.assertTrue(all(not isinstance(outcome, Exception) for _, outcome in steps), steps)
@@ -0,0 +1,57 @@
+import io
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from batch import *
+from linkbudget import evaluate_link
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w") as f:
+            f.write(text)
+        return path
+
+    def test_csv(self):
+        path = self.write("links.csv", "mgr1,mgr2,radio,freq,ht,hr,obstacles\n"
+                                       "100 100,200 200,406,800,30,40,3 30;7 40\n"
+                                       "100 100,200 200,406,800.1,30,40,\n"
+                                       "100 100,200 200,408,1400,30,40,20 30\n")
+        output = os.path.join(self.directory.name, "results.csv")
+        run_batch(path, output)
+
+        with open(output) as f:
+            results = list(csv.DictReader(f))
+        self.assertEqual([result["error"] for result in results],
+                         ["", "invalid freq", "obstacle must be between the two nodes"])
+
+        expected = evaluate_link(2 ** 0.5 * 10, 800, 30, 40, 406, [(3, 30), (7, 40)])
+        self.assertAlmostEqual(float(results[0]["fm"]), expected.fm)
+        self.assertAlmostEqual(float(results[0]["azimuth"]), 800)
+
+    def test_jsonl_workers(self):
+        links = [json.dumps({"mgr1": "100 100", "mgr2": f"{100 + i} 200", "radio": 406, "freq": 800, "ht": 30,
+                             "hr": 40, "obstacles": [[1, i]]}) for i in range(1, 50)]
+        path = self.write("links.jsonl", "\n".join(links[:10] + ["not json"] + links[10:]))
+
+        outputs = []
+        for workers in 1, 3:
+            output = io.StringIO()
+            with open(path) as f:
+                rows = enumerate(read_links(f, "jsonl"), 1)
+                write_results((result for chunk in ordered_map(compute_chunk, chunks(rows, 7), workers)
+                               for result in chunk), output, "jsonl")
+            outputs.append([json.loads(line) for line in output.getvalue().splitlines()])
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual([result["row"] for result in outputs[1]], list(range(1, 51)))
+        self.assertEqual(outputs[1][10]["error"], "invalid row")
@@ -0,0 +1,22 @@
+from unittest import TestCase
+
+from benchmark import compare, format_time, run_benchmarks
+
+
+class Test(TestCase):
+    def test_run_benchmarks(self):
+        results = run_benchmarks("effective_obstacle*,10]", repeat=1, min_time=0.01)
+        self.assertEqual(sorted(results["results"]), ["effective_obstacle[dominant,10]",
+                                                      "effective_obstacle[pairwise,10]"])
+        self.assertGreater(results["results"]["effective_obstacle[dominant,10]"]["best"], 0)
+
+    def test_compare(self):
+        baseline = {"results": {"a": {"best": 1.0}, "b": {"best": 1.0}, "removed": {"best": 1.0}}}
+        results = {"results": {"a": {"best": 1.1}, "b": {"best": 1.3}, "added": {"best": 1.0}}}
+        self.assertEqual(compare(results, baseline, threshold=0.2),
+                         [("a", 1.0, 1.1, 1.1, False), ("b", 1.0, 1.3, 1.3, True)])
+
+    def test_format_time(self):
+        self.assertEqual(format_time(2.5), "2.50s")
+        self.assertEqual(format_time(0.0125), "12.50ms")
+        self.assertEqual(format_time(3e-8), "30ns")
@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+from cache import TTLCache
+
+
+class Test(TestCase):
+    def test_lru(self):
+        cache = TTLCache(max_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)  # b is now the least recently used
+        cache.put("c", 3)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get_or_compute("c", lambda: 4), 3)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_ttl(self):
+        now = [0]
+        cache = TTLCache(ttl=10, clock=lambda: now[0])
+        cache.put("a", 1)
+        now[0] = 9
+        self.assertEqual(cache.get("a"), 1)
+        now[0] = 10
+        self.assertEqual(cache.get_or_compute("a", lambda: 2), 2)
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["expirations"]), (1, 1, 1))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_refresh(self):
+        now = [0]
+        cache = TTLCache(ttl=10, clock=lambda: now[0], refresh=True)
+        cache.put("a", 1)
+        now[0] = 9
+        self.assertEqual(cache.get("a"), 1)  # Expires at 19 now
+        now[0] = 18
+        self.assertEqual(cache.get("a"), 1)
+        now[0] = 28
+        self.assertIsNone(cache.get("a"))
+
+    def test_pop(self):
+        now = [0]
+        cache = TTLCache(ttl=10, clock=lambda: now[0])
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertIsNone(cache.get("a"))
+
+        now[0] = 10
+        self.assertIsNone(cache.pop("b"))
+        self.assertEqual(cache.stats()["size"], 0)
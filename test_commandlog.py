@@ -0,0 +1,53 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from commandlog import CommandLog, Record, get_logs_message, parse_logs_args
+
+
+class Test(TestCase):
+    def test_ring_buffer(self):
+        logs = CommandLog(capacity=3)
+        for i in range(5):
+            logs.add(Record(i, i % 2, f"user{i % 2}", "/pathprofile" if i % 2 else "/start", 0.1))
+
+        self.assertEqual([record.time for record in logs.find()], [4, 3, 2])
+        self.assertEqual([record.time for record in logs.find(user="1")], [3])
+        self.assertEqual([record.time for record in logs.find(user="user0", command="/start")], [4, 2])
+        self.assertEqual(logs.total, 5)
+
+    def test_page(self):
+        logs = CommandLog()
+        for i in range(5):
+            logs.add(Record(i, 1, "user", "/start", None))
+
+        records, pages = logs.page(2, page_size=2)
+        self.assertEqual(([record.time for record in records], pages), ([2, 1], 3))
+        self.assertEqual(logs.page(page_size=2, command="/relay"), ([], 1))
+
+        message = get_logs_message(records, 2, pages)
+        self.assertTrue(message.startswith("Page 2/3\n"))
+        self.assertIn("@user (1) ran /start\n", message)
+        self.assertEqual(get_logs_message([], 1, 1), "No logs.")
+
+    def test_parse_logs_args(self):
+        self.assertEqual(parse_logs_args([]), (1, None, None))
+        self.assertEqual(parse_logs_args(["/sweep", "3", "@xavilien"]), (3, "xavilien", "/sweep"))
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "commands.log")
+            logs = CommandLog(capacity=1, path=path, max_bytes=200, backups=1)
+            for i in range(5):
+                logs.add(Record(i, 1, "user", "/start", 0.25))
+            for handler in logs.logger.handlers:
+                handler.close()
+
+            # Rolled over to commands.log.1, older records are dropped from disk too
+            self.assertEqual(sorted(os.listdir(directory)), ["commands.log", "commands.log.1"])
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(lines[-1], {"time": 4, "user_id": 1, "username": "user", "command": "/start",
+                                         "latency": 0.25})
+            logs.logger.handlers.clear()
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import zlib
+from unittest import TestCase, mock
+
+import numpy as np
+
+import heatmap
+from heatmap import *
+from linkbudget import evaluate_link
+from terrain import ElevationGrid, write_grid
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "grid.dem")
+
+        rng = np.random.default_rng(0)
+        elevations = np.cumsum(np.cumsum(rng.normal(0, 1, (100, 100)), axis=0), axis=1)
+        write_grid(self.path, (elevations - elevations.min()) / np.ptp(elevations) * 300, (0, 0))
+        self.grid = ElevationGrid(self.path)
+
+    def tearDown(self):
+        del self.grid
+        self.directory.cleanup()
+
+    def test_get_cells(self):
+        eastings, northings = get_cells((2, 3, 1, 1), 0.5)
+        np.testing.assert_allclose(eastings, [1, 1.5, 2])
+        np.testing.assert_allclose(northings, [3, 2.5, 2, 1.5, 1])  # North first like an image
+
+    def test_without_terrain(self):
+        result = coverage([2.0, 2.0], (0, 0, 4, 3), 1, 406, 800, 30, 2)
+        self.assertEqual(result.fm.shape, (4, 5))
+        self.assertTrue(np.isnan(result.fm[1, 2]))  # The transmitter's cell
+        self.assertAlmostEqual(result.fm[3, 4], evaluate_link(2 ** 1.5, 800, 30, 2, 406).fm, places=4)
+
+    def test_with_terrain(self):
+        box = (0, 0, 9.9, 9.9)
+        result = coverage([3.0, 4.0], box, 0.1, 406, 800, 30, 2, grid=self.grid)
+        self.assertEqual(result.fm.shape, (100, 100))
+
+        # Cells of every ray length, split over many chunks
+        chunk_samples = CHUNK_SAMPLES
+        heatmap.CHUNK_SAMPLES = 500
+        try:
+            chunked = coverage([3.0, 4.0], box, 0.1, 406, 800, 30, 2, grid=self.grid)
+        finally:
+            heatmap.CHUNK_SAMPLES = chunk_samples
+        np.testing.assert_array_equal(chunked.fm, result.fm)
+
+        for row, col in [(0, 0), (50, 99), (95, 31)]:
+            mgr = [result.eastings[col], result.northings[row]]
+            expected = evaluate_link(np.hypot(mgr[0] - 3, mgr[1] - 4), 800, 30, 2, 406,
+                                     self.grid.profile([3.0, 4.0], mgr)).fm
+            self.assertAlmostEqual(result.fm[row, col], expected, places=3)
+
+        with self.assertRaises(ValueError):
+            coverage([20.0, 4.0], box, 0.1, 406, 800, 30, 2, grid=self.grid)
+
+    def test_box_overhanging_grid(self):
+        box = (5, 5, 14.9, 14.9)
+        result = coverage([3.0, 4.0], box, 0.1, 406, 800, 30, 2, grid=self.grid)
+        self.assertTrue(np.isnan(result.fm[:50]).all() and np.isnan(result.fm[:, 50:]).all())
+        self.assertFalse(np.isnan(result.fm[50:, :50]).any())
+
+        chunk_samples = CHUNK_SAMPLES
+        heatmap.CHUNK_SAMPLES = 2000  # So that the longest rays, outside of the grid, make chunks of their own
+        try:
+            chunked = coverage([3.0, 4.0], box, 0.1, 406, 800, 30, 2, grid=self.grid)
+        finally:
+            heatmap.CHUNK_SAMPLES = chunk_samples
+        np.testing.assert_array_equal(chunked.fm, result.fm)
+
+        # A chunk entirely outside of the grid is not sampled at all
+        with mock.patch.object(ElevationGrid, "profiles", side_effect=AssertionError):
+            fm = evaluate_cells(np.array([3.0, 4.0]), np.array([[12.0, 12.0], [14.0, 13.0]]), 800, 30, 2, 406,
+                                self.path)
+        self.assertTrue(np.isnan(fm).all())
+
+    def test_get_chunks(self):
+        cells = np.random.default_rng(0).uniform(0, 10, (1000, 2))
+        chunks = get_chunks(np.array([5.0, 5.0]), cells, terrain=True)
+        np.testing.assert_array_equal(np.sort(np.concatenate(chunks)), np.arange(1000))
+
+        samples = np.ceil(np.abs(cells - 5).max(axis=1) * 10).astype(int) + 1
+        self.assertTrue(all(len(chunk) * samples[chunk].max() <= CHUNK_SAMPLES for chunk in chunks))
+
+    def test_write_image(self):
+        fm = np.array([[np.nan, -10], [20, 100]])
+        pixels = get_pixels(fm)
+        np.testing.assert_array_equal(pixels, [[0, 1], [128, 255]])
+
+        pgm = os.path.join(self.directory.name, "coverage.pgm")
+        write_image(pgm, pixels)
+        with open(pgm, "rb") as f:
+            self.assertEqual(f.read(), b"P5\n2 2\n255\n\x00\x01\x80\xff")
+
+        png = os.path.join(self.directory.name, "coverage.png")
+        write_image(png, pixels)
+        with open(png, "rb") as f:
+            data = f.read()
+        self.assertTrue(data.startswith(b"\x89PNG\r\n\x1a\n"))
+        idat = data.index(b"IDAT")
+        length = int.from_bytes(data[idat - 4:idat], "big")
+        self.assertEqual(zlib.decompress(data[idat + 4:idat + 4 + length]), b"\x00\x00\x01\x00\x80\xff")
@@ -0,0 +1,158 @@
+import random
+from math import log10
+from unittest import TestCase
+
+import numpy as np
+
+from linkbudget import *
+from main import calculate_effective_obstacle
+
+
+def scalar_link_budget(distance, freq, ht, hr, radio, obstacles):
+    """The original one link at a time calculation, used as reference"""
+    largest_obstacle = (0.0, 0.0)
+    for obstacle in obstacles:
+        if obstacle[1] > largest_obstacle[1]:
+            largest_obstacle = obstacle
+    for i in range(len(obstacles)):
+        for x in range(i + 1, len(obstacles)):
+            obj = calculate_effective_obstacle(obstacles[i], obstacles[x], distance)
+            if obj[1] > largest_obstacle[1]:
+                largest_obstacle = obj
+
+    d1, h = largest_obstacle
+    d2 = distance - d1
+    h += d1 * d2 / 12.75 / 0.7
+
+    if hr > ht:
+        los = (hr - ht) * d1 / distance + ht
+    elif ht > hr:
+        los = (ht - hr) * d2 / distance + hr
+    else:
+        los = ht
+
+    radius = 0.6 * 548 * (d1 * d2 / freq / distance) ** 0.5
+    fsl = 20 * log10(41.87 * freq * distance)
+    pel = 115.11 + 40 * log10(distance) - 20 * log10(ht * hr)
+
+    if h < los - radius:
+        epl = fsl
+    elif h > los:
+        if fsl > pel:
+            epl = fsl + 19.22 * log10(h) - 9.5 * log10(d1) + 10 * log10(freq) - 41.84
+        else:
+            epl = pel + 20.3 * log10(h) - 20 * log10(d1) + 10 * log10(freq) - 40
+    else:
+        epl = pel
+
+    apl = 36. + 2 * 20 - 2 * 2.4 - (-82) if radio == 408 else 40. + 2 * 15 - 2 * 9 - (-82)
+    return d1, h, los, radius, epl, apl - epl
+
+
+def scalar_deygout(obstacles, distance, freq, start, end, depth):
+    """Diffraction loss of Deygout's method by plain recursion between start and end (distance, height), as reference"""
+    if depth == 0:
+        return 0.0
+    wavelength = 300 / freq
+    best = None
+    for d, h in obstacles:
+        if start[0] < d < end[0]:
+            h += d * (distance - d) / 12.75 / 0.7
+            line = start[1] + (end[1] - start[1]) * (d - start[0]) / (end[0] - start[0])
+            v = (h - line) * (2 / wavelength * (1 / (d - start[0]) + 1 / (end[0] - d)) / 1000) ** 0.5
+            if best is None or v > best[0]:
+                best = (v, (d, h))
+    if best is None or best[0] <= -0.78:
+        return 0.0
+    v, edge = best
+    loss = 6.9 + 20 * log10(((v - 0.1) ** 2 + 1) ** 0.5 + v - 0.1)
+    return loss + scalar_deygout(obstacles, distance, freq, start, edge, depth - 1) + \
+        scalar_deygout(obstacles, distance, freq, edge, end, depth - 1)
+
+
+def random_links(count, seed=0):
+    rng = random.Random(seed)
+    links = []
+    for _ in range(count):
+        distance = rng.uniform(1, 60)
+        radio = rng.choice([406, 408])
+        freq = rng.uniform(610, 960) if radio == 406 else rng.uniform(1350, 2690)
+        obstacles = [(rng.uniform(0.1, distance - 0.1), rng.uniform(1, 200)) for _ in range(rng.randint(0, 6))]
+        links.append((distance, freq, rng.randint(5, 60), rng.randint(5, 60), radio, obstacles))
+    return links
+
+
+class Test(TestCase):
+    def test_matches_scalar(self):
+        links = random_links(300)
+        distance, freq, ht, hr, radio, obstacles = zip(*links)
+
+        for method in EFFECTIVE_OBSTACLE_METHODS:
+            result = link_budget(distance, freq, ht, hr, radio, *pad_obstacles(obstacles), method=method)
+
+            for i, link in enumerate(links):
+                expected = scalar_link_budget(*link)
+                actual = (result.d1[i], result.h[i], result.los[i], result.radius[i], result.epl[i], result.fm[i])
+                for a, b in zip(actual, expected):
+                    self.assertAlmostEqual(a, b, places=9)
+                self.assertEqual(result.comms[i], expected[-1] > FM_THRESHOLD)
+
+    def test_dominant_matches_pairwise(self):
+        rng = np.random.default_rng(0)
+        distance = rng.uniform(5, 60, 200)
+        obstacle_d = rng.uniform(0.01, 1, (200, 40)) * distance[:, None]
+        obstacle_h = rng.uniform(1, 300, (200, 40))
+        obstacle_h[rng.random((200, 40)) < 0.2] = np.nan  # Links with different numbers of obstacles
+
+        for d, h in (obstacle_d, obstacle_h), (np.sort(obstacle_d, axis=1), obstacle_h):
+            expected = effective_obstacle(d, h, distance, method="pairwise")
+            actual = effective_obstacle(d, h, distance, method="dominant")
+            np.testing.assert_allclose(actual, expected, rtol=1e-12)
+
+    def test_cases(self):
+        self.assertEqual(evaluate_link(10, 800, 30, 30, 406).case, CASE_FSL)  # No obstacles
+        self.assertEqual(evaluate_link(10, 800, 30, 30, 406, [(5, 20)]).case, CASE_PEL)
+        self.assertIn(evaluate_link(10, 800, 30, 30, 406, [(5, 100)]).case, (CASE_FSL_SL, CASE_PEL_SL))
+
+    def test_evaluate_link(self):
+        result = evaluate_link(10, 800, 30, 40, 408, [(5, 30)])
+        self.assertIsInstance(result.fm, float)
+        self.assertEqual(result.apl, APL_408)
+        self.assertTrue(np.isclose(result.fm, scalar_link_budget(10, 800, 30, 40, 408, [(5, 30)])[-1]))
+
+    def test_evaluate_link_effective(self):
+        obstacles = [(3, 20), (5, 40), (8, 10)]
+        d1, h = effective_obstacle(*pad_obstacles([obstacles]), np.array([10.0]))
+        effective = (d1.item(), h.item())
+        for freq, ht in [(800, 30), (900, 60)]:
+            self.assertEqual(evaluate_link(10, freq, ht, 40, 406, effective=effective),
+                             evaluate_link(10, freq, ht, 40, 406, obstacles))
+
+    def test_deygout(self):
+        links = random_links(300, seed=1)
+        distance, freq, ht, hr, radio, obstacles = zip(*links)
+        result = link_budget(distance, freq, ht, hr, radio, *pad_obstacles(obstacles), method="deygout")
+
+        for i, (d, f, t, r, _, o) in enumerate(links):
+            loss = scalar_deygout(o, d, f, (0, t), (d, r), DEYGOUT_DEPTH)
+            self.assertAlmostEqual(result.epl[i], result.fsl[i] + loss, places=9)
+            self.assertEqual(result.case[i], CASE_DIFFRACTION if loss > 0 else CASE_FSL)
+
+        d, h = pad_obstacles(obstacles)
+        distance, freq, ht, hr = (np.array(x, dtype=float) for x in (distance, freq, ht, hr))
+        _, _, loss = deygout_obstacles(d, h, distance, freq, ht, hr, depth=4)
+        for i, link in enumerate(links):
+            self.assertAlmostEqual(loss[i], scalar_deygout(link[5], link[0], link[1], (0, link[2]), (link[0], link[3]),
+                                                           4), places=9)
+
+    def test_deygout_single_edge(self):
+        # An edge 20m above the LOS in the middle of a 10km link at 800MHz: v = 20 * sqrt(2 / 0.375 * 0.4 / 1000)
+        result = evaluate_link(10, 800, 30, 30, 406, [(5, 50 - 25 / 12.75 / 0.7)], method="deygout")
+        v = 20 * (2 / 0.375 * 0.4 / 1000) ** 0.5
+        self.assertAlmostEqual(result.epl - result.fsl, knife_edge_loss(v).item(), places=9)
+        self.assertEqual((result.d1, result.case), (5, CASE_DIFFRACTION))
+        self.assertAlmostEqual(knife_edge_loss(0).item(), 6.0, places=1)  # Grazing the LOS loses 6dB
+
+        self.assertEqual(evaluate_link(10, 800, 30, 30, 406, method="deygout").case, CASE_FSL)
+        with self.assertRaises(ValueError):
+            evaluate_link(10, 800, 30, 30, 406, effective=(5, 50), method="deygout")
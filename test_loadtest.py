@@ -0,0 +1,68 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from loadtest import *
+from sessions import ConversationStates, SQLiteStore
+
+# State of the conversation after each step of SCRIPTS["pathprofile"]
+STATES = ["pathprofile", "get_radio", "get_freq", "get_height", "get_number_of_obstacles", "get_obstacles",
+          "get_obstacles", None]
+
+
+class Test(TestCase):
+    def wait_for_state(self, states, state, timeout=10):
+        """Waits for the bot to save the state of chat 1, which it does once the reply of the step has been sent"""
+        deadline = time.monotonic() + timeout
+        while states.get((1, 1)) != state:
+            self.assertLess(time.monotonic(), deadline, f"State {state} not saved")
+            time.sleep(0.01)
+
+    def test_report(self):
+        results = [("distance", [(0, 0.01), (1, 0.02)]), ("pathprofile", [(0, 0.03), (1, TimeoutError())])]
+        report = get_report(results, 2.0, {"sendMessage": 3})
+        self.assertEqual((report["conversations"], report["completed"]), (2, 1))
+        self.assertEqual(report["errors"], {"pathprofile step 2: TimeoutError": 1})
+        self.assertAlmostEqual(report["latency"]["p50"], 0.02)
+        self.assertEqual(report["scripts"]["distance"]["count"], 2)
+        self.assertIn("Errors: 1", format_report(report))
+
+    def test_load(self):
+        fake = FakeTelegram()
+        fake.start()
+        port = get_free_port()
+        process = start_bot(fake, port)
+        try:
+            report = run_load(f"http://127.0.0.1:{port}/{TOKEN}", fake, conversations=6, concurrency=3)
+        finally:
+            stop_bot(process)
+            fake.shutdown()
+
+        self.assertEqual((report["completed"], report["errors"]), (6, {}))
+        self.assertEqual(report["scripts"]["pathprofile"]["count"], 2 * len(SCRIPTS["pathprofile"]))
+        self.assertEqual(fake.calls["setWebhook"], 1)
+
+    def test_shared_sessions(self):
+        fake = FakeTelegram()
+        fake.start()
+        ports = [get_free_port(), get_free_port()]
+        with tempfile.TemporaryDirectory() as directory:
+            env = {"PATHPROFILE_SESSIONS": os.path.join(directory, "sessions.db")}
+            processes = []
+            try:
+                for port in ports:
+                    processes.append(start_bot(fake, port, env))
+
+                # Every step goes to the other bot than the step before, as behind a load balancer
+                conversation = Conversation(None, fake, 1)
+                states = ConversationStates(SQLiteStore(env["PATHPROFILE_SESSIONS"]))
+                for number, (step, expected) in enumerate(SCRIPTS["pathprofile"]):
+                    conversation.webhook_url = f"http://127.0.0.1:{ports[number % 2]}/{TOKEN}"
+                    conversation.send(step, expected)
+                    self.wait_for_state(states, STATES[number])
+                states.store.close()
+            finally:
+                for process in processes:
+                    stop_bot(process)
+                fake.shutdown()
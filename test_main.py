@@ -15,3 +15,10 @@ class Test(TestCase):
         self.assertEqual(get_azimuth([100, 100], [50, 150]), 5600)  # North-west
 
         self.assertEqual(get_azimuth([100, 100], [100, 100]), 0)  # Same point
+
+    def test_azimuths(self):
+        mgr2 = [[100, 200], [200, 100], [100, 0], [0, 100], [200, 200], [150, 50], [50, 50], [50, 150], [100, 100]]
+        self.assertEqual(get_azimuths([100, 100], mgr2).tolist(), [get_azimuth([100, 100], mgr) for mgr in mgr2])
+
+    def test_distances(self):
+        self.assertEqual(get_distances([[0, 0], [1, 1]], [[3, 4], [1, 1]]).tolist(), [5, 0])
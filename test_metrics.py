@@ -0,0 +1,53 @@
+import json
+from unittest import TestCase
+from urllib.request import urlopen
+
+from metrics import Histogram, Metrics, get_stats_message, serve
+
+
+class Test(TestCase):
+    def test_histogram(self):
+        histogram = Histogram(buckets=(1, 2, 4))
+        for value in [0.5, 1.5, 1.5, 3, 10]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual(histogram.quantile(0.2), 1)  # All of the first bucket
+        self.assertEqual(histogram.quantile(0.4), 1.5)  # Halfway through the second
+        self.assertEqual(histogram.quantile(1), 4)  # Above the last bound
+        self.assertIsNone(Histogram().quantile(0.5))
+
+    def test_metrics(self):
+        now = [0]
+        metrics = Metrics(clock=lambda: now[0])
+        metrics.observe_handler("get_freq", 0.02, "get_height")
+        metrics.observe_handler("get_freq", 0.04, "get_freq")
+        metrics.observe_handler("get_freq", 0.03, "get_height")
+        metrics.observe_api("sendMessage", 0.2)
+        now[0] = 10
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["handlers"]["get_freq"]["count"], 3)
+        self.assertAlmostEqual(snapshot["handlers"]["get_freq"]["rate"], 0.3)
+        self.assertEqual(snapshot["transitions"], [{"handler": "get_freq", "state": "get_freq", "count": 1},
+                                                   {"handler": "get_freq", "state": "get_height", "count": 2}])
+        self.assertIn("sendMessage: 1 (6.0/min)", get_stats_message(snapshot))
+
+        text = metrics.to_prometheus()
+        self.assertIn('pathprofile_handler_seconds_bucket{handler="get_freq",le="0.025"} 1\n', text)
+        self.assertIn('pathprofile_handler_seconds_bucket{handler="get_freq",le="+Inf"} 3\n', text)
+        self.assertIn('pathprofile_transitions_total{handler="get_freq",state="get_height"} 2\n', text)
+
+    def test_serve(self):
+        metrics = Metrics()
+        metrics.observe_api("sendChatAction", 0.1)
+        server = serve(metrics, 0)
+        try:
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+            with urlopen(url + "/metrics") as response:
+                self.assertIn(b'pathprofile_api_seconds_count{method="sendChatAction"} 1', response.read())
+            with urlopen(url + "/metrics.json") as response:
+                self.assertEqual(json.load(response)["api"]["sendChatAction"]["count"], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,80 @@
+import itertools
+from unittest import TestCase
+
+import numpy as np
+
+from linkbudget import evaluate_link
+from main import get_distance
+from network import *
+
+
+class Test(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.names = [str(i) for i in range(60)]
+        self.mgrs = rng.uniform(0, 300, (60, 2))
+        self.heights = rng.uniform(10, 50, 60)
+        self.network = Network(408, 1400)
+        self.network.add_stations(self.names, self.mgrs, self.heights)
+
+    def brute_force(self, source, target, down=()):
+        """Best worst hop FM between 2 stations, trying every bottleneck from the best down"""
+        links = {}
+        for i, j in itertools.combinations(range(len(self.names)), 2):
+            if self.names[i] in down or self.names[j] in down:
+                continue
+            fm = evaluate_link(get_distance(self.mgrs[i], self.mgrs[j]), 1400, self.heights[i], self.heights[j], 408).fm
+            if fm >= self.network.min_fm:
+                links[i, j] = fm
+
+        for bottleneck in sorted(set(links.values()), reverse=True):
+            reached = {self.names.index(source)}
+            while True:
+                new = {j for (a, b) in links for i, j in ((a, b), (b, a))
+                       if i in reached and j not in reached and links[a, b] >= bottleneck}
+                if not new:
+                    break
+                reached |= new
+            if self.names.index(target) in reached:
+                return bottleneck
+        return None
+
+    def test_max_range(self):
+        distance = get_max_range(408, 1400)
+        self.assertGreaterEqual(evaluate_link(distance * 0.99, 1400, 10, 10, 408).fm, 20)
+        self.assertLess(evaluate_link(distance, 1400, 10, 10, 408).fm, 20)
+
+    def test_route(self):
+        stats = self.network.stats()
+        self.assertLess(stats["evaluated"], 60 * 59 / 2)  # Pairs too far apart were never evaluated
+
+        for source, target in ("0", "1"), ("5", "42"), ("17", "3"):
+            route = self.network.route(source, target)
+            expected = self.brute_force(source, target)
+            if expected is None:
+                self.assertIsNone(route)
+                continue
+            self.assertAlmostEqual(route.fm, expected)
+            self.assertEqual(route.fm, min(route.hops))
+            self.assertEqual((route.stations[0], route.stations[-1]), (source, target))
+
+    def test_updates(self):
+        route = self.network.route("5", "42")
+        relay = route.stations[1]
+        self.network.remove(relay)  # Drops the cached routes through the relay
+        self.names.remove(relay)
+        index = [str(i) for i in range(60)].index(relay)
+        self.mgrs = np.delete(self.mgrs, index, axis=0)
+        self.heights = np.delete(self.heights, index)
+
+        new = self.network.route("5", "42")
+        self.assertNotIn(relay, new.stations if new else [])
+        expected = self.brute_force("5", "42")
+        self.assertAlmostEqual(new.fm if new else None, expected)
+
+        self.network.move("42", self.mgrs[self.names.index("5")] + 1)  # Right next to 5 now
+        self.assertEqual(self.network.route("5", "42").stations, ["5", "42"])
+        self.assertEqual(self.network.stats()["stations"], 59)
+
+        with self.assertRaises(KeyError):
+            self.network.route("5", relay)
@@ -0,0 +1,54 @@
+import threading
+import time
+from unittest import TestCase
+
+from notifier import *
+
+
+class Test(TestCase):
+    def test_digest(self):
+        sent = []
+        notifier = Notifier(interval=0.2)
+        notifier.start(sent.append)
+        for i in range(5):
+            notifier.notify(f"command {i}")
+        notifier.stop(timeout=5)
+
+        self.assertEqual(sent, ["command 0\ncommand 1\ncommand 2\ncommand 3\ncommand 4"])
+
+    def test_backpressure(self):
+        sent = []
+        release = threading.Event()
+
+        def send(text):  # The owner's chat is slow
+            release.wait(5)
+            sent.append(text)
+
+        notifier = Notifier(max_queue=3, interval=0)
+        notifier.start(send)
+        notifier.notify("first")
+        time.sleep(0.1)  # first is being sent
+
+        start = time.monotonic()
+        for i in range(10):
+            notifier.notify(f"command {i}")
+        self.assertLess(time.monotonic() - start, 0.1)  # Never waits for send
+
+        release.set()
+        notifier.stop(timeout=5)
+        self.assertEqual(sent, ["first", "command 0\ncommand 1\ncommand 2\n... and 7 more"])
+
+    def test_failure(self):
+        notifier = Notifier(interval=0)
+        notifier.start(lambda text: 1 / 0)
+        notifier.notify("command")
+        notifier.stop(timeout=5)
+        self.assertEqual(notifier.stats()["failed"], 1)
+
+    def test_get_digest(self):
+        self.assertEqual(get_digest(["a", "b"]), "a\nb")
+        self.assertEqual(get_digest([], 3), "... and 3 more")
+
+        digest = get_digest(["x" * 10] * 100, max_length=50)
+        self.assertLessEqual(len(digest), 50)
+        self.assertTrue(digest.endswith("... and 97 more"))
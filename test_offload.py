@@ -0,0 +1,72 @@
+import math
+import os
+import queue
+import time
+from concurrent.futures.process import BrokenProcessPool
+from unittest import TestCase, mock
+
+from offload import Busy, Offloader
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.offloader = Offloader(workers=1, max_pending=2, timeout=10)
+        self.offloader.start()
+        self.results = queue.Queue()
+
+    def tearDown(self):
+        self.offloader.shutdown()
+
+    def callback(self, result, error):
+        self.results.put((result, error))
+
+    def test_submit(self):
+        self.offloader.submit(math.factorial, (5,), self.callback)
+        self.assertEqual(self.results.get(timeout=30), (120, None))
+
+        self.offloader.submit(math.sqrt, (-1,), self.callback)
+        result, error = self.results.get(timeout=30)
+        self.assertIsInstance(error, ValueError)
+
+        stats = self.offloader.stats()
+        self.assertEqual((stats["completed"], stats["failed"], stats["pending"]), (1, 1, 0))
+
+    def test_timeout_and_busy(self):
+        self.offloader.submit(time.sleep, (1,), self.callback, timeout=0.1)
+        self.offloader.submit(math.factorial, (3,), self.callback)
+        with self.assertRaises(Busy):  # Both are still waiting or running
+            self.offloader.submit(math.factorial, (4,), self.callback)
+
+        result, error = self.results.get(timeout=30)
+        self.assertIsInstance(error, TimeoutError)
+        self.assertEqual(self.results.get(timeout=30), (6, None))  # Queued behind the sleep, so after it is done
+
+        time.sleep(0.1)  # Let the timed out sleep's own callback run, which must not call back again
+        self.assertTrue(self.results.empty())
+        stats = self.offloader.stats()
+        self.assertEqual((stats["timeouts"], stats["rejected"], stats["pending"]), (1, 1, 0))
+
+    def test_broken_pool(self):
+        with mock.patch.object(self.offloader.executor, "submit", side_effect=BrokenProcessPool()):
+            with self.assertRaises(BrokenProcessPool):
+                self.offloader.submit(math.factorial, (5,), self.callback, timeout=0.1)
+
+        time.sleep(0.3)  # No timer left behind to call back with a false timeout
+        self.assertTrue(self.results.empty())
+        stats = self.offloader.stats()
+        self.assertEqual((stats["pending"], stats["failed"], stats["timeouts"]), (0, 1, 0))
+
+    def test_reports(self):
+        offloader = Offloader(workers=2, report=os.getpid)
+        offloader.start()
+        try:
+            self.assertEqual(offloader.reports(), [])
+            for i in range(4):
+                offloader.submit(math.factorial, (i,), self.callback)
+            self.assertEqual(sorted(self.results.get(timeout=30) for _ in range(4)),
+                             [(1, None), (1, None), (2, None), (6, None)])
+        finally:
+            offloader.shutdown()
+
+        pids = offloader.reports()  # The pid of every worker that ran one of them, as reported after it
+        self.assertTrue(1 <= len(pids) <= 2 and os.getpid() not in pids)
@@ -0,0 +1,216 @@
+import math
+import re
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from types import SimpleNamespace
+from unittest import TestCase, mock
+
+from linkbudget import evaluate_link
+from pathprofile_bot import *
+
+
+def get_update(text, chat_id=1):
+    """Update of a message with text, whose replies are kept in update.replies"""
+    replies = []
+    chat = SimpleNamespace(id=chat_id, username="user", type="private")
+    working = SimpleNamespace(edit_text=replies.append)  # The message sent, e.g. "Working..." by reply_later
+    message = SimpleNamespace(text=text, chat=chat, chat_id=chat_id,
+                              reply_text=lambda text, **_: replies.append(text) or working)
+    return SimpleNamespace(message=message, callback_query=None, effective_message=message, effective_chat=chat,
+                           effective_user=chat, replies=replies)
+
+
+def get_context(args=None):
+    return SimpleNamespace(args=args, matches=None, bot=SimpleNamespace(send_chat_action=lambda **_: None))
+
+
+def get_inline_update(query):
+    """Update of an inline query, whose answers are kept in update.answers"""
+    answers = []
+    user = SimpleNamespace(id=2, username="user")
+    inline_query = SimpleNamespace(query=query, answer=lambda results, **kwargs: answers.append((results, kwargs)))
+    return SimpleNamespace(inline_query=inline_query, effective_chat=None, effective_user=user, answers=answers)
+
+
+class Test(TestCase):
+    def setUp(self):
+        results.clear()
+
+    def test_parse_pathprofile(self):
+        chat = parse_pathprofile("100 100 200 200 406 800.00 30 40 5 30 7 40")
+        self.assertEqual((chat.mgr1, chat.mgr2, chat.radio, chat.freq, chat.ht, chat.hr),
+                         ("100 100", "200 200", 406, 800.0, 30.0, 40.0))
+        self.assertEqual(chat.points, ([10.0, 10.0], [20.0, 20.0]))
+        self.assertEqual((chat.number_of_obstacles, chat.obstacles), (2, [(5.0, 30.0), (7.0, 40.0)]))
+        self.assertAlmostEqual(chat.distance, 14.142, 3)
+
+        self.assertEqual(parse_pathprofile("100 100 200 200 408 1350.00 30 40").obstacles, [])
+
+    def test_parse_pathprofile_errors(self):
+        for text, error in [("100 100 200 200 406 800.00 30", "missing values"),
+                            ("100 100 200 200 406 800.00 30 40 5", "missing values"),
+                            ("100 100 200 x 406 800.00 30 40", "invalid mgr"),
+                            ("100 100 200 200 407 800.00 30 40", "invalid radio"),
+                            ("100 100 200 200 406 1350.00 30 40", "invalid freq"),
+                            ("100 100 200 200 406 800.00 30 x", "invalid height"),
+                            ("100 100 200 200 406 800.00 30 40 5 x", "invalid obstacles"),
+                            ("100 100 200 200 406 800.00 30 40 15 30", "obstacle must be between the two nodes")]:
+            with self.subTest(text):
+                with self.assertRaises(ValueError) as context:
+                    parse_pathprofile(text)
+                self.assertEqual(str(context.exception), error)
+
+    def test_pathprofile_oneshot(self):
+        update = get_update("/pathprofile 100 100 200 200 406 800.00 30 40 5 30", chat_id=10)
+        self.assertEqual(pathprofile_oneshot(update, "100 100 200 200 406 800.00 30 40 5 30"), -1)
+
+        result = evaluate_link(sessions.get(10).distance, 800.0, 30, 40, 406, [(5.0, 30.0)])
+        reply, = update.replies
+        self.assertTrue(reply.startswith("MGR 1: 100 100\nMGR 2: 200 200\nDistance: 14.1km\nRadio: 406\n"
+                                         "Frequency: 800.0MHz\nTransmitting height: 30m\nReceiving height: 40m\n\n"
+                                         "Obstacle 1\nDistance: 5km\nHeight: 30m\n\n"))
+        self.assertIn(f"FM = {result.fm:.1f}dB", reply)
+        self.assertTrue(reply.endswith(PATHPROFILE_FOOTER))
+        self.assertTrue(sessions.get(10).calculated)  # Saved for /sweep and /relay
+
+    def test_pathprofile_args(self):
+        text = "/pathprofile 100 100 200 200 406 800.00 30 40"
+        update = get_update(text, chat_id=12)
+        self.assertEqual(pathprofile(update, get_context(text.split()[1:])), -1)  # One go, no conversation
+        self.assertIn("Receiving height: 40m", update.replies[0])
+        self.assertEqual(sessions.get(12).obstacles, [])
+
+    def test_pathprofile_oneshot_invalid(self):
+        update = get_update("/pathprofile 100 100 200 200 407 800.00 30 40", chat_id=11)
+        self.assertEqual(pathprofile_oneshot(update, "100 100 200 200 407 800.00 30 40"), -1)
+        self.assertTrue(update.replies[0].startswith("Invalid path profile (invalid radio). Please enter it as such:"))
+        self.assertIsNone(sessions.get(11))
+
+    def test_inline_distance(self):
+        update = get_inline_update("100 100 200 200")
+        inline_query(update, None)
+
+        (answers, _), = update.answers
+        self.assertEqual([answer.id for answer in answers], ["distance", "azimuth"])
+        self.assertEqual(answers[0].input_message_content.message_text, get_distance_message("100 100 200 200"))
+        self.assertEqual(answers[0].description, "Distance: 14.142km")
+        self.assertEqual(answers[1].description, "Azimuth: 800mils")
+
+    def test_inline_pathprofile(self):
+        update = get_inline_update("100 100 200 200 406 800.00 30 40 5 30")
+        inline_query(update, None)
+
+        (answers, _), = update.answers
+        self.assertEqual([answer.id for answer in answers], ["pathprofile"])
+        self.assertEqual(answers[0].input_message_content.message_text,
+                         get_pathprofile_message(parse_pathprofile("100 100 200 200 406 800.00 30 40 5 30")))
+        self.assertIn(answers[0].description, ("Comms through!!!", "No comms :("))
+
+    def test_inline_invalid(self):
+        update = get_inline_update("100 100 200 200 406 800.00 30 40 15 30")
+        inline_query(update, None)
+        self.assertEqual(update.answers, [([], {"switch_pm_text": "Invalid path profile (obstacle must be between the "
+                                                                  "two nodes)",
+                                                "switch_pm_parameter": "pathprofile"})])
+
+        update = get_inline_update("100 100")  # Neither 2 MGRs nor a path profile
+        inline_query(update, None)
+        self.assertEqual(update.answers, [([], {})])
+
+    def test_reply_later_broken_pool(self):
+        update = get_update("/sweep", chat_id=30)
+        with mock.patch.object(offloader, "submit", side_effect=BrokenProcessPool()):
+            reply_later(update, ("test", 30), math.factorial, (5,))
+        self.assertEqual(update.replies, ["Working...", "Sorry, something went wrong."])
+        self.assertEqual(coalescer.stats()["in_flight"], 0)  # The next request tries again
+
+    def edit(self, chat_id, *args):
+        update = get_update("/edit " + " ".join(args), chat_id)
+        self.assertEqual(send_edit(update, get_context(list(args))), -1)
+        return update.replies[0]
+
+    def calculate_link(self, chat_id, text="100 100 200 200 406 800.00 30 40 5 30"):
+        pathprofile_oneshot(get_update("/pathprofile " + text, chat_id), text)
+        return sessions.get(chat_id)
+
+    def test_duplicate_mgrs(self):
+        text = "100 100\n200 200"
+        context = get_context()
+        context.matches = [re.match(r"\d+ \d+\n\d+ \d+", text)]
+        updates = [get_update(text, chat_id=24), get_update(text, chat_id=24)]
+        started = threading.Event()
+        message = get_distance_message(text)
+
+        def slow_message(_):
+            started.set()
+            time.sleep(0.2)
+            return message
+
+        coalesced = coalescer.stats()["coalesced"]
+        states = []
+        with mock.patch("pathprofile_bot.get_distance_message", side_effect=slow_message) as get_message:
+            first = threading.Thread(target=lambda: states.append(distance(updates[0], context)))
+            first.start()
+            self.assertTrue(started.wait(5))
+            states.append(distance(updates[1], context))  # Sent again while the first is being handled
+            first.join()
+
+        self.assertEqual(states, [-1, -1])
+        self.assertEqual(get_message.call_count, 1)
+        self.assertEqual(updates[0].replies + updates[1].replies, [message])  # Replied to once
+        self.assertEqual(coalescer.stats()["coalesced"], coalesced + 1)
+
+        # Once it is done, the same message is handled again
+        update = get_update(text, chat_id=24)
+        distance(update, context)
+        self.assertEqual(update.replies, [message])
+
+    def test_edit(self):
+        chat = self.calculate_link(20)
+        effective = (5.0, 30.0)  # The only obstacle
+        before = evaluate_link(chat.distance, 800.0, 30, 40, 406, effective=effective)
+        after = evaluate_link(chat.distance, 850.0, 30, 40, 406, effective=effective)
+
+        reply = self.edit(20, "freq", "850.00")
+        self.assertEqual(reply, get_edit_message(before, after, "Transmitting frequency: 800.0MHz -> 850.0MHz"))
+        self.assertTrue(reply.startswith("Transmitting frequency: 800.0MHz -> 850.0MHz\n\n"
+                                         f"EPL = {before.epl:.1f}dB -> {after.epl:.1f}dB "
+                                         f"({after.epl - before.epl:+.1f}dB)\n"))
+        self.assertEqual(sessions.get(20).freq, 850.0)
+
+        self.assertTrue(self.edit(20, "ht", "35").startswith("Transmitting height: 30m -> 35m\n\n"))
+        self.assertTrue(self.edit(20, "HR", "45").startswith("Receiving height: 40m -> 45m\n\n"))
+        self.assertTrue(self.edit(20, "obstacle", "6", "40").startswith("Added obstacle 2\nDistance: 6km\n"
+                                                                        "Height: 40m\n\n"))
+        chat = sessions.get(20)
+        self.assertEqual((chat.freq, chat.ht, chat.hr, chat.obstacles), (850.0, 35.0, 45.0, [(5.0, 30.0), (6.0, 40.0)]))
+        self.assertEqual(chat.number_of_obstacles, 2)
+
+    def test_edit_invalid(self):
+        self.calculate_link(21)
+        for args in [("freq", "900.1"), ("freq", "1350.00"), ("ht", "abc"), ("hr", "0"), ("ht",), ("obstacle", "6"),
+                     ("obstacle", "20", "40"), ("obstacle", "0", "40"), ("height", "30"), ()]:
+            with self.subTest(args):
+                self.assertEqual(self.edit(21, *args), EDIT_USAGE)
+
+        chat = sessions.get(21)
+        self.assertEqual((chat.freq, chat.ht, chat.hr, chat.obstacles), (800.0, 30.0, 40.0, [(5.0, 30.0)]))
+
+    def test_edit_before_calculate(self):
+        self.assertEqual(self.edit(22, "freq", "850.00"), "Please calculate a path profile using /pathprofile first.")
+
+    def test_edit_effective(self):
+        self.calculate_link(23)
+        self.edit(23, "ht", "35")
+        self.assertEqual(sessions.get(23).effective, (5.0, 30.0))
+
+        self.edit(23, "obstacle", "10", "300")  # Higher than the first obstacle, so it is the effective one now
+        self.assertEqual(sessions.get(23).effective, (10.0, 300.0))
+
+        # Edits after the obstacle was added reuse its effective obstacle instead of searching for it again
+        with mock.patch("pathprofile_bot.effective_obstacle", side_effect=AssertionError):
+            reply = self.edit(23, "hr", "45")
+        chat = sessions.get(23)
+        before = evaluate_link(chat.distance, 800.0, 35, 40, 406, effective=(10.0, 300.0))
+        after = evaluate_link(chat.distance, 800.0, 35, 45, 406, effective=(10.0, 300.0))
+        self.assertEqual(reply, get_edit_message(before, after, "Receiving height: 40m -> 45m"))
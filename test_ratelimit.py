@@ -0,0 +1,75 @@
+import threading
+from unittest import TestCase
+
+from ratelimit import Coalescer, RateLimiter
+
+
+class Test(TestCase):
+    def test_rate_limiter(self):
+        now = [0]
+        limiter = RateLimiter(rate=0.5, burst=2, clock=lambda: now[0])
+        self.assertEqual([limiter.acquire(1) for _ in range(4)], [(True, False), (True, False), (False, True),
+                                                                  (False, False)])  # Only warned once
+        self.assertEqual(limiter.acquire(2), (True, False))  # Other chats have their own bucket
+        self.assertEqual(limiter.wait_time(1), 2)
+
+        now[0] = 2
+        self.assertEqual(limiter.acquire(1), (True, False))
+        self.assertEqual(limiter.acquire(1), (False, True))
+
+        now[0] = 100  # Buckets never hold more than burst tokens
+        self.assertEqual([limiter.acquire(1)[0] for _ in range(3)], [True, True, False])
+        stats = limiter.stats()
+        self.assertEqual((stats["allowed"], stats["throttled"], stats["keys"]), (6, 4, 2))
+
+    def test_max_keys(self):
+        limiter = RateLimiter(rate=1, burst=1, max_keys=2, clock=lambda: 0)
+        limiter.acquire(1)
+        limiter.acquire(2)
+        self.assertEqual(limiter.acquire(1), (False, True))
+        limiter.acquire(3)  # Forgets 2, the least recently seen
+        self.assertEqual(limiter.stats()["keys"], 2)
+        self.assertEqual(limiter.acquire(1), (False, False))  # 1 was kept, empty and already warned
+        self.assertEqual(limiter.acquire(2), (True, False))
+
+    def test_join(self):
+        coalescer = Coalescer()
+        results = []
+        self.assertTrue(coalescer.join("a", lambda *args: results.append(("first", *args))))
+        self.assertFalse(coalescer.join("a", lambda *args: results.append(("second", *args))))
+        self.assertTrue(coalescer.join("b", lambda *args: results.append(("b", *args))))
+
+        coalescer.done("a", 42, None)
+        self.assertEqual(results, [("first", 42, None), ("second", 42, None)])
+        self.assertEqual(coalescer.stats(), {"coalesced": 1, "in_flight": 1})
+        self.assertTrue(coalescer.join("a", lambda *args: None))  # The next request calculates again
+
+    def test_run(self):
+        coalescer = Coalescer()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(10)
+            return 42
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(coalescer.run("a", compute))) for _ in range(3)]
+        threads[0].start()
+        started.wait(10)
+        for thread in threads[1:]:
+            thread.start()
+        while coalescer.stats()["coalesced"] < 2:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual((results, calls), ([42] * 3, [1]))
+
+        with self.assertRaises(ZeroDivisionError):
+            coalescer.run("b", lambda: 1 / 0)
+        self.assertEqual(coalescer.stats()["in_flight"], 0)
@@ -0,0 +1,85 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from linkbudget import evaluate_link
+from main import get_distance
+from registry import *
+
+
+class Test(TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        n = 2000
+        self.names = [str(i) for i in range(n)]
+        self.mgrs = rng.uniform(0, 500, (n, 2))
+        self.heights = rng.uniform(10, 50, n)
+        self.radios = rng.choice([406, 408], n)
+        self.freqs = np.where(self.radios == 406, 800, 1400)
+        self.registry = Registry()
+        self.registry.add(self.names, self.mgrs, self.heights, self.radios, self.freqs)
+
+    def get_distances(self, mgr):
+        return {name: get_distance(mgr, self.mgrs[i]) for i, name in enumerate(self.names) if name in self.registry.indices}
+
+    def test_within_and_nearest(self):
+        mgr = [250, 250]
+        distances = self.get_distances(mgr)
+        expected = sorted((name for name, distance in distances.items() if distance <= 20), key=distances.get)
+        self.assertEqual([neighbour.name for neighbour in self.registry.within(mgr, 20)], expected)
+
+        for mgr in [250, 250], [-300, 800]:  # Far outside of the stations too
+            distances = self.get_distances(mgr)
+            found = self.registry.nearest(mgr, 5)
+            self.assertEqual([neighbour.name for neighbour in found], sorted(distances, key=distances.get)[:5])
+            self.assertAlmostEqual(found[0].distance, min(distances.values()))
+
+    def test_reachable(self):
+        mgr = [100, 400]
+        expected = {}
+        for i, name in enumerate(self.names):
+            fm = evaluate_link(get_distance(mgr, self.mgrs[i]), self.freqs[i], self.heights[i], 2, self.radios[i]).fm
+            if fm >= 20:
+                expected[name] = fm
+
+        found = self.registry.reachable(mgr, 2)
+        self.assertEqual([neighbour.name for neighbour in found], sorted(expected, key=expected.get, reverse=True))
+        self.assertAlmostEqual(found[0].fm, max(expected.values()))
+
+    def test_remove(self):
+        found = self.registry.nearest([250, 250], 3)
+        self.registry.remove([found[0].name, found[1].name])
+        self.assertEqual(self.registry.nearest([250, 250], 1)[0].name, found[2].name)
+
+        self.registry.add(["new"], [[250, 250]], [30], [406], [800])  # Takes a free slot
+        self.assertEqual(len(self.registry.names), 2000)
+        self.assertEqual(self.registry.nearest([250, 250], 1)[0][:2], ("new", 0))
+        self.registry.add(["new"], [[0, 0]], [30], [406], [800])  # Moved
+        self.assertEqual(self.registry.within([250, 250], 0.1), [])
+        self.assertEqual(len(self.registry), 1999)
+
+    def test_add_repeated_name(self):
+        registry = Registry()
+        registry.add(["a", "b", "a"], [[10, 10], [20, 20], [30, 30]], [10, 20, 30], 406, [800, 800, 850])
+        self.assertEqual(len(registry), 2)
+        self.assertEqual([neighbour.name for neighbour in registry.within([10, 10], 1)], [])  # The last one wins
+        self.assertEqual(registry.within([30, 30], 1)[0][:2], ("a", 0))
+        slot = registry.indices["a"]
+        self.assertEqual((registry.heights[slot], registry.freqs[slot]), (30, 850))
+
+        registry.remove(["a"])
+        self.assertEqual(registry.within([30, 30], 1), [])
+        self.assertEqual(registry.within([10, 10], 1), [])
+        self.assertEqual(sum(len(slots) for slots in registry.buckets.values()), 1)
+
+    def test_read_registry(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "stations.csv")
+            with open(path, "w") as f:
+                f.write("name,mgr,height,radio,freq\nHQ,100 100,30,408,1400\nHill,200 100,40,,\n")
+            names, mgrs, heights, radios, freqs = read_registry(path, 406, 800)
+            self.assertEqual((names, radios.tolist(), freqs.tolist()), (["HQ", "Hill"], [408, 406], [1400, 800]))
+            with self.assertRaises(ValueError):
+                read_registry(path)  # No radio for Hill
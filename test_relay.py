@@ -0,0 +1,52 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from linkbudget import evaluate_link
+from relay import *
+from terrain import ElevationGrid, write_grid
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "grid.dem")
+
+        rng = np.random.default_rng(0)
+        elevations = np.cumsum(np.cumsum(rng.normal(0, 1, (200, 200)), axis=0), axis=1)
+        write_grid(self.path, (elevations - elevations.min()) / np.ptp(elevations) * 300, (0, 0))
+        self.grid = ElevationGrid(self.path)
+
+    def tearDown(self):
+        del self.grid
+        self.directory.cleanup()
+
+    def test_without_terrain(self):
+        relays = find_relays([1.0, 1.0], [9.0, 1.0], (2, 0, 8, 2), 406, 800, 30, 40, 20, step=0.5, top=3)
+        self.assertEqual(relays[0].mgr, [5.0, 1.0])  # Halfway, on the line between the nodes
+        self.assertAlmostEqual(relays[0].fm1, evaluate_link(4, 800, 30, 20, 406).fm)
+        self.assertEqual(relays[0].fm, min(relays[0].fm1, relays[0].fm2))
+
+    def test_pruning(self):
+        args = [1.0, 1.0], [19.0, 19.0], (3, 3, 17, 17), 406, 800, 30, 30, 30
+        pruned = find_relays(*args, step=0.2, top=5, grid=self.grid, chunk_size=64)
+        everything = find_relays(*args, step=0.2, top=5, grid=self.grid, prune=False)
+        self.assertEqual(pruned, everything)
+
+        relay = pruned[0]
+        expected = evaluate_link(get_distances([1.0, 1.0], relay.mgr).item(), 800, 30, 30, 406,
+                                 self.grid.profile([1.0, 1.0], relay.mgr))
+        self.assertAlmostEqual(relay.fm1, expected.fm)
+
+    def test_upper_bound(self):
+        candidates = get_candidates((3, 3, 17, 17), 0.5)
+        fm1, _ = evaluate_terrain(self.path, [1.0, 1.0], [19.0, 19.0], candidates, 800, 30, 20, 10, 406)
+        bound = get_upper_bound(get_distances([1.0, 1.0], candidates), 800, 30, 10, 406)
+        self.assertTrue((fm1 <= bound + 1e-9).all())
+
+    def test_box_outside_grid(self):
+        relays = find_relays([1.0, 1.0], [19.0, 19.0], (25, 25, 30, 30), 406, 800, 30, 30, 30, step=0.5,
+                             grid=self.grid)
+        self.assertEqual(relays, [])
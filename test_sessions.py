@@ -0,0 +1,111 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from sessions import ConversationStates, MemoryStore, Session, SQLiteStore
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "sessions.db")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_json(self):
+        session = Session("100 100", "200 200", ([10.0, 10.0], [20.0, 20.0]), 14.1, 406, 800.0, 30, 40, 1, [(5, 30)],
+                          calculated=True, effective=(5.0, 30.0))
+        copy = Session.from_json(session.to_json())
+        self.assertEqual(copy, session)
+        self.assertEqual(copy.obstacles, [(5, 30)])
+
+    def test_memory_store(self):
+        now = [0]
+        store = MemoryStore(max_size=2, ttl=10, clock=lambda: now[0])
+        store.save(1, Session(radio=406))
+        store.save(2, Session(radio=408))
+        store.get(1).freq = 800.0  # Sessions are changed in place
+        store.save(3, Session())  # Evicts 2, the least recently used
+
+        self.assertEqual(store.get(1).freq, 800.0)
+        self.assertIsNone(store.get(2))
+
+        now[0] = 10
+        self.assertIsNone(store.get(1))
+        stats = store.stats()
+        self.assertEqual((stats["evictions"], stats["expirations"]), (1, 1))
+
+        store.delete(3)
+        self.assertIsNone(store.get(3))
+
+    def test_memory_store_ttl_on_get(self):
+        now = [0]
+        store = MemoryStore(ttl=10, clock=lambda: now[0])
+        store.save(1, Session(radio=406))
+        for now[0] in 8, 16, 24:  # Only read, e.g. repeated /sweep, which keeps it alive
+            self.assertIsNotNone(store.get(1))
+
+        now[0] = 34
+        self.assertIsNone(store.get(1))
+
+    def test_sqlite_store(self):
+        now = [0]
+        store = SQLiteStore(self.path, max_size=2, ttl=10, clock=lambda: now[0])
+        other = SQLiteStore(self.path, max_size=2, ttl=10, clock=lambda: now[0])  # Another process serving the bot
+
+        session = Session(radio=406)
+        store.save(1, session)
+        session.freq = 800.0
+        other.save(1, session)
+        self.assertEqual(store.get(1), session)
+
+        now[0] = 1
+        store.save(2, Session())
+        now[0] = 2
+        store.get(1)  # 2 is now the least recently used
+        store.save(3, Session())
+        self.assertIsNone(other.get(2))
+        self.assertEqual(store.stats()["evictions"], 1)
+
+        now[0] = 12
+        self.assertIsNone(store.get(1))
+        self.assertEqual(store.stats()["size"], 1)
+
+        store.delete(3)
+        self.assertEqual(store.stats()["size"], 0)
+
+        store.close()
+        other.close()
+
+    def test_states(self):
+        now = [0]
+        for store in MemoryStore(ttl=10, clock=lambda: now[0]), SQLiteStore(self.path, ttl=10, clock=lambda: now[0]):
+            with self.subTest(type(store).__name__):
+                now[0] = 0
+                states = ConversationStates(store)
+                states[(1, 2)] = "get_freq"
+                self.assertEqual((states.get((1, 2)), (1, 2) in states, (1, 3) in states), ("get_freq", True, False))
+
+                now[0] = 8
+                self.assertEqual(states[(1, 2)], "get_freq")  # Read, which keeps it alive like a session
+                now[0] = 16
+                self.assertEqual(states.pop((1, 2)), "get_freq")
+                self.assertIsNone(states.get((1, 2)))
+                with self.assertRaises(KeyError):
+                    states[(1, 2)]
+
+                states[(1, 2)] = "get_radio"
+                now[0] = 26
+                self.assertNotIn((1, 2), states)
+                store.close()
+
+    def test_sqlite_states_shared(self):
+        store = SQLiteStore(self.path)
+        other = SQLiteStore(self.path)  # Another process serving the bot
+        ConversationStates(store)[(1, 1)] = "get_height"
+        self.assertEqual(ConversationStates(other).get((1, 1)), "get_height")
+        del ConversationStates(other)[(1, 1)]
+        self.assertNotIn((1, 1), ConversationStates(store))
+        store.close()
+        other.close()
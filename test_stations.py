@@ -0,0 +1,28 @@
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from linkbudget import evaluate_link
+from main import get_azimuth, get_distance
+from stations import *
+
+
+class Test(TestCase):
+    def test_matrices(self):
+        rng = np.random.default_rng(0)
+        mgrs = rng.uniform(0, 50, (30, 2))
+        heights = rng.uniform(10, 50, 30)
+
+        with tempfile.TemporaryDirectory() as directory:
+            matrices = get_matrices(mgrs, heights, 408, 1400, directory, block_size=7)
+            self.assertIsInstance(matrices["fm"], np.memmap)
+
+            for i, j in (0, 1), (5, 29), (29, 0):
+                self.assertAlmostEqual(matrices["distance"][i, j], get_distance(mgrs[i], mgrs[j]), places=4)
+                self.assertAlmostEqual(matrices["azimuth"][i, j], get_azimuth(mgrs[i], mgrs[j]), places=2)
+                expected = evaluate_link(get_distance(mgrs[i], mgrs[j]), 1400, heights[i], heights[j], 408).fm
+                self.assertAlmostEqual(matrices["fm"][i, j], expected, places=4)
+
+            self.assertTrue(np.isnan(np.diag(matrices["fm"])).all())
+            del matrices
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+import numpy as np
+
+from linkbudget import evaluate_link
+from main import get_channels
+from sweep import *
+
+
+class Test(TestCase):
+    def test_sweep(self):
+        obstacles = [(3, 30), (7, 40)]
+        result = sweep(14, 30, 40, 406, obstacles)
+
+        self.assertEqual(sorted(result.freq.tolist()), get_channels(406).tolist())
+        self.assertTrue((np.diff(result.fm) <= 0).all())  # Best first
+        for i in 0, 500, -1:
+            expected = evaluate_link(14, result.freq[i], 30, 40, 406, obstacles)
+            self.assertAlmostEqual(result.fm[i], expected.fm)
+
+    def test_ranges(self):
+        result = sweep(50, 30, 30, 408)
+        (low, high, comms), (next_low, _, next_comms) = result.ranges
+        self.assertEqual((low, comms, next_comms), (1350.0, True, False))
+        self.assertGreater(evaluate_link(50, high, 30, 30, 408).fm, 20)
+        self.assertLessEqual(evaluate_link(50, next_low, 30, 30, 408).fm, 20)
+        self.assertIn(f"No comms on {next_low:.2f}", get_sweep_message(result))
+
+        self.assertEqual(sweep(2, 30, 30, 408).ranges, [(1350.0, 2690.0, True)])
+        self.assertIn("Comms through on every channel", get_sweep_message(sweep(2, 30, 30, 408)))
+
+    def test_ranges_case_switch(self):
+        # The case switches from PEL to FSL as the frequency rises, so the lowest channels have no comms but the
+        # best channel does
+        result = sweep(5.077, 10, 10, 406, [(0.51, 10)])
+        self.assertGreater(result.fm[0], 20)
+        self.assertEqual([comms for _, _, comms in result.ranges], [False, True, False])
+        low, high, _ = result.ranges[1]
+        self.assertTrue(low <= result.freq[0] <= high)
+
+        message = get_sweep_message(result)
+        self.assertIn(f"Comms through on {low:.2f}-{high:.2f}MHz", message)
+        self.assertIn("No comms on 610.00", message)
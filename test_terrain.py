@@ -0,0 +1,62 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from terrain import *
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "grid.dem")
+
+        # Flat ground at 50m with a 20m ridge along easting 105
+        elevations = np.full((20, 20), 50)
+        elevations[:, 5] = 70
+        write_grid(self.path, elevations, (100, 100))
+        self.grid = ElevationGrid(self.path)
+
+    def tearDown(self):
+        del self.grid
+        self.directory.cleanup()
+
+    def test_elevation(self):
+        self.assertIsInstance(self.grid.data, np.memmap)
+        self.assertEqual(self.grid.elevation([100, 105], [100, 119]).tolist(), [50, 70])
+        self.assertRaises(ValueError, self.grid.elevation, [120], [100])
+
+    def test_profile(self):
+        obstacles = self.grid.profile([10.0, 10.5], [11.5, 10.5])  # Due east across the ridge
+        self.assertEqual(len(obstacles), 1)
+        self.assertAlmostEqual(obstacles[0][0], 0.5)
+        self.assertAlmostEqual(obstacles[0][1], 20)
+
+        self.assertEqual(self.grid.profile([10.0, 10.0], [10.0, 11.9]), [])  # Along flat ground
+        self.assertRaises(ValueError, self.grid.profile, [10.0, 10.0], [13.0, 10.0])
+
+    def test_cache(self):
+        grid = ElevationGrid(self.path, cache_bytes=2 * 8 * 8 * 2, tile_size=8)  # Room for 2 tiles of 8x8 int16
+        grid.profile([10.0, 10.0], [10.7, 10.0])  # One tile
+        self.assertEqual(grid.cache.stats()["misses"], 1)
+        self.assertEqual(grid.cache.stats()["prefetches"], 1)  # The tile to the east
+
+        grid.profile([10.0, 10.0], [10.7, 10.0])
+        self.assertEqual(grid.cache.stats()["hits"], 1)
+
+        grid.profile([10.0, 11.9], [10.0, 11.5])  # Tile to the north, evicts the oldest
+        stats = grid.cache.stats()
+        self.assertEqual(stats["tiles"], 2)
+        self.assertGreater(stats["evictions"], 0)
+        self.assertLessEqual(stats["bytes"], stats["max_bytes"])
+        self.assertEqual(grid.elevation([105, 100], [110, 110]).tolist(), [70, 50])
+
+        total = add_stats([stats, stats])  # E.g. of 2 workers
+        self.assertEqual((total["hits"], total["tiles"], total["max_bytes"]), (2 * stats["hits"], 4, 2 * 256))
+        self.assertEqual(total["hit_rate"], stats["hits"] / (stats["hits"] + stats["misses"]))
+        self.assertEqual(add_stats([])["hit_rate"], 0.0)
+
+    def test_open_grid(self):
+        self.assertIsNone(open_grid(None))
+        self.assertEqual(open_grid(self.path).shape, (20, 20))
@@ -0,0 +1,41 @@
+import io
+from unittest import TestCase
+
+from linkbudget import evaluate_link
+from track import *
+
+
+class Test(TestCase):
+    def setUp(self):
+        self.tracker = Tracker(["HQ", "Hill"], [[10, 10], [30, 10]], [30, 40], 408, 1400, 2, hysteresis=1)
+
+    def test_update(self):
+        events = [event for t in range(150) for event in self.tracker.update(t, [10 + t, 10])]
+        events += self.tracker.close()
+        self.assertEqual([(event["type"], event["station"]) for event in events],
+                         [("start", "HQ"), ("start", "Hill"), ("segment", "HQ"), ("crossing", "HQ"),
+                          ("segment", "Hill"), ("crossing", "Hill"), ("segment", "HQ"), ("segment", "Hill")])
+
+        crossing = events[3]
+        self.assertFalse(crossing["comms"])
+        self.assertLessEqual(crossing["fm"], 20 - 1)
+        self.assertAlmostEqual(crossing["fm"], evaluate_link(crossing["distance"], 1400, 30, 2, 408).fm, places=2)
+        self.assertEqual((events[2]["start"], events[2]["end"], events[2]["points"]), (0, crossing["time"],
+                                                                                       crossing["time"]))
+        self.assertIsNone(events[2]["max_fm"])  # Infinite at the station itself
+        self.assertEqual(events[-2]["points"] + events[2]["points"], 150)
+
+    def test_hysteresis(self):
+        flapping = Tracker(["HQ"], [[10, 10]], [30], 408, 1400, 2)
+        for tracker, crossings in (flapping, 4), (self.tracker, 0):
+            events = []
+            for t, distance in enumerate([77, 79, 77, 79, 77]):  # FM just either side of the threshold
+                events += tracker.update(t, [10 + distance, 10])
+            self.assertEqual(len([e for e in events if e["type"] == "crossing" and e["station"] == "HQ"]), crossings)
+
+    def test_track(self):
+        f = io.StringIO("time,mgr\n0,100 100\n1,bad\n2,101 100\n")
+        events = list(track(read_track(f, "csv"), self.tracker))
+        self.assertEqual([event["type"] for event in events], ["start", "start", "error", "segment", "segment"])
+        self.assertEqual(events[2]["row"], 2)
+        self.assertEqual((events[3]["start"], events[3]["end"], events[3]["points"]), ("0", "2", 2))
@@ -0,0 +1,136 @@
+import json
+import sys
+
+import numpy as np
+
+from batch import get_format, read_links
+from linkbudget import FM_THRESHOLD, link_budget
+from main import check_mgr, get_azimuths, get_distances
+from stations import read_stations
+
+
+def get_number(x, digits):
+    """x rounded to digits, or None if it is not finite (e.g. the FM at the station itself), which JSON cannot hold"""
+    return round(x, digits) if np.isfinite(x) else None
+
+
+class Tracker:
+    """
+    Follows a moving node against fixed stations one position at a time, keeping only the current segment of each
+    station (the positions since comms last changed), so memory does not grow with the length of the track.
+    Comms to a station change when its FM crosses threshold, moved away from the current side by hysteresis so that a
+    FM hovering around the threshold does not flap.
+    """
+
+    def __init__(self, names, mgrs, heights, radio, freq, hr, threshold=FM_THRESHOLD, hysteresis=0.0):
+        """
+        :param names, mgrs, heights: the fixed stations, as returned by stations.read_stations
+        :param hr: height of the moving node (m)
+        """
+        self.names = list(names)
+        self.mgrs = np.asarray(mgrs, dtype=float).reshape(-1, 2)
+        self.heights = np.asarray(heights, dtype=float)
+        self.radio = radio
+        self.freq = freq
+        self.hr = hr
+        self.threshold = threshold
+        self.hysteresis = hysteresis
+
+        n = len(self.names)
+        self.comms = None  # Whether comms are through to each station, None before the first position
+        self.start = [None] * n  # Time the current segment started
+        self.points = np.zeros(n, dtype=int)
+        self.min_fm = np.full(n, np.inf)
+        self.max_fm = np.full(n, -np.inf)
+        self.last = None  # Time of the last position
+
+    def update(self, time, mgr):
+        """
+        Takes the next position of the moving node
+        :param mgr: [10.0, 10.0] in km, as returned by main.get_mgr
+        :return: events of the stations whose comms changed: the segment that ended, then the crossing itself
+        """
+        distance = get_distances(mgr, self.mgrs)
+        azimuth = get_azimuths(mgr, self.mgrs)
+        fm = link_budget(distance, self.freq, self.heights, self.hr, self.radio).fm
+
+        if self.comms is None:
+            comms = fm > self.threshold
+            changed = np.arange(len(self.names))
+        else:
+            comms = np.where(self.comms, fm > self.threshold - self.hysteresis, fm > self.threshold + self.hysteresis)
+            changed = np.flatnonzero(comms != self.comms)
+
+        events = []
+        for i in changed.tolist():
+            if self.comms is not None:
+                events.append(self.get_segment(i, time))
+            events.append({"type": "crossing" if self.comms is not None else "start", "time": time,
+                           "station": self.names[i], "mgr": f"{mgr[0] * 10:.0f} {mgr[1] * 10:.0f}",
+                           "distance": round(distance[i].item(), 3), "azimuth": round(azimuth[i].item(), 1),
+                           "fm": get_number(fm[i].item(), 2), "comms": bool(comms[i])})
+            self.start[i] = time
+            self.points[i] = 0
+            self.min_fm[i] = np.inf
+            self.max_fm[i] = -np.inf
+
+        self.comms = comms
+        self.points += 1
+        self.min_fm = np.minimum(self.min_fm, fm)
+        self.max_fm = np.maximum(self.max_fm, fm)
+        self.last = time
+        return events
+
+    def close(self):
+        """Events of the segments still open at the end of the track"""
+        if self.comms is None:
+            return []
+        return [self.get_segment(i, self.last) for i in range(len(self.names))]
+
+    def get_segment(self, i, end):
+        """Summary of the current segment of station i, ending at end"""
+        return {"type": "segment", "station": self.names[i], "start": self.start[i], "end": end,
+                "comms": bool(self.comms[i]), "points": self.points[i].item(),
+                "min_fm": get_number(self.min_fm[i].item(), 2), "max_fm": get_number(self.max_fm[i].item(), 2)}
+
+
+def read_track(f, fmt):
+    """
+    Yields (row number, time, mgr) of every position in a CSV (with a header row) or JSONL file with a time and mgr,
+    e.g. 2022-11-01T10:00:00,100 100, as soon as it is read. mgr is None if the row is invalid.
+    """
+    for number, row in enumerate(read_links(f, fmt), 1):
+        if row is None or not check_mgr(str(row.get("mgr", ""))):
+            yield number, row and row.get("time"), None
+        else:
+            yield number, row.get("time"), [float(x) / 10 for x in str(row["mgr"]).split()]
+
+
+def track(positions, tracker):
+    """Yields the events of tracker over (row number, time, mgr) positions, with an error for every invalid row"""
+    for number, time, mgr in positions:
+        if mgr is None:
+            yield {"type": "error", "row": number, "error": "invalid position"}
+        else:
+            yield from tracker.update(time, mgr)
+    yield from tracker.close()
+
+
+def run_track(input_path, stations_path, radio, freq, hr, hysteresis=0.0, output_path=None, input_format=None):
+    """
+    Streams positions from input_path (CSV or JSONL, "-" for stdin) against the stations in stations_path and writes
+    every event as a line of JSON as soon as it happens, so a live feed can be followed
+    """
+    tracker = Tracker(*read_stations(stations_path), radio, freq, hr, hysteresis=hysteresis)
+
+    f_in = sys.stdin if input_path == "-" else open(input_path, newline="")
+    f_out = sys.stdout if not output_path or output_path == "-" else open(output_path, "w")
+    try:
+        for event in track(read_track(f_in, input_format or get_format(input_path)), tracker):
+            f_out.write(json.dumps(event) + "\n")
+            f_out.flush()
+    finally:
+        if f_in is not sys.stdin:
+            f_in.close()
+        if f_out is not sys.stdout:
+            f_out.close()